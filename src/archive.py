@@ -0,0 +1,450 @@
+""" Keeps the older messages of each channel in a memory-mapped file
+
+tiered_history can be used in place of the plain list held in
+channel.channel_messages. Its newest messages stay in memory as message
+objects, and archive_messages moves the older ones out to a
+message_archive: one append-only file, read through mmap, holding a
+fixed size header and the utf-8 text of each archived message. What is
+left in memory per archived message is its message_id in the channel's
+history, its offset in the file and where its record starts. Archived
+messages are also dropped from data.search_index; searches find them by
+scanning the searched channels' records in the file instead, see
+message_archive.matches. So memory grows with recent activity rather
+than with the whole history.
+
+Reading an archived message returns an archived_message, a view like
+message_store.message_row whose attributes read the file. Pinning and
+removing write the header in place, and an edit appends a new copy of the
+message and points its offset there. Archived messages are no longer in
+data.message_id_index, data.find_message asks the archive instead, so
+paging, cursors, search and check_message_valid reach them without
+knowing where they are kept.
+
+The archive only ever holds copies: snapshots, the write-ahead log and
+the database still hold every message, so the file is started afresh each
+time the server starts. Loading a snapshot writes each channel's older
+messages straight to it, see load_history.
+
+To tier new channels this way:
+    data.archive = message_archive(path)
+    data.history_class = tiered_history
+"""
+import mmap
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from data import data, NO_REACTS
+
+# message_id, channel_id, u_id, time_created, seq, is_pinned, removed, text length
+HEADER = struct.Struct('<qqqqqbbI')
+PINNED_AT = 40
+REMOVED_AT = 41
+
+# archive_messages keeps at most this many messages of each channel in memory
+ARCHIVE_HOT_MESSAGES = 1000
+# and archives messages sent more than this many seconds ago
+ARCHIVE_MAX_AGE = 7 * 24 * 60 * 60
+# Offsets are kept in pages covering this many message_ids each, and only
+# for the ranges of message_ids that hold archived messages
+OFFSET_PAGE = 4096
+
+class archived_message:
+    __slots__ = ('archive', 'message_id')
+
+    def __init__(self, archive, message_id):
+        self.archive = archive
+        self.message_id = message_id
+
+    def __eq__(self, other):
+        return isinstance(other, archived_message) and self.archive is other.archive \
+            and self.message_id == other.message_id
+
+    def __hash__(self):
+        return hash(self.message_id)
+
+    @property
+    def channel_id(self):
+        return self.archive.header(self.message_id)[1]
+
+    @property
+    def u_id(self):
+        return self.archive.header(self.message_id)[2]
+
+    @property
+    def time_created(self):
+        return self.archive.header(self.message_id)[3]
+
+    @property
+    def seq(self):
+        return self.archive.header(self.message_id)[4]
+
+    @property
+    def message(self):
+        return self.archive.read_text(self.message_id)
+
+    @property
+    def is_pinned(self):
+        return bool(self.archive.header(self.message_id)[5])
+
+    @is_pinned.setter
+    def is_pinned(self, is_pinned):
+        self.archive.write_flag(self.message_id, PINNED_AT, is_pinned)
+
+    @property
+    def removed(self):
+        return bool(self.archive.header(self.message_id)[6])
+
+    @removed.setter
+    def removed(self, removed):
+        self.archive.write_flag(self.message_id, REMOVED_AT, removed)
+
+    @property
+    def reacts(self):
+        return self.archive.reacts.get(self.message_id, NO_REACTS)
+
+    @reacts.setter
+    def reacts(self, reacts):
+        if reacts:
+            self.archive.reacts[self.message_id] = list(reacts)
+        else:
+            self.archive.reacts.pop(self.message_id, None)
+
+    def message_details(self):
+        _, _, u_id, time_created, _, is_pinned, _, _ = self.archive.header(self.message_id)
+        return {
+            'message_id': self.message_id,
+            'u_id': u_id,
+            'message': self.archive.read_text(self.message_id),
+            'time_created': time_created,
+            'is_pinned': bool(is_pinned),
+            'reacts': list(self.reacts)
+        }
+
+    def update_message(self, new_message):
+        self.archive.write_text(self.message_id, new_message)
+
+    def new_react(self, react):
+        self.archive.reacts.setdefault(self.message_id, []).append(react)
+
+    def remove_react(self, react_index):
+        reacts = self.archive.reacts[self.message_id]
+        reacts.pop(react_index)
+        if not reacts:
+            del self.archive.reacts[self.message_id]
+
+class message_archive:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w+b')
+        self.map = None
+        # Readers remap under map_lock while sharing data.lock, so a map they
+        # replace may still be read by another; it is closed by the next writer
+        self.map_lock = threading.Lock()
+        self.retired_maps = []
+        self.size = 0
+        # message_id // OFFSET_PAGE -> the offsets of the latest copy of each
+        # message_id in that page, -1 where not archived
+        self.offset_pages = {}
+        # Where each record in the file starts, in order, for matches
+        self.record_starts = array('q')
+        # channel_id -> the (start, end) byte ranges, flattened, of each run
+        # of that channel's records in the file, so matches only scans the
+        # channels being searched
+        self.channel_ranges = {}
+        # The reacts of the few archived messages that have any
+        self.reacts = {}
+
+    def __contains__(self, message_id):
+        return message_id >= 0 and self.offset(message_id) >= 0
+
+    def offset(self, message_id):
+        page = self.offset_pages.get(message_id // OFFSET_PAGE)
+        return -1 if page is None else page[message_id % OFFSET_PAGE]
+
+    def set_offset(self, message_id, offset):
+        page = self.offset_pages.get(message_id // OFFSET_PAGE)
+        if page is None:
+            page = self.offset_pages[message_id // OFFSET_PAGE] = array('q', [-1]) * OFFSET_PAGE
+        page[message_id % OFFSET_PAGE] = offset
+
+    def add(self, channel_id, message):
+        """ Appends a copy of message, which belongs to channel_id """
+        self.append(message.message_id, channel_id, message.u_id, message.time_created,
+                    message.seq, message.is_pinned, message.removed, message.message)
+        if message.reacts:
+            self.reacts[message.message_id] = list(message.reacts)
+
+    def append(self, message_id, channel_id, u_id, time_created, seq, is_pinned, removed, text):
+        self.append_encoded(message_id, channel_id, u_id, time_created, seq, is_pinned, removed,
+                            text.encode())
+
+    def append_encoded(self, message_id, channel_id, u_id, time_created, seq, is_pinned, removed,
+                       encoded):
+        self.close_retired()
+        self.file.seek(self.size)
+        self.file.write(HEADER.pack(message_id, channel_id, u_id, time_created, seq,
+                                    int(is_pinned), int(removed), len(encoded)))
+        self.file.write(encoded)
+        self.set_offset(message_id, self.size)
+        self.record_starts.append(self.size)
+        end = self.size + HEADER.size + len(encoded)
+        ranges = self.channel_ranges.get(channel_id)
+        if ranges is None:
+            self.channel_ranges[channel_id] = array('q', [self.size, end])
+        elif ranges[-1] == self.size:
+            # Follows the channel's last record, archive_messages and
+            # load_history write each channel's messages together
+            ranges[-1] = end
+        else:
+            ranges.extend((self.size, end))
+        self.size = end
+
+    def mapped(self, end):
+        """ The file mapped into memory up to at least end """
+        with self.map_lock:
+            if self.map is None or len(self.map) < end:
+                self.file.flush()
+                if self.map is not None:
+                    self.retired_maps.append(self.map)
+                self.map = mmap.mmap(self.file.fileno(), self.size)
+            return self.map
+
+    def close_retired(self):
+        """ Closes the replaced maps, only while holding data.lock for writing """
+        for retired in self.retired_maps:
+            retired.close()
+        self.retired_maps.clear()
+
+    def header(self, message_id):
+        offset = self.offset(message_id)
+        return HEADER.unpack_from(self.mapped(offset + HEADER.size), offset)
+
+    def read_text(self, message_id):
+        offset = self.offset(message_id)
+        length = self.header(message_id)[7]
+        start = offset + HEADER.size
+        return self.mapped(start + length)[start:start + length].decode()
+
+    def write_text(self, message_id, text):
+        """ Appends a copy of the message with new text, the old copy is never read again """
+        header = self.header(message_id)
+        self.append(message_id, *header[1:7], text)
+
+    def write_flag(self, message_id, at, value):
+        offset = self.offset(message_id)
+        self.mapped(offset + HEADER.size)[offset + at] = int(value)
+
+    def find(self, message_id):
+        """ The (channel, message) pair of a live archived message, or None """
+        if message_id not in self:
+            return None
+        found = archived_message(self, message_id)
+        if found.removed:
+            return None
+        return (data.channels[found.channel_id], found)
+
+    def matches(self, query_str, channel_ids):
+        """
+        Finds the live archived messages in channel_ids whose text contains
+        query_str, by searching the parts of the mapped file holding those
+        channels' records rather than an index
+
+        Parameters:
+            query_str (str): the string being searched for
+            channel_ids (set): the channels to search
+
+        Returns:
+            matches (list): (channel_id, seq, time_created, message_id) of
+                            each matching message
+        """
+        needle = query_str.encode()
+        if not needle or not self.size:
+            return []
+        mapped = self.mapped(self.size)
+        matches = []
+        for channel_id in channel_ids:
+            ranges = self.channel_ranges.get(channel_id, ())
+            for index in range(0, len(ranges), 2):
+                self.match_range(mapped, needle, ranges[index], ranges[index + 1], matches)
+        return matches
+
+    def match_range(self, mapped, needle, range_start, range_end, matches):
+        """ Adds the live messages matching needle in the records from range_start to range_end """
+        position = mapped.find(needle, range_start, range_end)
+        while position >= 0:
+            start = self.record_starts[bisect_right(self.record_starts, position) - 1]
+            message_id, channel_id, _, time_created, seq, _, removed, length = \
+                HEADER.unpack_from(mapped, start)
+            text_end = start + HEADER.size + length
+            if position < start + HEADER.size or position + len(needle) > text_end:
+                # Matched across a header, look again from the next byte
+                position = mapped.find(needle, position + 1, range_end)
+                continue
+            # Older copies of edited messages are skipped
+            if not removed and self.offset(message_id) == start:
+                matches.append((channel_id, seq, time_created, message_id))
+            position = mapped.find(needle, text_end, range_end)
+
+    def clear(self):
+        self.close_retired()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.truncate(0)
+        self.size = 0
+        self.offset_pages.clear()
+        self.record_starts = array('q')
+        self.channel_ranges.clear()
+        self.reacts.clear()
+
+    def close(self):
+        self.close_retired()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+class tiered_history:
+    """ Archived messages, oldest first, followed by the messages kept in memory """
+    def __init__(self):
+        self.archived = array('q')
+        self.hot = []
+
+    def __len__(self):
+        return len(self.archived) + len(self.hot)
+
+    def __iter__(self):
+        for message_id in self.archived:
+            yield archived_message(data.archive, message_id)
+        yield from self.hot
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if 0 <= index < len(self.archived):
+            return archived_message(data.archive, self.archived[index])
+        if index < 0:
+            raise IndexError('history index out of range')
+        return self.hot[index - len(self.archived)]
+
+    def append(self, message):
+        # Messages that are already archived only come back in order, when
+        # channel.compact rebuilds the history
+        if isinstance(message, archived_message):
+            self.archived.append(message.message_id)
+        else:
+            self.hot.append(message)
+
+    def archive_oldest(self, channel_id, count):
+        """ Moves the oldest count messages kept in memory to data.archive """
+        for message in self.hot[:count]:
+            data.archive.add(channel_id, message)
+            self.archived.append(message.message_id)
+            data.message_id_index.pop(message.message_id, None)
+            data.search_index.discard(channel_id, message.message_id, message.message)
+        del self.hot[:count]
+
+def archive_messages(max_hot=ARCHIVE_HOT_MESSAGES, max_age=ARCHIVE_MAX_AGE):
+    """
+    Moves the older messages of every tiered channel to data.archive
+
+    Parameters:
+        max_hot (int): the most messages to keep in memory per channel, or
+                       None for no limit
+        max_age (int): archive messages sent more than this many seconds
+                       ago, or None to archive by count only
+
+    Returns:
+        archived (int): the number of live messages moved
+    """
+    archived = 0
+    with data.lock:
+        cutoff = time.time() - max_age if max_age is not None else None
+        for channel in data.channels:
+            # Removed messages are archived still flagged, keeping the
+            # channel's tombstone positions right, and dropped by compact()
+            history = channel.channel_messages
+            if not isinstance(history, tiered_history):
+                continue
+            live_hot = len(history.hot) - (len(channel.tombstones) -
+                                           bisect_left(channel.tombstones, len(history.archived)))
+            excess = max(live_hot - max_hot, 0) if max_hot is not None else 0
+            count, live = oldest_to_archive(
+                ((message.time_created, message.removed) for message in history.hot), excess, cutoff)
+            if count:
+                history.archive_oldest(channel.channel_id, count)
+                archived += live
+    return archived
+
+def oldest_to_archive(messages, excess, cutoff):
+    """
+    Works out how many of a channel's oldest messages to archive
+
+    Parameters:
+        messages (iterable): (time_created, removed) of the messages kept
+                             in memory, oldest first
+        excess (int): how many live messages must go
+        cutoff (float): messages sent before this time must go too, or None
+
+    Returns:
+        (count, live) (tuple): how many messages to archive, and how many
+                               of those are live
+    """
+    count = live = 0
+    for time_created, removed in messages:
+        if live >= excess and (cutoff is None or time_created >= cutoff):
+            break
+        if not removed:
+            live += 1
+        count += 1
+    return count, live
+
+def load_history(history, channel_id, saved, removed):
+    """
+    Loads the older messages of a channel being restored from a snapshot
+    straight into data.archive, the ones archive_messages would move, so
+    the whole history is never held in memory
+
+    Parameters:
+        history (tiered_history): the channel's history, still empty
+        channel_id (int): the channel being restored
+        saved (dict): the channel as snapshot.capture_channel saved it
+        removed (set): the rows of removed messages
+
+    Returns:
+        first_hot (int): the row of the oldest message left to keep in memory
+    """
+    message_ids, u_ids, times, pinned, seqs = saved['columns']
+    text, text_start, text_length = saved['text']
+    live = len(message_ids) - len(removed)
+    first_hot, _ = oldest_to_archive(((times[row], row in removed) for row in range(len(times))),
+                                     max(live - ARCHIVE_HOT_MESSAGES, 0),
+                                     time.time() - ARCHIVE_MAX_AGE)
+    for row in range(first_hot):
+        message_id = message_ids[row]
+        start = text_start[row]
+        data.archive.append_encoded(message_id, channel_id, u_ids[row], times[row], seqs[row],
+                                    pinned[row], row in removed,
+                                    text[start:start + text_length[row]])
+        if message_id in saved['reacts']:
+            data.archive.reacts[message_id] = saved['reacts'][message_id]
+        history.archived.append(message_id)
+    return first_hot
+
+def start_archiving(interval):
+    """
+    Runs archive_messages every interval seconds on the scheduler thread
+
+    Parameters:
+        interval (float): seconds between runs
+
+    Returns:
+        job_id (int): the recurring job, which clear() leaves queued
+    """
+    def run_archiving():
+        archive_messages()
+    return data.scheduler.every(interval, run_archiving)
@@ -0,0 +1,186 @@
+""" Tests for archive.py """
+import pytest
+from data import data
+from auth import auth_register
+from channel import channel_messages, channel_messages_cursor
+from channels import channels_create
+from message import message_send, message_remove, message_edit, message_react, message_unreact
+from message import message_pin, message_unpin
+from other import clear, search
+from snapshot import save_snapshot, load_snapshot
+from archive import message_archive, tiered_history, archive_messages, start_archiving
+from error import InputError
+
+@pytest.fixture
+def tiered(tmp_path):
+    clear()
+    data.archive = message_archive(str(tmp_path / 'messages.archive'))
+    data.history_class = tiered_history
+    yield data.archive
+    clear()
+    data.archive.close()
+    data.archive = None
+    data.history_class = list
+
+def fill_channel():
+    """ Sends 30 messages and changes a few of them, returning the user, channel and message_ids """
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    channel_id = channels_create(user['token'], "channel", True)['channel_id']
+    msg_ids = [message_send(user['token'], channel_id, "message " + str(i) + " ü")['message_id']
+               for i in range(30)]
+    message_remove(user['token'], msg_ids[1])
+    message_edit(user['token'], msg_ids[2], "edited")
+    message_react(user['token'], msg_ids[3], 1)
+    message_pin(user['token'], msg_ids[4])
+    return user, channel_id, msg_ids
+
+def read_everything(user, channel_id):
+    pages = [channel_messages(user['token'], channel_id, start) for start in (0, 10, 25)]
+    pages.append(channel_messages_cursor(user['token'], channel_id, before_message_id=20, limit=7))
+    pages.append(channel_messages_cursor(user['token'], channel_id, after_message_id=3, limit=7))
+    # The removed message still works as a cursor
+    pages.append(channel_messages_cursor(user['token'], channel_id, before_message_id=1))
+    for query_str in ("message 1", "ü", "edited", "e"):
+        pages.append(search(user['token'], query_str))
+    pages.append(search(user['token'], "message", limit=6, before_message_id=12))
+    return pages
+
+def test_archived_reads_match(tiered):
+    user, channel_id, _ = fill_channel()
+    before = read_everything(user, channel_id)
+
+    assert archive_messages(max_hot=5, max_age=None) == 24
+    history = data.channels[channel_id].channel_messages
+    # The removed message is archived with the others until the channel is compacted
+    assert len(history.hot) == 5 and len(history.archived) == 25
+    assert 0 not in data.message_id_index
+    assert read_everything(user, channel_id) == before
+    # Archiving again has nothing left to move
+    assert archive_messages(max_hot=5, max_age=None) == 0
+
+def test_archived_messages_leave_the_search_index(tiered, monkeypatch):
+    monkeypatch.setattr('archive.OFFSET_PAGE', 8)
+    user, channel_id, msg_ids = fill_channel()
+    before = read_everything(user, channel_id)
+    # Archives message_ids 0 to 15, the removed one among them
+    archive_messages(max_hot=14, max_age=None)
+
+    hot_ids = {message.message_id for message in data.channels[channel_id].channel_messages.hot}
+    assert set(data.search_index.message_times) == hot_ids
+    assert set(data.search_index.candidates("message", [channel_id])) == hot_ids
+    # Only the pages covering archived message_ids hold offsets
+    assert sorted(tiered.offset_pages) == [0, 1]
+    assert read_everything(user, channel_id) == before
+    # Archived messages still work as search cursors
+    page = search(user['token'], "message", limit=2, before_message_id=msg_ids[10])
+    assert [msg['message_id'] for msg in page['messages']] == [msg_ids[9], msg_ids[8]]
+
+def test_archive_matches(tiered):
+    user, channel_id, msg_ids = fill_channel()
+    other_id = channels_create(user['token'], "other", True)['channel_id']
+    other_msg = message_send(user['token'], other_id, "message in another channel")['message_id']
+    archive_messages(max_hot=0, max_age=None)
+    message_edit(user['token'], msg_ids[12], "renamed")
+
+    def found(query_str, channel_ids):
+        return sorted(message_id for _, _, _, message_id in tiered.matches(query_str, channel_ids))
+    assert found("message 1", {channel_id}) == [msg_ids[i] for i in [10, 11, 13, 14, 15, 16, 17, 18, 19]]
+    assert found("renamed", {channel_id}) == [msg_ids[12]]
+    assert found("message 12", {channel_id}) == []
+    assert found("another", {channel_id}) == []
+    assert found("another", {channel_id, other_id}) == [other_msg]
+    # Each channel's messages were archived together, the edit started a new run
+    assert len(tiered.channel_ranges[channel_id]) == 4
+    assert len(tiered.channel_ranges[other_id]) == 2
+
+def test_archive_remap_keeps_maps_in_use(tiered):
+    tiered.append(0, 0, 0, 0, 0, False, False, "first")
+    first_map = tiered.mapped(1)
+    tiered.append(1, 0, 0, 0, 1, False, False, "second")
+    # Another reader remaps while the first map is still being read
+    assert tiered.read_text(1) == "second"
+    assert not first_map.closed
+    assert tiered.read_text(0) == "first"
+    # The next writer closes it
+    tiered.append(2, 0, 0, 0, 2, False, False, "third")
+    assert first_map.closed
+    assert tiered.read_text(2) == "third"
+
+def test_load_archives_older_messages(tiered, tmp_path, monkeypatch):
+    user, channel_id, _ = fill_channel()
+    before = read_everything(user, channel_id)
+    save_snapshot(str(tmp_path / 'store.snapshot'))
+
+    clear()
+    monkeypatch.setattr('archive.ARCHIVE_HOT_MESSAGES', 5)
+    load_snapshot(str(tmp_path / 'store.snapshot'))
+    history = data.channels[channel_id].channel_messages
+    assert len(history.hot) == 5 and len(history.archived) == 25
+    assert len(data.message_id_index) == 5
+    assert read_everything(user, channel_id) == before
+
+def test_archive_by_age(tiered):
+    user, channel_id, msg_ids = fill_channel()
+    history = data.channels[channel_id].channel_messages
+    for message in history.hot[:10]:
+        message.time_created -= 3600
+    before = read_everything(user, channel_id)
+
+    # One of the ten is the removed message, which is moved but not counted
+    assert archive_messages(max_hot=None, max_age=60) == 9
+    assert [message.message_id for message in history.hot][:1] == [msg_ids[10]]
+    assert read_everything(user, channel_id) == before
+
+def test_change_archived_messages(tiered):
+    user, channel_id, msg_ids = fill_channel()
+    archive_messages(max_hot=5, max_age=None)
+
+    message_edit(user['token'], msg_ids[2], "a much longer edit than before")
+    message_edit(user['token'], msg_ids[5], "short")
+    message_unreact(user['token'], msg_ids[3], 1)
+    message_react(user['token'], msg_ids[6], 1)
+    message_unpin(user['token'], msg_ids[4])
+    message_pin(user['token'], msg_ids[7])
+    message_remove(user['token'], msg_ids[8])
+    with pytest.raises(InputError):
+        message_remove(user['token'], msg_ids[8])
+
+    messages = {msg['message_id']: msg for msg in channel_messages(user['token'], channel_id, 0)['messages']}
+    assert msg_ids[8] not in messages
+    assert messages[msg_ids[2]]['message'] == "a much longer edit than before"
+    assert messages[msg_ids[5]]['message'] == "short"
+    assert messages[msg_ids[3]]['reacts'] == []
+    assert messages[msg_ids[6]]['reacts'] == [
+        {'react_id': 1, 'u_ids': [user['u_id']], 'is_this_user_reacted': True}
+    ]
+    assert not messages[msg_ids[4]]['is_pinned'] and messages[msg_ids[7]]['is_pinned']
+    assert [msg['message_id'] for msg in search(user['token'], "short")['messages']] == [msg_ids[5]]
+    assert search(user['token'], "message 8")['messages'] == []
+
+    # Compacting keeps archived messages archived
+    data.compact_messages()
+    history = data.channels[channel_id].channel_messages
+    assert isinstance(history, tiered_history)
+    assert len(history.archived) == 23 and len(history.hot) == 5
+
+def test_snapshot_of_archived_messages(tiered, tmp_path):
+    user, channel_id, _ = fill_channel()
+    archive_messages(max_hot=5, max_age=None)
+    before = read_everything(user, channel_id)
+    save_snapshot(str(tmp_path / 'store.snapshot'))
+
+    clear()
+    load_snapshot(str(tmp_path / 'store.snapshot'))
+    # The removed message comes back as a tombstone
+    assert len(data.channels[channel_id].channel_messages.hot) == 30
+    assert data.channels[channel_id].num_messages() == 29
+    assert read_everything(user, channel_id) == before
+
+def test_archiving_survives_snapshot_load(tiered, tmp_path):
+    fill_channel()
+    save_snapshot(str(tmp_path / 'store.snapshot'))
+    job_id = start_archiving(60)
+    # Restoring clears the store first
+    load_snapshot(str(tmp_path / 'store.snapshot'))
+    assert data.scheduler.queue_depth() == 1
+    assert data.scheduler.cancel(job_id)
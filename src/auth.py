@@ -9,6 +9,7 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 from data import data, user
+from storage import store
 from error import InputError
 from other import valid_email, existing_email
 
@@ -32,12 +33,14 @@ def auth_passwordreset_reset(reset_code, new_password):
 
     # Check that the reset_code is valid
     key_valid = False
-    for user in data.users:
+    for user in store.users.all():
         if user.secret_key != None:
             if user.secret_key == reset_code:
                 key_valid = True
                 user.password = hashlib.sha256(new_password.encode()).hexdigest()
                 user.secret_key = None # invalidate key
+                data.token_cache.remove_user(user.u_id)
+                store.users.save(user)
                 break
     if key_valid == False:
         raise InputError("Invalid reset code given.")
@@ -55,14 +58,8 @@ def auth_passwordreset_request(email):
     # checks email is for a valid user
     valid_email(email)
     # Check email exists - If reached here, then email is valid
-    email_exists = False
-
-    for user in data.users:
-        if user.email == email:
-            current_user = user
-            email_exists = True
-
-    if not email_exists:
+    current_user = store.users.find_by_email(email)
+    if current_user is None:
         raise InputError("No registered user with that email")
 
     # generates a secret key
@@ -71,6 +68,7 @@ def auth_passwordreset_request(email):
 
     # stores the key in the user dictionary
     current_user.secret_key = secret_key
+    store.users.save(current_user)
 
     # sends email with secret key
     system_email = 'testcode03@gmail.com'
@@ -118,29 +116,22 @@ def auth_login(email, password):
     valid_email(email)
 
     # Check email exists - If reached here, then email is valid
-    email_exists = False
-
-    for item in data.users:
-        if item.email == email:
-            current_user = item.u_id
-            email_exists = True
-
-    if not email_exists:
+    login_user = store.users.find_by_email(email)
+    if login_user is None:
         raise InputError("No registered user with that email")
+    current_user = login_user.u_id
 
     if not isinstance(password, str):
         raise InputError("Invalid password")
 
     # Check hashed password - If reached here, then user exists
     hashed_password = hashlib.sha256(password.encode()).hexdigest()
-    if not hashed_password == data.users[current_user].password:
-        print(data.users[current_user].password)
-        print(hashed_password)
+    if not hashed_password == login_user.password:
         raise InputError("Incorrect Password")
 
     # Generate Token - Used Siennas method - If reached here, login successful
     token = generate_token(current_user)
-    data.tokens[current_user] = token
+    store.sessions.add(token, current_user)
 
     return {
         'u_id': current_user,
@@ -161,13 +152,9 @@ def auth_logout(token):
     						  the token was valid
     	}
     """
-    if token in data.tokens:
-        index_token = data.tokens.index(token)
-
-        success = True
-        data.tokens[index_token] = ''
-    else:
-        success = False
+    success = isinstance(token, str) and store.sessions.end(token)
+    if success:
+        data.token_cache.remove(token)
 
     return {
         'is_success': success,
@@ -197,7 +184,7 @@ def auth_register(email, password, name_first, name_last):
     valid_email(email)
 
     # Email already belongs to another user
-    if data.users != []:
+    if store.users.count() != 0:
         existing_email(email)
 
     # Password is less than 6 characters
@@ -215,11 +202,11 @@ def auth_register(email, password, name_first, name_last):
     new_user = user(email, password, name_first, name_last)
 
     # add the new user to the data
-    data.new_user(new_user)
+    store.users.add(new_user)
 
     ### Token generation ###
     token = generate_token(new_user.u_id)
-    data.tokens.append(token)
+    store.sessions.add(token, new_user.u_id)
 
     return {
         'u_id': new_user.u_id,
@@ -229,7 +216,8 @@ def auth_register(email, password, name_first, name_last):
 
 def generate_token(u_id):
     """
-    Generates an encoded token given a user id
+    Generates an encoded token given a user id. Each call carries a new
+    session_id so that a user can hold several sessions at once.
     Parameters:
         u_id (int): A unique ID for each user
 
@@ -239,6 +227,7 @@ def generate_token(u_id):
 
     """
     SECRET = 'aaaaaddeeeiiklmmnnnnnorrsy'
-    encoded_jwt = jwt.encode({'u_id':u_id}, SECRET, algorithm='HS256').decode('utf-8')
+    session_id = store.sessions.next_index()
+    encoded_jwt = jwt.encode({'u_id':u_id, 'session_id': session_id}, SECRET, algorithm='HS256').decode('utf-8')
 
     return encoded_jwt
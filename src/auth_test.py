@@ -5,8 +5,8 @@ import jwt
 from data import data
 from auth import auth_login, auth_logout, auth_register
 from auth import generate_token, auth_passwordreset_reset, auth_passwordreset_request
-from error import InputError
-from other import clear
+from error import InputError, AccessError
+from other import clear, authenticate_token
 
 
 ######################## Tests focused on auth_logout #################################
@@ -31,6 +31,26 @@ def test_auth_logout_valid_token():
     secondAttempt = auth_logout(registered['token']) # Should now be invalid
     assert not secondAttempt['is_success']
 
+# Logging out one session should leave the user's other sessions valid
+def test_auth_logout_one_of_many_sessions():
+    clear()
+    registered = auth_register('test@test.com', 'password', 'firstName', 'lastName')
+    login = auth_login('test@test.com', 'password')
+    assert login['token'] != registered['token']
+
+    assert auth_logout(registered['token'])['is_success']
+    assert authenticate_token(login['token']) == registered['u_id']
+    with pytest.raises(AccessError):
+        authenticate_token(registered['token'])
+
+# Whitebox test that a session records its user and when it was last used
+def test_auth_login_session_record_whitebox():
+    clear()
+    registered = auth_register('test@test.com', 'password', 'firstName', 'lastName')
+    session = data.find_session(registered['token'])
+    assert session.u_id == registered['u_id']
+    assert session.last_seen >= session.issued_at
+
 
 ######################## Tests focused on auth_login #################################
 
@@ -0,0 +1,101 @@
+""" Feed of every change made to the store, for replicas and incremental backups
+
+Once data.feed is open, data.record hands it every change, the same
+records the write-ahead log and the database are given. Each record gets
+the next sequence number (seq) and is encoded as JSON straight away, like
+a write-ahead log record, so later changes to the store can't alter it. A
+record read back is a list [seq, kind, values...], the same shape as
+wal.read_log returns.
+
+Readers pull the records after the last seq they have seen, so keeping a
+copy up to date costs as much as the changes made since, not the size of
+the store. The feed keeps the last FEED_MAX_RECORDS records. A reader that
+falls further behind than that gets a ValueError, and has to start again
+from a full copy, such as a snapshot.
+
+replica applies the feed to anything with an apply(entry) method taking
+one record, such as a sqlite_store: a second store in the same process,
+whose file is a backup kept up to date record by record.
+
+Records hold everything the store does, session tokens and password hashes
+included, so they are only handed to replicas in this process. Nothing
+opens the feed by default, as encoding every change costs time and memory
+when nobody reads it. Open it together with the replica following it:
+    data.feed = change_feed()
+    follower = replica(data.feed, sqlite_store(path))
+"""
+import json
+import threading
+from collections import deque
+from itertools import islice
+
+# The most records a change_feed keeps for readers that are behind
+FEED_MAX_RECORDS = 100000
+
+class change_feed:
+    def __init__(self, last_seq=0, max_records=FEED_MAX_RECORDS):
+        self.last_seq = last_seq
+        self.records = deque(maxlen=max_records)
+        # append is called with data.lock held but readers need not hold it
+        self.lock = threading.Lock()
+
+    def append(self, entry):
+        """
+        Adds a record to the feed
+
+        Parameters:
+            entry (tuple): the kind of change followed by its values
+
+        Returns:
+            seq (int): the record's sequence number
+        """
+        with self.lock:
+            self.last_seq += 1
+            self.records.append(json.dumps([self.last_seq] + list(entry)))
+            return self.last_seq
+
+    def read(self, after_seq=0, limit=None):
+        """
+        The records after after_seq, oldest first
+
+        Parameters:
+            after_seq (int): the seq of the last record the reader has
+            limit (int): the most records to return, or None for all of them
+
+        Returns:
+            records (list): lists of [seq, kind, values...]
+        """
+        with self.lock:
+            first_seq = self.last_seq - len(self.records) + 1
+            if after_seq < first_seq - 1:
+                raise ValueError('records after ' + str(after_seq) + ' are no longer kept')
+            if after_seq > self.last_seq:
+                raise ValueError('no record ' + str(after_seq) + ' has been made yet')
+            start = after_seq - first_seq + 1
+            stop = len(self.records) if limit is None else min(start + limit, len(self.records))
+            lines = list(islice(self.records, start, stop))
+        return [json.loads(line) for line in lines]
+
+class replica:
+    """ Keeps target up to date with a change_feed """
+    def __init__(self, feed, target, last_seq=0):
+        self.feed = feed
+        self.target = target
+        # The seq of the last record applied to target
+        self.last_seq = last_seq
+
+    def pull(self, limit=None):
+        """
+        Applies the records made since the last pull to target
+
+        Parameters:
+            limit (int): the most records to apply, or None for all of them
+
+        Returns:
+            applied (int): the number of records applied
+        """
+        records = self.feed.read(self.last_seq, limit)
+        for record in records:
+            self.target.apply(record[1:])
+            self.last_seq = record[0]
+        return len(records)
@@ -0,0 +1,93 @@
+""" Tests for change_feed.py """
+import pytest
+from data import data
+from auth import auth_register
+from channel import channel_messages, channel_details
+from channels import channels_create, channels_list
+from message import message_send, message_edit, message_remove, message_react, message_pin
+from user import user_profile_sethandle
+from other import clear, search
+from sqlite_store import sqlite_store
+from change_feed import change_feed, replica
+
+@pytest.fixture
+def feed():
+    clear()
+    data.feed = change_feed()
+    yield data.feed
+    data.feed = None
+    clear()
+
+def store_state(user, channel_id):
+    return {
+        'messages': channel_messages(user['token'], channel_id, 0),
+        'details': channel_details(user['token'], channel_id),
+        'channels': channels_list(user['token']),
+        'search': search(user['token'], "message")
+    }
+
+def load_replica(database):
+    """ Swaps the store for the replica's copy of it """
+    data.feed = None
+    clear()
+    database.load()
+
+def test_feed_numbers_records(feed):
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    channel_id = channels_create(user['token'], "channel", True)['channel_id']
+    message_send(user['token'], channel_id, "message")
+    records = feed.read()
+    assert [record[0] for record in records] == list(range(1, feed.last_seq + 1))
+    assert records[-1][1:5] == ['message', channel_id, 0, user['u_id']]
+    assert feed.read(feed.last_seq) == []
+    assert feed.read(1, limit=2) == records[1:3]
+
+def test_feed_records_do_not_change(feed):
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    channel_id = channels_create(user['token'], "channel", True)['channel_id']
+    message_send(user['token'], channel_id, "message")
+    message_react(user['token'], 0, 1)
+    # The store changes react dictionaries in place after recording them
+    data.find_message(0)[1].reacts[0]['u_ids'].append(99)
+    assert feed.read(feed.last_seq - 1) == [[feed.last_seq, 'message_state', 0, False, [
+        {'react_id': 1, 'u_ids': [user['u_id']], 'is_this_user_reacted': True}
+    ]]]
+
+def test_feed_gap(feed):
+    data.feed = change_feed(last_seq=10, max_records=3)
+    for _ in range(5):
+        auth_register("test@test.com", "password", "firstName", "lastName")
+        clear()
+    assert data.feed.last_seq > 13
+    with pytest.raises(ValueError):
+        data.feed.read(10)
+    with pytest.raises(ValueError):
+        data.feed.read(data.feed.last_seq + 1)
+    assert len(data.feed.read(data.feed.last_seq - 3)) == 3
+
+def test_replica_follows_store(feed, tmp_path):
+    database = sqlite_store(str(tmp_path / 'replica.sqlite'))
+    follower = replica(feed, database)
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    user2 = auth_register("test2@test.com", "password", "secondName", "lastName")
+    channel_id = channels_create(user['token'], "channel", True)['channel_id']
+    for i in range(20):
+        message_send(user['token'], channel_id, "message " + str(i))
+    while follower.pull(limit=7):
+        pass
+    assert follower.last_seq == feed.last_seq
+
+    # Later pulls only apply what changed since
+    message_edit(user['token'], 2, "edited message")
+    message_remove(user['token'], 3)
+    message_react(user['token'], 4, 1)
+    message_pin(user['token'], 5)
+    user_profile_sethandle(user2['token'], "newhandle")
+    assert follower.pull() == 5
+    assert follower.pull() == 0
+    before = store_state(user, channel_id)
+
+    load_replica(database)
+    database.close()
+    assert store_state(user, channel_id) == before
+    assert data.find_user_by_handle("newhandle") is not None
@@ -1,5 +1,5 @@
 """ Functions used for individual channels """
-from data import data
+from storage import store
 from other import authenticate_token
 from other import valid_channel_id, valid_user_id
 from error import InputError, AccessError
@@ -117,38 +117,177 @@ def channel_messages(token, channel_id, start):
 
     # Check that start is not greater
     # than the total number of messages in the channel and not negative
-    msg_count = channel.num_messages()
+    msg_count = store.messages.count(channel)
     if (start > msg_count or start < 0):
         raise InputError("invalid start")
 
     # Initialize the desired return data
     ch_messages = {}
-    ch_messages['messages'] = []
 
+    # Work out the positions, counting from the oldest message, of the
+    # first and last messages to load
     msg_load = msg_count - start
     if msg_count == 0:  # No messages to load
+        first, last = 0, -1
         end = -1
     elif start == msg_count: # Only loads a single message if start is equal to message_count
-        msg = channel.channel_messages[msg_count - 1].message_details()
-        ch_messages['messages'].append(msg)
+        first, last = msg_count - 1, msg_count - 1
         end = -1
     elif msg_load <= 50:  # Loads all the messages in the channel if there are less than 50 messages to load
-        for i in range(msg_load, start, -1):
-            msg = channel.channel_messages[i - 1].message_details()
-            ch_messages['messages'].append(msg)
+        first, last = start, msg_load - 1
         end = -1
     else:   # Only loads the first 50 messages if there are more than 50 messages in the channel
-        for i in range(start + 50, start, -1):
-            msg = channel.channel_messages[i - 1].message_details()
-            ch_messages['messages'].append(msg)
+        first, last = start, start + 49
         end = start + 50
 
+    # The messages are returned newest first
+    ch_messages['messages'] = store.messages.page(channel, first, last)
+
     # Updates the start and end value which needs to be returned
     ch_messages['start'] = start
     ch_messages['end'] = end
 
     return ch_messages
 
+def channel_messages_cursor(token, channel_id, before_message_id=None, after_message_id=None, limit=50):
+    """
+    Returns a page of messages next to a cursor message, newest first.
+    Unlike channel_messages, pages do not move when messages are removed.
+
+    Parameters:
+        token (str): a unique token (to determine authorisation)
+        channel_id(int): a unique id for such channel
+        before_message_id (int): load the messages sent before this message, or
+                                 the newest messages if neither cursor is given
+        after_message_id (int): load the messages sent after this message
+        limit (int): the maximum number of messages to load (1 to 50)
+
+    Returns:
+        {
+            messages (list): the loaded message dictionaries, newest first
+            end (int): the message_id to pass as the same cursor to load the
+                       next page, or -1 if there are no more messages that way
+        }
+    """
+    # Check that token is valid and gets it index(u_id)
+    user_id = authenticate_token(token)
+    user = valid_user_id(user_id)
+
+    # Check that channel_id is valid
+    channel = valid_channel_id(channel_id)
+
+    # Check that user is part of the desired channel
+    if not channel.existing_member(user):
+        raise AccessError(description = "User not in desired channel.")
+
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1 or limit > 50:
+        raise InputError("invalid limit")
+    if before_message_id is not None and after_message_id is not None:
+        raise InputError("only one of before_message_id and after_message_id can be given")
+
+    if after_message_id is not None:
+        page, has_more = channel.messages_after(cursor_seq(channel, after_message_id), limit)
+        end = page[-1].message_id if has_more else -1
+    else:
+        if before_message_id is None:
+            seq = channel.next_seq
+        else:
+            seq = cursor_seq(channel, before_message_id)
+        page, has_more = channel.messages_before(seq, limit)
+        end = page[0].message_id if has_more else -1
+
+    return {
+        'messages': [msg.message_details() for msg in reversed(page)],
+        'end': end
+    }
+
+def cursor_seq(channel, message_id):
+    """
+    Finds the position in the channel of the message used as a cursor,
+    which may since have been removed
+
+    Parameters:
+        channel (channel): the channel being paged through
+        message_id (int): the cursor message
+
+    Returns:
+        seq (int): the sequence number of the message in the channel
+    """
+    if not isinstance(message_id, int) or isinstance(message_id, bool):
+        raise InputError("message_id must be integer")
+    found = store.messages.find(message_id)
+    if found is not None and found[0] is channel:
+        return found[1].seq
+    if message_id in channel.removed_seqs:
+        return channel.removed_seqs[message_id]
+    raise InputError("invalid message_id")
+
+def channel_pins(token, channel_id):
+    """
+    Returns the pinned messages of a channel, newest first
+
+    Parameters:
+        token (str): a unique token (to determine authorisation)
+        channel_id(int): a unique id for such channel
+
+    Returns:
+        {
+            messages (list): the pinned message dictionaries, newest first
+        }
+    """
+    # Check that token is valid and gets it index(u_id)
+    user_id = authenticate_token(token)
+    user = valid_user_id(user_id)
+
+    # Check that channel_id is valid
+    channel = valid_channel_id(channel_id)
+
+    # Check that user is part of the desired channel
+    if not channel.existing_member(user):
+        raise AccessError(description = "User not in desired channel.")
+
+    return {
+        'messages': store.messages.pinned(channel)
+    }
+
+def channel_messages_between(token, channel_id, since=None, until=None, limit=50):
+    """
+    Returns the newest messages of a channel sent in a range of time, newest first
+
+    Parameters:
+        token (str): a unique token (to determine authorisation)
+        channel_id(int): a unique id for such channel
+        since (UNIX timestamp): ignore messages sent before this time, if given
+        until (UNIX timestamp): ignore messages sent after this time, if given
+        limit (int): the maximum number of messages to load (1 to 50)
+
+    Returns:
+        {
+            messages (list): the loaded message dictionaries, newest first
+        }
+    """
+    # Check that token is valid and gets it index(u_id)
+    user_id = authenticate_token(token)
+    user = valid_user_id(user_id)
+
+    # Check that channel_id is valid
+    channel = valid_channel_id(channel_id)
+
+    # Check that user is part of the desired channel
+    if not channel.existing_member(user):
+        raise AccessError(description = "User not in desired channel.")
+
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1 or limit > 50:
+        raise InputError("invalid limit")
+    for bound in (since, until):
+        if bound is not None and (not isinstance(bound, int) or isinstance(bound, bool)):
+            raise InputError("since and until must be integers")
+
+    return {
+        'messages': store.messages.between(channel, since, until, limit)
+    }
+
+
 
 def channel_leave(token, channel_id):
     """
@@ -177,7 +316,7 @@ def channel_leave(token, channel_id):
     channel.remove_member(user)
 
     # Check if user is owner and remove from owner_members if TRUE
-    if user.u_id in [user['u_id'] for user in channel.channel_details()['owner_members']]:
+    if channel.is_owner(user.u_id):
         channel.remove_owner(user)
 
     return {
@@ -243,7 +382,7 @@ def channel_addowner(token, channel_id, u_id):
     channel = valid_channel_id(channel_id)
     
     # Check that the caller is a member and an owner
-    if caller.u_id not in [user['u_id'] for user in channel.channel_details()['owner_members']]:
+    if not channel.is_owner(caller.u_id):
         raise AccessError(description = "Caller is not an owner / member")
 
     # Check that the target is a member (If global owner, make member first)
@@ -254,7 +393,7 @@ def channel_addowner(token, channel_id, u_id):
             raise InputError(description = "Target is not a member")
 
     # Check that not targeted at an owner
-    if target.u_id in [user['u_id'] for user in channel.channel_details()['owner_members']]:
+    if channel.is_owner(target.u_id):
         raise InputError(description = "Target is already an owner")
 
     # If reached, here then successful
@@ -290,9 +429,9 @@ def channel_removeowner(token, channel_id, u_id):
         raise AccessError(description = "Caller not in channel")
 
     # Check that access is from an owner and targeted at an owner
-    if caller.u_id not in [user['u_id'] for user in channel.channel_details()['owner_members']]:
+    if not channel.is_owner(caller.u_id):
         raise AccessError(description = "Caller is not an owner")
-    if target.u_id not in [user['u_id'] for user in channel.channel_details()['owner_members']]:
+    if not channel.is_owner(target.u_id):
         raise InputError(description = "Target is not an owner")
 
     # Only a global owner can remove a global owner
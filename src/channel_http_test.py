@@ -324,6 +324,33 @@ def test_channel_messages_fail(url, user_input, user4_input, channel_input):
     r = requests.get(f'{url}channel/messages', params = input_data)
     assert r.status_code == 400
 
+# cursor mode of channel_messages, used when a cursor or limit is given
+def test_channel_messages_cursor_success(url, user_input, channel_input1):
+    requests.delete(f'{url}clear')
+    user = requests.post(f'{url}auth/register', json = user_input).json()
+
+    channel_input1.update({"token": user['token']})
+    channel = requests.post(f'{url}channels/create', json = channel_input1).json()
+    for message in ["first", "second", "third"]:
+        requests.post(f'{url}message/send', json = {
+            "token": user['token'],
+            "channel_id": channel['channel_id'],
+            "message": message
+        })
+
+    input_data = {
+        "token": user['token'],
+        "channel_id": channel['channel_id'],
+        "limit": 2
+    }
+    page = requests.get(f'{url}channel/messages', params = input_data).json()
+    assert [msg['message'] for msg in page['messages']] == ["third", "second"]
+
+    input_data.update({"before_message_id": page['end']})
+    page = requests.get(f'{url}channel/messages', params = input_data).json()
+    assert [msg['message'] for msg in page['messages']] == ["first"]
+    assert page['end'] == -1
+
 ######################## One large test for channel file #################################
 def test_channel_full(url, user_input, user3_input, user4_input, channel_input):
     requests.delete(f'{url}clear')
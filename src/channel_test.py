@@ -2,10 +2,11 @@
 import pytest
 from other import clear
 from auth import auth_register
-from channel import channel_invite, channel_details, channel_messages
+from channel import channel_invite, channel_details, channel_messages, channel_messages_cursor
 from channel import channel_leave, channel_join, channel_addowner, channel_removeowner
+from channel import channel_pins, channel_messages_between
 from channels import channels_create, channels_list, channels_listall
-from message import message_send
+from message import message_send, message_remove, message_pin, message_react, message_unreact
 from error import InputError, AccessError
 from data import data
 
@@ -530,6 +531,155 @@ def test_channel_messages_start_equal_message_count():
     assert message['messages'][0]['message_id'] == 49
     assert message['messages'][0]['message'] == 'Oof'
 
+############################## Tests for channel_messages_cursor ###################################
+def test_channel_messages_cursor_pages():
+    '''
+    channel_messages_cursor should walk back through history a page at a time
+    '''
+    clear()
+    usr_leony = auth_register('validemail1@outlook.com', 'BlueDaisy99', 'Leony', 'Mint')
+    channel_private = channels_create(usr_leony['token'], "Testing_private", False)
+    for sent_msg in range(70):
+        message_send(usr_leony['token'], channel_private['channel_id'], str(sent_msg))
+
+    page = channel_messages_cursor(usr_leony['token'], channel_private['channel_id'])
+    assert len(page['messages']) == 50
+    assert page['messages'][0]['message_id'] == 69
+    assert page['messages'][49]['message_id'] == 20
+    assert page['end'] == 20
+
+    page = channel_messages_cursor(usr_leony['token'], channel_private['channel_id'],
+                                   before_message_id=page['end'])
+    assert [msg['message_id'] for msg in page['messages']] == list(range(19, -1, -1))
+    assert page['end'] == -1
+
+    page = channel_messages_cursor(usr_leony['token'], channel_private['channel_id'],
+                                   after_message_id=60, limit=5)
+    assert [msg['message_id'] for msg in page['messages']] == [65, 64, 63, 62, 61]
+    assert page['end'] == 65
+
+def test_channel_messages_cursor_stable_after_remove():
+    '''
+    Removing messages, including the cursor message, should not shift later pages
+    '''
+    clear()
+    usr_leony = auth_register('validemail1@outlook.com', 'BlueDaisy99', 'Leony', 'Mint')
+    channel_private = channels_create(usr_leony['token'], "Testing_private", False)
+    for sent_msg in range(10):
+        message_send(usr_leony['token'], channel_private['channel_id'], str(sent_msg))
+
+    page = channel_messages_cursor(usr_leony['token'], channel_private['channel_id'], limit=3)
+    assert page['end'] == 7
+    message_remove(usr_leony['token'], 7)
+    message_remove(usr_leony['token'], 9)
+
+    page = channel_messages_cursor(usr_leony['token'], channel_private['channel_id'],
+                                   before_message_id=page['end'], limit=3)
+    assert [msg['message_id'] for msg in page['messages']] == [6, 5, 4]
+
+def test_channel_messages_cursor_after_react():
+    '''
+    A message that is reacted to and unreacted should still page by cursor in the same place
+    '''
+    clear()
+    usr_leony = auth_register('validemail1@outlook.com', 'BlueDaisy99', 'Leony', 'Mint')
+    channel_private = channels_create(usr_leony['token'], "Testing_private", False)
+    msg_ids = [message_send(usr_leony['token'], channel_private['channel_id'], str(sent_msg))['message_id']
+               for sent_msg in range(3)]
+
+    message_react(usr_leony['token'], msg_ids[1], 1)
+    message_unreact(usr_leony['token'], msg_ids[1], 1)
+
+    page = channel_messages_cursor(usr_leony['token'], channel_private['channel_id'],
+                                   before_message_id=msg_ids[2])
+    assert [msg['message_id'] for msg in page['messages']] == [msg_ids[1], msg_ids[0]]
+    page = channel_messages_cursor(usr_leony['token'], channel_private['channel_id'],
+                                   after_message_id=msg_ids[1])
+    assert [msg['message_id'] for msg in page['messages']] == [msg_ids[2]]
+
+def test_channel_messages_cursor_invalid_inputs():
+    clear()
+    usr_leony = auth_register('validemail1@outlook.com', 'BlueDaisy99', 'Leony', 'Mint')
+    usr_hayden = auth_register('validemail@gmail.com', 'RedRocket88', 'Hayden', 'Everest')
+    channel_1 = channels_create(usr_leony['token'], "Testing_1", False)
+    channel_2 = channels_create(usr_leony['token'], "Testing_2", False)
+    msg = message_send(usr_leony['token'], channel_2['channel_id'], 'Oof')
+
+    with pytest.raises(InputError):
+        channel_messages_cursor(usr_leony['token'], channel_1['channel_id'], limit=0)
+    with pytest.raises(InputError):
+        channel_messages_cursor(usr_leony['token'], channel_1['channel_id'], limit=51)
+    with pytest.raises(InputError):
+        channel_messages_cursor(usr_leony['token'], channel_1['channel_id'],
+                                before_message_id=msg['message_id'])
+    with pytest.raises(InputError):
+        channel_messages_cursor(usr_leony['token'], channel_2['channel_id'],
+                                before_message_id=msg['message_id'], after_message_id=msg['message_id'])
+    with pytest.raises(AccessError):
+        channel_messages_cursor(usr_hayden['token'], channel_2['channel_id'])
+
+############################## Tests for channel_pins and channel_messages_between ###################################
+def test_channel_pins():
+    '''
+    channel_pins should return the pinned messages still in the channel, newest first
+    '''
+    clear()
+    usr_leony = auth_register('validemail1@outlook.com', 'BlueDaisy99', 'Leony', 'Mint')
+    channel_private = channels_create(usr_leony['token'], "Testing_private", False)
+    for sent_msg in range(5):
+        message_send(usr_leony['token'], channel_private['channel_id'], str(sent_msg))
+    assert channel_pins(usr_leony['token'], channel_private['channel_id']) == {'messages': []}
+
+    for msg_id in (1, 3, 4):
+        message_pin(usr_leony['token'], msg_id)
+    message_remove(usr_leony['token'], 4)
+    pins = channel_pins(usr_leony['token'], channel_private['channel_id'])
+    assert [msg['message_id'] for msg in pins['messages']] == [3, 1]
+    assert all(msg['is_pinned'] for msg in pins['messages'])
+
+def test_channel_messages_between():
+    '''
+    channel_messages_between should return the newest messages sent in the range
+    '''
+    clear()
+    usr_leony = auth_register('validemail1@outlook.com', 'BlueDaisy99', 'Leony', 'Mint')
+    channel_private = channels_create(usr_leony['token'], "Testing_private", False)
+    for sent_msg in range(10):
+        message_send(usr_leony['token'], channel_private['channel_id'], str(sent_msg))
+    history = data.channels[channel_private['channel_id']].channel_messages
+    for position in range(10):
+        history[position].time_created = 100 + position
+    message_remove(usr_leony['token'], 5)
+
+    def between(**bounds):
+        page = channel_messages_between(usr_leony['token'], channel_private['channel_id'], **bounds)
+        return [msg['message_id'] for msg in page['messages']]
+    assert between(since=102, until=107) == [7, 6, 4, 3, 2]
+    assert between(since=102, until=107, limit=2) == [7, 6]
+    assert between(since=108) == [9, 8]
+    assert between(until=101) == [1, 0]
+    assert between() == [9, 8, 7, 6, 4, 3, 2, 1, 0]
+    assert between(since=200) == []
+
+def test_channel_pins_and_between_invalid_inputs():
+    clear()
+    usr_leony = auth_register('validemail1@outlook.com', 'BlueDaisy99', 'Leony', 'Mint')
+    usr_hayden = auth_register('validemail@gmail.com', 'RedRocket88', 'Hayden', 'Everest')
+    channel_1 = channels_create(usr_leony['token'], "Testing_1", False)
+
+    with pytest.raises(InputError):
+        channel_messages_between(usr_leony['token'], channel_1['channel_id'], limit=0)
+    with pytest.raises(InputError):
+        channel_messages_between(usr_leony['token'], channel_1['channel_id'], limit=51)
+    with pytest.raises(InputError):
+        channel_messages_between(usr_leony['token'], channel_1['channel_id'], since='yesterday')
+    with pytest.raises(InputError):
+        channel_pins(usr_leony['token'], 1000)
+    with pytest.raises(AccessError):
+        channel_pins(usr_hayden['token'], channel_1['channel_id'])
+    with pytest.raises(AccessError):
+        channel_messages_between(usr_hayden['token'], channel_1['channel_id'])
+
 ############################## Tests for channel_leave ###################################
 # Raises InputError as given channel_id is not a valid channel
 def test_channel_leave_invalid_type_channel_id():
@@ -994,3 +1144,36 @@ def test_channel_removeowner_target_not_owner():
     # user1 tries to removeowner on user2, but they're not an owner
     with pytest.raises(InputError):
         channel_removeowner(user1['token'], channel['channel_id'], user2['u_id'])
+
+####################### Whitebox tests for channel membership #####################
+def test_channel_is_member_is_owner_whitebox():
+    clear()
+    user1 = auth_register('test@test.com', 'password', 'firstName', 'lastName')
+    user2 = auth_register('test2@test.com', 'password2', 'firstName2', 'lastName2')
+    channel = channels_create(user1['token'], 'channelName', True)
+    channel_join(user2['token'], channel['channel_id'])
+    channel_addowner(user1['token'], channel['channel_id'], user2['u_id'])
+
+    ch = data.channels[channel['channel_id']]
+    assert ch.is_member(user2['u_id'])
+    assert ch.is_owner(user2['u_id'])
+
+    channel_leave(user2['token'], channel['channel_id'])
+    assert not ch.is_member(user2['u_id'])
+    assert not ch.is_owner(user2['u_id'])
+    assert ch.is_owner(user1['u_id'])
+
+def test_channel_details_keeps_join_order_whitebox():
+    clear()
+    user1 = auth_register('test@test.com', 'password', 'firstName', 'lastName')
+    user2 = auth_register('test2@test.com', 'password2', 'firstName2', 'lastName2')
+    user3 = auth_register('test3@test.com', 'password3', 'firstName3', 'lastName3')
+    channel = channels_create(user1['token'], 'channelName', True)
+    channel_join(user3['token'], channel['channel_id'])
+    channel_join(user2['token'], channel['channel_id'])
+    channel_leave(user3['token'], channel['channel_id'])
+    channel_join(user3['token'], channel['channel_id'])
+
+    details = channel_details(user1['token'], channel['channel_id'])
+    assert [member['u_id'] for member in details['all_members']] == \
+        [user1['u_id'], user2['u_id'], user3['u_id']]
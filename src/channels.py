@@ -1,5 +1,6 @@
 """ File for functions concering channels"""
-from data import data, channel
+from data import channel
+from storage import store
 from error import InputError, AccessError
 from other import authenticate_token
 
@@ -27,18 +28,11 @@ def channels_list(token):
 
     # check that token is authorised
     token_index = authenticate_token(token)
-    user_id = data.users[token_index].u_id
-
-    channels_list_array = []
-    # if user is memember add channel to list
-    for channel in data.channels:
-        for user in channel.all_members:
-            if user.u_id == user_id:
-                channels_list_array.append({'channel_id': channel.channel_id, 'name': channel.name})
-                break
+    user_id = store.users.find(token_index).u_id
 
+    # every channel the user is a member of
     return {
-        'channels': channels_list_array
+        'channels': store.channels.listing(user_id)
     }
 
 def channels_listall(token):
@@ -66,7 +60,7 @@ def channels_listall(token):
     authenticate_token(token)
     
     return_list = []
-    for channel in data.channels:
+    for channel in store.channels.all():
         return_list.append({'channel_id': channel.channel_id, 'name': channel.name})
 
     return {
@@ -113,13 +107,13 @@ def channels_create(token, name, is_public):
     new_channel = channel(name, is_public)
 
     #  get user_id, first_name,last_name from token
-    creator = data.users[u_id]
+    creator = store.users.find(u_id)
+
+    store.channels.add(new_channel)
 
     new_channel.new_owner(creator)
     new_channel.new_member(creator)
 
-    data.new_channel(new_channel)
-
     return {
         'channel_id' : new_channel.channel_id
     }
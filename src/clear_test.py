@@ -7,13 +7,14 @@ def test_resets_user_fields():
 
     assert data.users[0].u_id == 0
 
-    data.tokens = ['token1', 'token2', 'token3', 'token4']
+    data.new_session('token1', 0)
+    data.new_session('token2', 0)
 
 
     clear()
     assert data.num_users() == 0
     assert data.users == []
-    assert data.tokens == []
+    assert data.sessions == {}
 
 def test_resets_channel_fields():
     data.channels.append(channel("channel1", True))
@@ -1,9 +1,20 @@
 import hashlib
 import random
 import string
+import threading
 import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from contextlib import contextmanager
+from operator import attrgetter
+from search_index import search_index
+from scheduler import scheduler
 
 class user:
+    __slots__ = ('u_id', 'email', 'password', 'name_first', 'name_last', 'secret_key',
+                 'profile_img_url', 'permission_id', 'handle_str')
+
     def __init__(self, email, password, name_first, name_last):
         self.u_id = data.num_users()
         self.email = email
@@ -22,9 +33,7 @@ class user:
         if len(handle_str) > 20:
             handle_str = handle_str[:20]
 
-        check_list_handles = [user.handle_str for user in data.users]
-
-        while handle_str in check_list_handles:
+        while data.find_user_by_handle(handle_str) is not None:
             handle_add = ''.join(random.choice(string.digits) for i in range(3))
             if len(handle_str) < 18:
                 handle_str += handle_add
@@ -53,82 +62,618 @@ class user:
     def update_profile_img_url(self, new_url):
         self.profile_img_url = new_url
 
+class session:
+    def __init__(self, u_id):
+        self.u_id = u_id
+        self.issued_at = int(time.time())
+        self.last_seen = self.issued_at
+
+    def touch(self):
+        self.last_seen = int(time.time())
+
+class token_cache:
+    """ Bounded LRU cache of already verified tokens to their u_id """
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, token):
+        with self.lock:
+            u_id = self.entries.get(token)
+            if u_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(token)
+            return u_id
+
+    def add(self, token, u_id):
+        with self.lock:
+            self.entries[token] = u_id
+            self.entries.move_to_end(token)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def remove(self, token):
+        with self.lock:
+            self.entries.pop(token, None)
+
+    def remove_user(self, u_id):
+        with self.lock:
+            for token in [token for token, cached in self.entries.items() if cached == u_id]:
+                del self.entries[token]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def cache_details(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries)
+        }
+
+class search_cache:
+    """
+    Bounded LRU cache of the message_ids a search returned. Each entry keeps
+    the versions it was computed at, the user's membership version and the
+    write version of each of their channels, and only counts as a hit while
+    they all still match
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, versions):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != versions:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def add(self, key, versions, message_ids):
+        with self.lock:
+            self.entries[key] = (versions, message_ids)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def cache_details(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries)
+        }
+
+class store_lock:
+    """
+    Lets any number of readers or one writer use the store at a time. Taking
+    it with acquire or a with block is the writer's side, which the thread
+    holding it may take again like an RLock. reading() is the readers' side;
+    a waiting writer holds back new readers, so readers must not nest
+    """
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None
+        self.depth = 0
+        self.waiting_writers = 0
+
+    def acquire(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer != me:
+                self.waiting_writers += 1
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+                self.waiting_writers -= 1
+                self.writer = me
+            self.depth += 1
+
+    def release(self):
+        with self.condition:
+            self.depth -= 1
+            if not self.depth:
+                self.writer = None
+                self.condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def acquire_read(self):
+        with self.condition:
+            # The writer can read what it already holds
+            if self.writer == threading.get_ident():
+                self.depth += 1
+                return
+            while self.writer is not None or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.condition:
+            if self.writer == threading.get_ident():
+                self.depth -= 1
+                return
+            self.readers -= 1
+            if not self.readers:
+                self.condition.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield self
+        finally:
+            self.release_read()
+
 class data_class:
     def __init__(self):
+        # Held by anything that must see or change the store all at once.
+        # Requests that change the store, scheduled sends and loading take
+        # the writer's side; reading requests and snapshot captures share it
+        self.lock = store_lock()
         self.users = []
-        self.tokens = []
+        # Maps each active token to its session, a user may hold several
+        self.sessions = {}
+        self.session_index = 0
+        self.token_cache = token_cache()
+        # Container used for each new channel's channel_messages, see message_store
+        self.history_class = list
+        # concurrent.futures executor that other.search spreads unindexed
+        # scans across, or None to scan the channels one after another
+        self.search_executor = None
         self.channels = []
         self.message_index = 0
+        # Secondary indexes over users, kept in sync by new_user,
+        # update_email and update_handle
+        self.user_id_index = {}
+        self.email_index = {}
+        self.handle_index = {}
+        # Maps message_id to the (channel, message) pair holding it, for
+        # every live message but the archived ones, see find_message
+        self.message_id_index = {}
+        # Words of every live message, archived or not, by channel
+        self.search_index = search_index(self.channel_texts)
+        self.search_cache = search_cache()
+        # Maps u_id to the set of channel_ids the user is a member of
+        self.user_channel_index = {}
+        # Bumped whenever a user joins or leaves a channel
+        self.membership_versions = {}
+        # Runs message_sendlater and other timed work on one thread
+        self.scheduler = scheduler()
+        # Maps the message_id of each message waiting to be sent later to
+        # the (job_id, u_id) of its scheduler job
+        self.scheduled_messages = {}
+        # Every change is recorded here once server.py opens it, see wal.py
+        self.wal = None
+        # SQLite mirror every change is also written through to while
+        # sqlite_store.sqlite_engine is in use
+        self.database = None
+        # change_feed every change is also handed to while a replica follows it
+        self.feed = None
+        # message_archive holding the older messages of tiered channels, see archive.py
+        self.archive = None
 
     def num_users(self):
         return len(self.users)
 
+    def find_user(self, u_id):
+        return self.user_id_index.get(u_id)
+
+    def find_user_by_email(self, email):
+        return self.email_index.get(email.lower())
+
+    def find_user_by_handle(self, handle_str):
+        return self.handle_index.get(handle_str)
+
     def num_channels(self):
         return len(self.channels)
     
+    def record(self, *entry):
+        """ Adds a change to the write-ahead log, the database and the change feed, if open """
+        if self.wal is not None:
+            self.wal.append(entry)
+        if self.database is not None:
+            self.database.apply(entry)
+        if self.feed is not None:
+            self.feed.append(entry)
+
+    def record_user(self, user):
+        """ Records every field of a user, after any of them changes """
+        self.record('user', *(getattr(user, field) for field in user.__slots__))
+
+    def record_message_state(self, message):
+        """ Records the pin and reacts of a message, after either changes """
+        self.record('message_state', message.message_id, message.is_pinned, list(message.reacts))
+
     def new_user(self, user):
         self.users.append(user)
+        self.user_id_index[user.u_id] = user
+        self.email_index[user.email.lower()] = user
+        self.handle_index[user.handle_str] = user
+        self.record_user(user)
+
+    def update_email(self, user, email):
+        del self.email_index[user.email.lower()]
+        user.email = email
+        self.email_index[email.lower()] = user
+        self.record_user(user)
+
+    def update_handle(self, user, handle_str):
+        del self.handle_index[user.handle_str]
+        user.handle_str = handle_str
+        self.handle_index[handle_str] = user
+        self.record_user(user)
     
     def new_channel(self, channel):
         self.channels.append(channel)
+        self.record('channel', channel.channel_id, channel.name, channel.is_public)
+
+    def new_session(self, token, u_id):
+        self.sessions[token] = session(u_id)
+        self.record('session', token, u_id, self.session_index)
+
+    def find_session(self, token):
+        return self.sessions.get(token)
+
+    def end_session(self, token):
+        ended = self.sessions.pop(token, None) is not None
+        if ended:
+            self.record('end_session', token)
+        return ended
+
+    def next_message_id(self):
+        """ Hands out the next unused message_id """
+        message_id = self.message_index
+        self.message_index += 1
+        self.record('message_index', self.message_index)
+        return message_id
+
+    def schedule_message(self, message_id, job_id, u_id):
+        self.scheduled_messages[message_id] = (job_id, u_id)
+        self.record('scheduled', message_id, job_id, u_id)
+
+    def unschedule_message(self, message_id):
+        if self.scheduled_messages.pop(message_id, None) is not None:
+            self.record('unscheduled', message_id)
+
+    def find_user_channels(self, u_id):
+        channel_ids = sorted(self.user_channel_index.get(u_id, ()))
+        return [self.channels[channel_id] for channel_id in channel_ids]
+
+    def add_membership(self, u_id, channel_id):
+        self.user_channel_index.setdefault(u_id, set()).add(channel_id)
+        self.membership_versions[u_id] = self.membership_versions.get(u_id, 0) + 1
+
+    def remove_membership(self, u_id, channel_id):
+        self.user_channel_index[u_id].discard(channel_id)
+        self.membership_versions[u_id] = self.membership_versions.get(u_id, 0) + 1
+
+    def search_versions(self, u_id):
+        """ What a search by u_id depends on, for checking search_cache entries """
+        channel_versions = tuple(channel.version for channel in self.find_user_channels(u_id))
+        return (self.membership_versions.get(u_id, 0), channel_versions)
+
+    def new_message(self, channel, message):
+        stored = channel.new_message(message)
+        channel.version += 1
+        self.message_id_index[message.message_id] = (channel, stored)
+        self.search_index.add(channel.channel_id, message.message_id, message.message,
+                              message.time_created)
+        self.record('message', channel.channel_id, message.message_id, message.u_id,
+                    message.message, message.time_created, message.is_pinned,
+                    list(message.reacts), message.seq)
+
+    def find_message(self, message_id):
+        found = self.message_id_index.get(message_id)
+        if found is None and self.archive is not None:
+            found = self.archive.find(message_id)
+        return found
+
+    def remove_message(self, message_id):
+        channel, message = self.find_message(message_id)
+        self.message_id_index.pop(message_id, None)
+        self.search_index.remove(channel.channel_id, message_id, message.message,
+                                 message.time_created)
+        channel.remove_message(message)
+        channel.version += 1
+        self.record('remove_message', message_id)
+
+    def update_message(self, message_id, new_message):
+        channel, message = self.find_message(message_id)
+        self.search_index.update(channel.channel_id, message_id, message.message, new_message)
+        message.update_message(new_message)
+        channel.version += 1
+        self.record('edit', message_id, new_message)
+
+    def channel_texts(self, channel_id):
+        """ Yields what search_index.add_many takes for each live message of a channel kept in memory """
+        for message in self.channels[channel_id].channel_messages:
+            # Archived messages are searched in the archive instead
+            if not message.removed and message.message_id in self.message_id_index:
+                yield (channel_id, message.message_id, message.message, message.time_created)
+
+    def compact_messages(self, min_tombstones=1):
+        """
+        Rewrites the history of every channel holding at least min_tombstones
+        removed messages
+
+        Parameters:
+            min_tombstones (int): the fewest removed messages worth a rewrite
+
+        Returns:
+            compacted (int): the number of channels rewritten
+        """
+        compacted = 0
+        with self.lock:
+            for channel in self.channels:
+                if len(channel.tombstones) >= min_tombstones:
+                    channel.compact()
+                    compacted += 1
+        return compacted
+
+# The background pass only rewrites channels holding at least this many removed messages
+COMPACT_MIN_TOMBSTONES = 64
+# A channel remembers the seqs of at most this many removed messages, see cursor_seq
+REMOVED_SEQS_MAX = 1024
 
 class channel:
+    __slots__ = ('name', 'is_public', 'owners', 'members', 'channel_messages', 'channel_id',
+                 'next_seq', 'removed_seqs', 'tombstones', 'version', 'standup_end',
+                 'standup_buffer', 'hangman')
+
     def __init__(self, name, is_public):
         self.name = name
         self.is_public = is_public
-        self.owner_members = []
-        self.all_members = []
-        self.channel_messages = []
+        # Members keyed by u_id; dicts keep insertion order for channel_details
+        self.owners = {}
+        self.members = {}
+        self.channel_messages = data.history_class()
         self.channel_id = data.num_channels()
+        # Every message gets the next seq, so channel_messages is sorted by seq.
+        # Removed messages keep their seq here so they still work as cursors,
+        # until REMOVED_SEQS_MAX later removals push them out
+        self.next_seq = 0
+        self.removed_seqs = {}
+        # Positions in channel_messages of the removed messages, in order.
+        # They stay there, flagged, until compact()
+        self.tombstones = array('q')
+        # Bumped by every send, edit and remove, see search_cache
+        self.version = 0
         self.standup_end = None
-        self.standup_message = ""
+        self.standup_buffer = standup_buffer()
         self.hangman = hangman()
     
     def num_messages(self):
-        return len(self.channel_messages)
+        return len(self.channel_messages) - len(self.tombstones)
+
+    def live_position(self, index):
+        """ The position in channel_messages of the index-th live message, oldest first """
+        tombstones = self.tombstones
+        # tombstones[i] - i live messages come before the i-th removed one
+        return index + bisect_right(range(len(tombstones)), index,
+                                    key=lambda i: tombstones[i] - i)
+
+    def live_positions(self, first, last):
+        """ The positions in channel_messages of the live messages first to last, oldest first """
+        position = self.live_position(first)
+        tombstone = bisect_left(self.tombstones, position)
+        positions = []
+        while len(positions) <= last - first:
+            if tombstone < len(self.tombstones) and self.tombstones[tombstone] == position:
+                tombstone += 1
+            else:
+                positions.append(position)
+            position += 1
+        return positions
+
+    def compact(self):
+        """ Rewrites channel_messages without the removed messages """
+        history = type(self.channel_messages)()
+        for message in self.channel_messages:
+            if not message.removed:
+                history.append(message)
+                # Archived messages are found through data.archive instead
+                if message.message_id in data.message_id_index:
+                    data.message_id_index[message.message_id] = (self, history[-1])
+        self.channel_messages = history
+        self.tombstones = array('q')
     
     def channel_details(self):
         return {
             'name': self.name,
-            'owner_members': [user.member_details() for user in self.owner_members],
-            'all_members': [user.member_details() for user in self.all_members]
+            'owner_members': [user.member_details() for user in self.owners.values()],
+            'all_members': [user.member_details() for user in self.members.values()]
         }
     
+    @property
+    def owner_members(self):
+        return list(self.owners.values())
+
+    @property
+    def all_members(self):
+        return list(self.members.values())
+
+    def is_owner(self, u_id):
+        return u_id in self.owners
+
+    def is_member(self, u_id):
+        return u_id in self.members
+
     def new_owner(self, user):
-        self.owner_members.append(user)
+        self.owners[user.u_id] = user
+        data.record('owner', self.channel_id, user.u_id, True)
     
     def new_member(self, user):
-        self.all_members.append(user)
+        self.members[user.u_id] = user
+        data.add_membership(user.u_id, self.channel_id)
+        data.record('member', self.channel_id, user.u_id, True)
     
     def remove_owner(self, user):
-        self.owner_members.remove(user)
+        del self.owners[user.u_id]
+        data.record('owner', self.channel_id, user.u_id, False)
     def existing_member(self, user):
-        return user in self.all_members
+        return user.u_id in self.members
     def remove_member(self, user):
-        self.all_members.remove(user)
+        del self.members[user.u_id]
+        data.remove_membership(user.u_id, self.channel_id)
+        data.record('member', self.channel_id, user.u_id, False)
     def new_message(self, message):
+        message.seq = self.next_seq
+        self.next_seq += 1
         self.channel_messages.append(message)
-    def standup_message_add(self, handle, message):
-        self.standup_message = self.standup_message + handle + ": " + message + "\n"
+        return self.channel_messages[-1]
+    def remove_message(self, message):
+        self.removed_seqs[message.message_id] = message.seq
+        if len(self.removed_seqs) > REMOVED_SEQS_MAX:
+            del self.removed_seqs[next(iter(self.removed_seqs))]
+        message.removed = True
+        insort(self.tombstones,
+               bisect_left(self.channel_messages, message.seq, key=attrgetter('seq')))
+    def messages_before(self, seq, limit):
+        """ Up to limit messages older than seq, oldest first, and whether older ones remain """
+        history = self.channel_messages
+        position = bisect_left(history, seq, key=attrgetter('seq')) - 1
+        page = []
+        while position >= 0 and len(page) < limit:
+            if not history[position].removed:
+                page.append(history[position])
+            position -= 1
+        while position >= 0 and history[position].removed:
+            position -= 1
+        page.reverse()
+        return page, position >= 0
+    def messages_after(self, seq, limit):
+        """ Up to limit messages newer than seq, oldest first, and whether newer ones remain """
+        history = self.channel_messages
+        position = bisect_right(history, seq, key=attrgetter('seq'))
+        page = []
+        while position < len(history) and len(page) < limit:
+            if not history[position].removed:
+                page.append(history[position])
+            position += 1
+        while position < len(history) and history[position].removed:
+            position += 1
+        return page, position < len(history)
+    def standup_start(self, time_finish):
+        self.standup_end = time_finish
+        data.record('standup_start', self.channel_id, time_finish)
+    def standup_message_add(self, u_id, message):
+        added = self.standup_buffer.add(u_id, message)
+        if added:
+            data.record('standup_part', self.channel_id, u_id, message)
+        return added
     def standup_details(self):
         return {
         	'is_active': self.standup_end != None,
-        	'time_finish': self.standup_end,
-        	'message_queue': self.standup_message[:-1]
+        	'time_finish': self.standup_end
         }
     def standup_reset(self):
+        """ Ends the standup, returning the standup_buffer it collected """
+        finished = self.standup_buffer
         self.standup_end = None
-        self.standup_message = ""
+        self.standup_buffer = standup_buffer()
+        data.record('standup_reset', self.channel_id)
+        return finished
+    def record_hangman(self):
+        """ Records the state of the channel's hangman game, after it changes """
+        data.record('hangman', self.channel_id, self.hangman.mode, self.hangman.word,
+                    list(self.hangman.guesses))
+
+# Most characters in one message
+MESSAGE_MAX_LENGTH = 1000
+# Most characters of message text a channel collects in one standup
+STANDUP_MAX_SIZE = 100000
+
+class standup_buffer:
+    """
+    The messages sent during a standup, kept as (u_id, text) parts and only
+    joined into messages when the standup ends
+    """
+    __slots__ = ('parts', 'counts', 'size')
+
+    def __init__(self):
+        self.parts = []
+        # u_id -> number of parts that user has added
+        self.counts = {}
+        self.size = 0
 
+    def __len__(self):
+        return len(self.parts)
+
+    def add(self, u_id, text):
+        """ Adds a part, returns False without adding it if the buffer is full """
+        if self.size + len(text) > STANDUP_MAX_SIZE:
+            return False
+        self.parts.append((u_id, text))
+        self.counts[u_id] = self.counts.get(u_id, 0) + 1
+        self.size += len(text)
+        return True
+
+    def lines(self):
+        """ A "handle: text" line per part """
+        handles = {u_id: data.find_user(u_id).handle_str for u_id in self.counts}
+        return [handles[u_id] + ": " + text for u_id, text in self.parts]
+
+    def render(self):
+        """ The parts as one message """
+        return "\n".join(self.lines())
+
+    def render_messages(self, max_length=MESSAGE_MAX_LENGTH):
+        """
+        The parts as messages of at most max_length characters, breaking
+        between lines, and cutting up lines that are longer than that
+        """
+        messages = []
+        for line in self.lines():
+            for start in range(0, len(line), max_length):
+                piece = line[start:start + max_length]
+                if messages and len(messages[-1]) + 1 + len(piece) <= max_length:
+                    messages[-1] += "\n" + piece
+                else:
+                    messages.append(piece)
+        return messages
+
+
+# Shared by every message that has not been reacted to yet
+NO_REACTS = ()
 
 class message:
+    __slots__ = ('message_id', 'u_id', 'message', 'time_created', 'is_pinned', 'reacts', 'seq',
+                 'removed')
+
     def __init__(self, message, u_id, message_id):
         self.message_id = message_id
         self.u_id = u_id
         self.message = message
         self.time_created = int(time.time())
         self.is_pinned = False
-        self.reacts = []
+        self.reacts = NO_REACTS
+        self.seq = None
+        self.removed = False
     
     def message_details(self):
         return {
@@ -137,10 +682,18 @@ class message:
             'message': self.message,
             'time_created': self.time_created,
             'is_pinned': self.is_pinned,
-            'reacts': self.reacts
+            'reacts': list(self.reacts)
         }
     def update_message(self, new_message):
         self.message = new_message
+    def new_react(self, react):
+        if self.reacts is NO_REACTS:
+            self.reacts = []
+        self.reacts.append(react)
+    def remove_react(self, react_index):
+        self.reacts.pop(react_index)
+        if not self.reacts:
+            self.reacts = NO_REACTS
 
 class hangman:
     def __init__(self):
@@ -169,3 +722,18 @@ class hangman:
         }
 
 data = data_class()
+
+def start_compacting(interval):
+    """
+    Runs data.compact_messages every interval seconds on the scheduler
+    thread, for channels holding at least COMPACT_MIN_TOMBSTONES removed messages
+
+    Parameters:
+        interval (float): seconds between runs
+
+    Returns:
+        job_id (int): the recurring job, which clear() leaves queued
+    """
+    def run_compacting():
+        data.compact_messages(COMPACT_MIN_TOMBSTONES)
+    return data.scheduler.every(interval, run_compacting)
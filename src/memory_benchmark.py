@@ -0,0 +1,55 @@
+""" Reports the memory used per message and per user object in data.py
+
+Usage:
+    python3 src/memory_benchmark.py [num_messages] [num_users]
+"""
+import sys
+import tracemalloc
+from data import data, user, message
+from other import clear
+
+def bytes_per_object(make_object, count):
+    """
+    Measures the average number of bytes allocated per object
+
+    Parameters:
+        make_object (function): called with an index, returns the object to keep
+        count (int): how many objects to create
+
+    Returns:
+        bytes (float): traced memory growth divided by count
+    """
+    kept = []
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(count):
+        kept.append(make_object(i))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # Do not charge the list holding the objects to the objects themselves
+    return (after - before - sys.getsizeof(kept)) / count
+
+def make_message(i):
+    return message("message number " + str(i), i % 100, i)
+
+def make_user(i):
+    new_user = user('user' + str(i) + '@test.com', 'password', 'First' + str(i), 'Last')
+    data.new_user(new_user)
+    return new_user
+
+def run_benchmark(num_messages, num_users):
+    clear()
+    per_message = bytes_per_object(make_message, num_messages)
+    per_user = bytes_per_object(make_user, num_users)
+    clear()
+    return {
+        'bytes_per_message': per_message,
+        'bytes_per_user': per_user
+    }
+
+if __name__ == "__main__":
+    NUM_MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    NUM_USERS = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    results = run_benchmark(NUM_MESSAGES, NUM_USERS)
+    print(f"bytes per message: {results['bytes_per_message']:.1f} ({NUM_MESSAGES} messages)")
+    print(f"bytes per user:    {results['bytes_per_user']:.1f} ({NUM_USERS} users)")
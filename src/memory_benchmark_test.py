@@ -0,0 +1,20 @@
+""" Tests for memory_benchmark.py and the compact data objects it measures """
+import pytest
+from data import user, message, channel, NO_REACTS
+from memory_benchmark import run_benchmark
+from other import clear
+
+def test_data_objects_have_no_instance_dict():
+    clear()
+    assert not hasattr(user('test@test.com', 'password', 'Test', 'Test'), '__dict__')
+    assert not hasattr(message('hello', 0, 0), '__dict__')
+    assert not hasattr(channel('channel', True), '__dict__')
+
+def test_unreacted_messages_share_reacts():
+    assert message('hello', 0, 0).reacts is NO_REACTS
+    assert message('hello', 0, 0).message_details()['reacts'] == []
+
+def test_run_benchmark():
+    results = run_benchmark(100, 10)
+    assert results['bytes_per_message'] > 0
+    assert results['bytes_per_user'] > 0
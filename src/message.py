@@ -1,7 +1,7 @@
 import time
-from data import data, message
+from data import data, message, MESSAGE_MAX_LENGTH
+from storage import store
 from other import authenticate_token, valid_channel_id, valid_user_id
-import threading
 from error import InputError, AccessError
 import random
 from english_words import english_words_lower_alpha_set
@@ -19,37 +19,25 @@ def check_message_valid(message_id):
     Return:
         {
             is_message_valid (Bool): True means that the message_id exist in the data and vice versa
-            sent_msg (dict): a dictionary containing the characteristics of the message;
-                             the key values being message_id, u_id, message and time_created
-            msg_index (int): the index where the message_id can be found in a list of messages
+            sent_msg (message): the message object stored under message_id
+            channel (channel): the channel object where the message was found
             ch_index (int): the index of the channel (channel_id) where the message was found
         }
     """
-    # Initializes the required return data
-    is_message_valid = False
-    sent_msg = {}
-    ch_index = 0
-    # Search for the message_id in the channel
-    for channel in data.channels:
-        id_check = [message.message_id for message in channel.channel_messages]
-        # message id is in data
-        if message_id in id_check:
-            msg_index = id_check.index(message_id)
-            # Get the desired return data
-            sent_msg = channel.channel_messages[msg_index]
-            ch_index = data.channels.index(channel)
-            is_message_valid = True
+    # Look the message up in the global message_id index
+    found = store.messages.find(message_id)
 
     # Raise InputError if message does not exist in the data
-    if is_message_valid is False:
+    if found is None:
         raise InputError(description='Invalid message id')
 
     # Return the results
+    channel, sent_msg = found
     return {
-        'is_message_valid': is_message_valid,
+        'is_message_valid': True,
         'sent_msg': sent_msg,
-        'msg_index': msg_index,
-        'ch_index': ch_index
+        'channel': channel,
+        'ch_index': channel.channel_id
     }
 
 def check_message_access(user_id, msg_check):
@@ -63,14 +51,14 @@ def check_message_access(user_id, msg_check):
     Parameters:
         user_id (int): the unique identification number of the person requesting the command
         msg_check (dict): a dictionary containing the keys is_message_valid (Bool),
-                          sent_msg (dict), msg_index (int) and ch_index (int)
+                          sent_msg (message), channel (channel) and ch_index (int)
 
     Return:
         {}
     """
     # Get the data needed from msg_check
     sender_u_id  = msg_check['sent_msg'].u_id
-    ch_index = msg_check['ch_index']
+    channel = msg_check['channel']
 
     # Check if command is requested by the same user who sent the message
     is_user = False
@@ -78,14 +66,11 @@ def check_message_access(user_id, msg_check):
         is_user = True
 
     # Check if command is forcibly requested by admin (channel owner)
-    is_owner = False
-    check_owner_uid = [user.u_id for user in data.channels[ch_index].owner_members]
-    if user_id in check_owner_uid:
-        is_owner = True
+    is_owner = channel.is_owner(user_id)
 
     # Check if command is forcibly requested by flockr owner
     is_flockr_owner = False
-    perm_status = data.users[user_id].permission_id
+    perm_status = store.users.find(user_id).permission_id
     if perm_status == 1:
         is_flockr_owner = True
 
@@ -111,10 +96,11 @@ def send_msg(msg_id, user_id, message_in, channel, time_sent):
     Return:
         {}
     '''
+    store.messages.unschedule(msg_id)
     new_message = message(message_in, user_id, msg_id)
     # Alter the message time sent to remove program execution time errors
     new_message.time_created = time_sent
-    channel.channel_messages.append(new_message)
+    store.messages.add(channel, new_message)
     return
 
 
@@ -170,7 +156,7 @@ def message_send(token, channel_id, message_in):
     # Check message length, raise InputError if characters in message:
     # -> length of characters > 1000
     # -> length of characters == 0 (empty message)
-    if len(message_in) > 1000 or len(message_in) == 0:
+    if len(message_in) > MESSAGE_MAX_LENGTH or len(message_in) == 0:
         raise InputError(description='Invalid message length')
 
     # Check if token and channel_id exists in data
@@ -192,13 +178,12 @@ def message_send(token, channel_id, message_in):
 
     if message_in == "/hangman start" or is_guess:
         message_in = hangman(message_in, channel)
+        channel.record_hangman()
 
-
-    message_id = data.message_index
-    data.message_index += 1
+    message_id = store.messages.next_id()
     message_object = message(message_in, user_id, message_id)
 
-    channel.new_message(message_object)
+    store.messages.add(channel, message_object)
 
     return {
         'message_id': message_object.message_id
@@ -219,7 +204,6 @@ def message_remove(token, message_id):
     # Check if message exists in the data
     # Function will raise InputError if message does not exist
     msg_check = check_message_valid(message_id)
-    ch_index = msg_check['ch_index']
 
     # Check if token is valid
     user_id = authenticate_token(token)
@@ -228,7 +212,7 @@ def message_remove(token, message_id):
     check_message_access(user_id, msg_check)
 
     # Removes the message from the channel
-    data.channels[ch_index].channel_messages.remove(msg_check['sent_msg'])
+    store.messages.remove(message_id)
     return {
     }
 
@@ -248,10 +232,6 @@ def message_edit(token, message_id, message):
     # Check if message exists in the data
     # Function will raise InputError if message does not exist
     msg_check = check_message_valid(message_id)
-    ch_index = msg_check['ch_index']
-    msg_index = msg_check['msg_index']
-
-    channel = valid_channel_id(ch_index)
 
     # Check if token is valid
     user_id = authenticate_token(token)
@@ -261,9 +241,9 @@ def message_edit(token, message_id, message):
 
     # Edits the message or remove it if message is empty
     if message == '':
-        channel.channel_messages.remove(msg_check['sent_msg'])
+        store.messages.remove(message_id)
     else:
-        channel.channel_messages[msg_index].update_message(message)
+        store.messages.edit(message_id, message)
     return {
     }
 
@@ -282,7 +262,7 @@ def message_sendlater(token, channel_id, message, time_sent):
         message_id (int): the unique id of a message in the system
     """
     # Check message length, raise InputError if characters in message is invalid
-    if len(message) > 1000 or len(message) == 0:
+    if len(message) > MESSAGE_MAX_LENGTH or len(message) == 0:
         raise InputError(description='Invalid message length')
 
     # Check if token is valid and channel_id exists in data
@@ -302,20 +282,68 @@ def message_sendlater(token, channel_id, message, time_sent):
 
     # Generate message id and increment the counter in the data
     # Message_id is generated when message_sendlater is called
-    msg_id = data.message_index
-    data.message_index += 1
+    msg_id = store.messages.next_id()
 
     # Send the message according to the desired time
-    timer = time_sent - cur_time
-    send_after = threading.Timer(timer, send_msg,
-                                [msg_id, user_id, message, channel, time_sent])
-    send_after.start()
+    job_id = data.scheduler.schedule_durable(time_sent, 'sendlater',
+                                             (msg_id, user_id, message, channel_id, time_sent))
+    store.messages.schedule(msg_id, job_id, user_id)
 
     # Return the generated message_id
     return {
         'message_id': msg_id
     }
 
+def send_later(msg_id, user_id, message_in, channel_id, time_sent):
+    '''
+    Run by the scheduler at the time given to message_sendlater, takes only
+    JSON values so the job can be kept in the schedule log
+
+    Parameters:
+        msg_id (int): the message_id returned by message_sendlater
+        user_id (int): the sender
+        message_in (str): the message which will be sent in the channel
+        channel_id (int): the channel to send it in
+        time_sent (int): the unix timestamp the message was due at
+
+    Return:
+        None
+    '''
+    with data.lock:
+        send_msg(msg_id, user_id, message_in, valid_channel_id(channel_id), time_sent)
+
+data.scheduler.register('sendlater', send_later)
+
+def message_sendlater_cancel(token, message_id):
+    """
+    Stops a message queued by message_sendlater from being sent
+
+    Parameters:
+        token (str): Used to authenticate and identify the user
+        message_id (int): the id returned by message_sendlater
+
+    Return:
+    	{}
+    """
+    user_id = authenticate_token(token)
+
+    # Raise InputError if the message is not waiting to be sent
+    scheduled = store.messages.find_scheduled(message_id)
+    if scheduled is None:
+        raise InputError(description='Message is not scheduled')
+
+    # Only the sender can cancel their message
+    job_id, sender_id = scheduled
+    if sender_id != user_id:
+        raise AccessError("User did not schedule this message")
+
+    if data.scheduler.cancel(job_id):
+        store.messages.unschedule(message_id)
+        return {
+        }
+    # It was sent while we were checking
+    raise InputError(description='Message is not scheduled')
+
 def message_react(token, message_id, react_id):
     """
     Given a valid user appointed with the token, react to an existing message under
@@ -336,9 +364,7 @@ def message_react(token, message_id, react_id):
 
     # Check if message exists in the data
     msg_check = check_message_valid(message_id)
-    ch_index = msg_check['ch_index']
-    msg_index = msg_check['msg_index']
-    channel = valid_channel_id(ch_index)
+    channel = msg_check['channel']
 
     # Check if user is a member of the channel where the message was posted
     if not channel.existing_member(user):
@@ -348,7 +374,7 @@ def message_react(token, message_id, react_id):
     check_valid_react_id(react_id)
 
     # Find the current user_id in the reacts u_id list
-    cur_msg = data.channels[ch_index].channel_messages[msg_index]
+    cur_msg = msg_check['sent_msg']
     is_already_reacted = False
     for react in cur_msg.reacts:
         if react['react_id'] == react_id and user_id in react['u_ids']:
@@ -367,7 +393,7 @@ def message_react(token, message_id, react_id):
         new_react_dict['react_id'] = react_id
         new_react_dict['u_ids'] = [user_id]
         new_react_dict['is_this_user_reacted'] = False
-        cur_msg.reacts.append(new_react_dict)
+        cur_msg.new_react(new_react_dict)
     else: # Add react data on the current dictionary
         cur_react_dict = cur_msg.reacts[react_index]
         # Append the current user_id into the u_ids list
@@ -378,6 +404,7 @@ def message_react(token, message_id, react_id):
     if user_id == cur_msg.u_id:
         cur_msg.reacts[react_index]['is_this_user_reacted'] = True
 
+    store.messages.save(cur_msg)
     return {}
 
 def message_unreact(token, message_id, react_id):
@@ -400,9 +427,7 @@ def message_unreact(token, message_id, react_id):
 
     # Check if message exists in the data
     msg_check = check_message_valid(message_id)
-    ch_index = msg_check['ch_index']
-    msg_index = msg_check['msg_index']
-    channel = valid_channel_id(ch_index)
+    channel = msg_check['channel']
 
     # Check if user is a member of the channel where the message was posted
     if not channel.existing_member(user):
@@ -412,7 +437,7 @@ def message_unreact(token, message_id, react_id):
     check_valid_react_id(react_id)
 
     # Find the current user_id in the reacts u_id list
-    cur_msg = data.channels[ch_index].channel_messages[msg_index]
+    cur_msg = msg_check['sent_msg']
     is_reacted = False
     for react in cur_msg.reacts:
         if react['react_id'] == react_id and user_id in react['u_ids']:
@@ -432,12 +457,13 @@ def message_unreact(token, message_id, react_id):
     # Updates the is_this_user_reacted value if the current user who unreacted is the
     # same user who sent the message
     if user_id == cur_msg.u_id:
-        cur_msg.reacts[react_index]['is_this_user_reacted'] = False
+        cur_react_dict['is_this_user_reacted'] = False
 
     # Remove the react from the whole reacts list if u_ids list is empty
-    if cur_msg.reacts[react_index]['u_ids'] == []:
-        cur_msg.reacts.pop(react_index)
+    if cur_react_dict['u_ids'] == []:
+        cur_msg.remove_react(react_index)
 
+    store.messages.save(cur_msg)
     return {}
 
 def message_pin(token, message_id):
@@ -458,20 +484,19 @@ def message_pin(token, message_id):
     # Check if message exists in the data
     # Function will raise InputError if message does not exist
     msg_check = check_message_valid(message_id)
-    ch_index = msg_check['ch_index']
-    msg_index = msg_check['msg_index']
-
-    channel = valid_channel_id(ch_index)
+    channel = msg_check['channel']
+    cur_msg = msg_check['sent_msg']
 
     # Check if user is an owner of the channel, raise AccessError if not
-    if user not in channel.owner_members:
+    if not channel.is_owner(user.u_id):
         raise AccessError("User not not an owner inside desired channel")
 
     # check is pinned and set
-    if not channel.channel_messages[msg_index].is_pinned:
-        channel.channel_messages[msg_index].is_pinned = True
+    if not cur_msg.is_pinned:
+        cur_msg.is_pinned = True
     else:
         raise InputError(description='message is already pinned')
+    store.messages.save(cur_msg)
 
     return {}
 
@@ -493,20 +518,19 @@ def message_unpin(token, message_id):
     # Check if message exists in the data
     # Function will raise InputError if message does not exist
     msg_check = check_message_valid(message_id)
-    ch_index = msg_check['ch_index']
-    msg_index = msg_check['msg_index']
-
-    channel = valid_channel_id(ch_index)
+    channel = msg_check['channel']
+    cur_msg = msg_check['sent_msg']
 
     # Check if user is an owner of the channel, raise AccessError if not
-    if user not in channel.owner_members:
+    if not channel.is_owner(user.u_id):
         raise AccessError("User not not an owner inside desired channel")
 
     # check is pinned and set
-    if channel.channel_messages[msg_index].is_pinned:
-        channel.channel_messages[msg_index].is_pinned = False
+    if cur_msg.is_pinned:
+        cur_msg.is_pinned = False
     else:
         raise InputError(description="message wasn't pinned")
+    store.messages.save(cur_msg)
 
     return {}
 
@@ -0,0 +1,244 @@
+""" Columnar storage engine for a channel's message history
+
+message_columns can be used in place of the plain list held in
+channel.channel_messages. message_id, u_id, time_created and is_pinned live in
+typed arrays and the message text lives in one utf-8 buffer addressed by
+offset and length, so a channel's history costs a few machine words per
+message instead of a Python object per message. Reading a message returns a
+message_row, a small view whose attributes read and write the columns.
+Pages, pinned messages and time ranges are read straight from the columns,
+see memory_messages in storage.py.
+
+To store new channels this way, as server.py --columnar does:
+    data.history_class = message_columns
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from data import NO_REACTS
+
+# The text buffer is packed again once edits and removals have left at
+# least this many unused bytes in it, and they make up more than half of it
+TEXT_COMPACT_MIN_GARBAGE = 64 * 1024
+
+class message_row:
+    __slots__ = ('store', 'message_id')
+
+    def __init__(self, store, message_id):
+        self.store = store
+        self.message_id = message_id
+
+    def __eq__(self, other):
+        return isinstance(other, message_row) and self.store is other.store \
+            and self.message_id == other.message_id
+
+    def __hash__(self):
+        return hash(self.message_id)
+
+    @property
+    def u_id(self):
+        return self.store.u_ids[self.store.rows[self.message_id]]
+
+    @property
+    def message(self):
+        return self.store.read_text(self.store.rows[self.message_id])
+
+    @property
+    def time_created(self):
+        return self.store.times[self.store.rows[self.message_id]]
+
+    @time_created.setter
+    def time_created(self, time_created):
+        times = self.store.times
+        row = self.store.rows[self.message_id]
+        times[row] = time_created
+        if (row > 0 and times[row - 1] > time_created) or \
+                (row + 1 < len(times) and time_created > times[row + 1]):
+            self.store.times_sorted = False
+
+    @property
+    def seq(self):
+        return self.store.seqs[self.store.rows[self.message_id]]
+
+    @property
+    def removed(self):
+        return bool(self.store.removed[self.store.rows[self.message_id]])
+
+    @removed.setter
+    def removed(self, removed):
+        self.store.removed[self.store.rows[self.message_id]] = int(removed)
+
+    @property
+    def is_pinned(self):
+        return bool(self.store.pinned[self.store.rows[self.message_id]])
+
+    @is_pinned.setter
+    def is_pinned(self, is_pinned):
+        self.store.pinned[self.store.rows[self.message_id]] = int(is_pinned)
+
+    @property
+    def reacts(self):
+        return self.store.reacts.get(self.message_id, NO_REACTS)
+
+    @reacts.setter
+    def reacts(self, reacts):
+        if reacts:
+            self.store.reacts[self.message_id] = list(reacts)
+        else:
+            self.store.reacts.pop(self.message_id, None)
+
+    def message_details(self):
+        return self.store.row_details(self.store.rows[self.message_id])
+
+    def update_message(self, new_message):
+        self.store.write_text(self.store.rows[self.message_id], new_message)
+
+    def new_react(self, react):
+        self.store.reacts.setdefault(self.message_id, []).append(react)
+
+    def remove_react(self, react_index):
+        reacts = self.store.reacts[self.message_id]
+        reacts.pop(react_index)
+        if not reacts:
+            del self.store.reacts[self.message_id]
+
+class message_columns:
+    def __init__(self):
+        self.message_ids = array('q')
+        self.u_ids = array('q')
+        self.times = array('q')
+        self.pinned = array('b')
+        self.seqs = array('q')
+        self.removed = array('b')
+        self.text_start = array('q')
+        self.text_length = array('q')
+        self.text = bytearray()
+        # Bytes of text no row points at any more, see pack_text
+        self.garbage = 0
+        # message_id -> row, and the reacts of the few messages that have any
+        self.rows = {}
+        self.reacts = {}
+        # Whether time_created never goes down from one row to the next, so
+        # time ranges can be found by bisection. A message_sendlater job that
+        # runs late can append an older time
+        self.times_sorted = True
+
+    def __len__(self):
+        return len(self.message_ids)
+
+    def __iter__(self):
+        return (message_row(self, message_id) for message_id in self.message_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [message_row(self, message_id) for message_id in self.message_ids[index]]
+        return message_row(self, self.message_ids[index])
+
+    def append(self, message):
+        if self.times and message.time_created < self.times[-1]:
+            self.times_sorted = False
+        self.rows[message.message_id] = len(self.message_ids)
+        self.message_ids.append(message.message_id)
+        self.u_ids.append(message.u_id)
+        self.times.append(message.time_created)
+        self.pinned.append(int(message.is_pinned))
+        self.seqs.append(message.seq)
+        self.removed.append(int(message.removed))
+        self.text_start.append(len(self.text))
+        self.text_length.append(0)
+        self.write_text(len(self.message_ids) - 1, message.message)
+        if message.reacts:
+            self.reacts[message.message_id] = list(message.reacts)
+
+    def remove(self, message):
+        row = self.rows.pop(message.message_id)
+        self.garbage += self.text_length[row]
+        for column in (self.message_ids, self.u_ids, self.times, self.pinned, self.seqs,
+                       self.removed, self.text_start, self.text_length):
+            del column[row]
+        self.reacts.pop(message.message_id, None)
+        # Rows after the removed one have shifted down by one
+        for later_row in range(row, len(self.message_ids)):
+            self.rows[self.message_ids[later_row]] = later_row
+
+    def read_text(self, row):
+        start = self.text_start[row]
+        return self.text[start:start + self.text_length[row]].decode()
+
+    def write_text(self, row, text):
+        encoded = text.encode()
+        start = self.text_start[row]
+        # Edits that fit are written in place, longer text goes at the end
+        if len(encoded) > self.text_length[row]:
+            self.garbage += self.text_length[row]
+            start = len(self.text)
+            self.text_start[row] = start
+            self.text.extend(encoded)
+        else:
+            self.garbage += self.text_length[row] - len(encoded)
+            self.text[start:start + len(encoded)] = encoded
+        self.text_length[row] = len(encoded)
+        if self.garbage >= TEXT_COMPACT_MIN_GARBAGE and self.garbage * 2 > len(self.text):
+            self.pack_text()
+
+    def pack_text(self):
+        """ Copies every row's text into a new buffer, leaving out the unused bytes """
+        packed = bytearray()
+        for row, start in enumerate(self.text_start):
+            self.text_start[row] = len(packed)
+            packed += self.text[start:start + self.text_length[row]]
+        self.text = packed
+        self.garbage = 0
+
+    def pinned_rows(self):
+        """ The rows of live pinned messages, newest first """
+        flags = self.pinned.tobytes()
+        rows = []
+        row = flags.rfind(1)
+        while row >= 0:
+            if not self.removed[row]:
+                rows.append(row)
+            row = flags.rfind(1, 0, row)
+        return rows
+
+    def rows_between(self, since, until, limit):
+        """
+        The rows of the newest live messages created from since to until
+
+        Parameters:
+            since (int): the earliest time_created wanted, or None
+            until (int): the latest time_created wanted, or None
+            limit (int): the most rows to return
+
+        Returns:
+            rows (list): rows, newest first
+        """
+        if self.times_sorted:
+            first = 0 if since is None else bisect_left(self.times, since)
+            last = len(self.times) if until is None else bisect_right(self.times, until)
+            candidates = range(last - 1, first - 1, -1)
+        else:
+            candidates = [row for row in range(len(self.times) - 1, -1, -1)
+                          if (since is None or self.times[row] >= since)
+                          and (until is None or self.times[row] <= until)]
+        rows = []
+        for row in candidates:
+            if len(rows) == limit:
+                break
+            if not self.removed[row]:
+                rows.append(row)
+        return rows
+
+    def page_details(self, rows):
+        """ The message dictionaries of rows, in the order given """
+        return [self.row_details(row) for row in rows]
+
+    def row_details(self, row):
+        message_id = self.message_ids[row]
+        return {
+            'message_id': message_id,
+            'u_id': self.u_ids[row],
+            'message': self.read_text(row),
+            'time_created': self.times[row],
+            'is_pinned': bool(self.pinned[row]),
+            'reacts': list(self.reacts.get(message_id, NO_REACTS))
+        }
@@ -0,0 +1,112 @@
+""" Tests for the columnar message store in message_store.py """
+import pytest
+from auth import auth_register
+from channel import channel_messages, channel_pins, channel_messages_between
+from channels import channels_create
+from message import message_send, message_remove, message_edit, message_react, message_pin
+from message import message_unreact
+from other import clear, search
+from data import data, message
+from message_store import message_columns
+
+@pytest.fixture
+def columnar():
+    clear()
+    data.history_class = message_columns
+    yield
+    data.history_class = list
+    clear()
+
+def test_message_columns_send_and_read(columnar):
+    user = auth_register('pineapplepizza@gmail.com', 'Kscai<W01', 'Pineapple', 'Pizzeria')
+    channel = channels_create(user['token'], "Test_Channel", False)
+    assert isinstance(data.channels[channel['channel_id']].channel_messages, message_columns)
+
+    message_send(user['token'], channel['channel_id'], "FIRST!!!")
+    message_send(user['token'], channel['channel_id'], "SECOND!! ünïcode")
+    check_message = channel_messages(user['token'], channel['channel_id'], 0)
+    assert [msg['message'] for msg in check_message['messages']] == ["SECOND!! ünïcode", "FIRST!!!"]
+    assert check_message['messages'][0]['u_id'] == user['u_id']
+    assert check_message['messages'][0]['reacts'] == []
+
+def test_message_columns_edit_remove(columnar):
+    user = auth_register('pineapplepizza@gmail.com', 'Kscai<W01', 'Pineapple', 'Pizzeria')
+    channel = channels_create(user['token'], "Test_Channel", False)
+    msg1 = message_send(user['token'], channel['channel_id'], "FIRST!!!")
+    msg2 = message_send(user['token'], channel['channel_id'], "SECOND!!")
+    msg3 = message_send(user['token'], channel['channel_id'], "THIRD!")
+
+    message_edit(user['token'], msg1['message_id'], "a much longer first message")
+    message_edit(user['token'], msg3['message_id'], "3")
+    message_remove(user['token'], msg2['message_id'])
+    check_message = channel_messages(user['token'], channel['channel_id'], 0)
+    assert [msg['message'] for msg in check_message['messages']] == ["3", "a much longer first message"]
+
+    # Rows after the removed message can still be edited by id
+    message_edit(user['token'], msg3['message_id'], "")
+    check_message = channel_messages(user['token'], channel['channel_id'], 0)
+    assert [msg['message_id'] for msg in check_message['messages']] == [msg1['message_id']]
+
+def test_message_columns_react_pin_search(columnar):
+    user = auth_register('pineapplepizza@gmail.com', 'Kscai<W01', 'Pineapple', 'Pizzeria')
+    channel = channels_create(user['token'], "Test_Channel", False)
+    msg1 = message_send(user['token'], channel['channel_id'], "hello world")
+    msg2 = message_send(user['token'], channel['channel_id'], "goodbye world")
+    message_react(user['token'], msg1['message_id'], 1)
+    message_pin(user['token'], msg2['message_id'])
+
+    result = search(user['token'], "world")
+    assert result['messages'][0]['reacts'] == [
+        {'react_id': 1, 'u_ids': [user['u_id']], 'is_this_user_reacted': True}
+    ]
+    assert result['messages'][1]['is_pinned']
+
+    message_unreact(user['token'], msg1['message_id'], 1)
+    assert search(user['token'], "hello")['messages'][0]['reacts'] == []
+
+def test_message_columns_pins_and_time_ranges(columnar):
+    user = auth_register('pineapplepizza@gmail.com', 'Kscai<W01', 'Pineapple', 'Pizzeria')
+    channel = channels_create(user['token'], "Test_Channel", False)
+    msg_ids = [message_send(user['token'], channel['channel_id'], str(i))['message_id']
+               for i in range(6)]
+    history = data.channels[channel['channel_id']].channel_messages
+    for row in range(6):
+        history[row].time_created = 100 + row
+    message_pin(user['token'], msg_ids[0])
+    message_pin(user['token'], msg_ids[4])
+    message_remove(user['token'], msg_ids[3])
+
+    assert history.pinned_rows() == [4, 0]
+    assert [msg['message_id'] for msg in channel_pins(user['token'], channel['channel_id'])['messages']] == \
+        [msg_ids[4], msg_ids[0]]
+    assert history.times_sorted
+    assert history.rows_between(101, 104, 50) == [4, 2, 1]
+    assert history.rows_between(None, None, 2) == [5, 4]
+
+    # A message that went out late, out of time order, turns bisection off
+    history[1].time_created = 90
+    assert not history.times_sorted
+    assert history.rows_between(None, 100, 50) == [1, 0]
+    page = channel_messages_between(user['token'], channel['channel_id'], since=101, until=105)
+    assert [msg['message_id'] for msg in page['messages']] == [msg_ids[5], msg_ids[4], msg_ids[2]]
+
+
+
+def test_message_columns_pack_text(columnar, monkeypatch):
+    monkeypatch.setattr('message_store.TEXT_COMPACT_MIN_GARBAGE', 10)
+    user = auth_register('pineapplepizza@gmail.com', 'Kscai<W01', 'Pineapple', 'Pizzeria')
+    channel = channels_create(user['token'], "Test_Channel", False)
+    msg1 = message_send(user['token'], channel['channel_id'], "first")
+    msg2 = message_send(user['token'], channel['channel_id'], "second")
+    history = data.channels[channel['channel_id']].channel_messages
+
+    # A longer edit moves the text to the end, a shorter one leaves bytes unused
+    message_edit(user['token'], msg1['message_id'], "a much longer first message")
+    assert history.garbage == len("first")
+    message_edit(user['token'], msg1['message_id'], "x")
+    assert history.garbage == 0
+    assert bytes(history.text) == b"xsecond"
+    check_message = channel_messages(user['token'], channel['channel_id'], 0)
+    assert [msg['message'] for msg in check_message['messages']] == ["second", "x"]
+    message_edit(user['token'], msg2['message_id'], "2nd")
+    assert channel_messages(user['token'], channel['channel_id'], 0)['messages'][0]['message'] == "2nd"
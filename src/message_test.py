@@ -3,10 +3,10 @@ import time
 from auth import auth_register, auth_logout
 from channel import channel_messages, channel_join
 from channels import channels_create
-from message import find_react_id_index, message_send, message_remove, message_edit, message_sendlater, message_react, message_unreact, message_pin, message_unpin
+from message import check_message_valid, find_react_id_index, message_send, message_remove, message_edit, message_sendlater, message_sendlater_cancel, message_react, message_unreact, message_pin, message_unpin
 from error import AccessError, InputError
 from other import clear
-from data import data
+from data import data, COMPACT_MIN_TOMBSTONES, start_compacting
 
 ####################### Tests for helper functions #####################
 def test_find_react_id_index_empty_list():
@@ -32,6 +32,35 @@ def test_find_react_id_index_valid_list():
     ]
     assert find_react_id_index(reacts_list, 2) == 2
 
+def test_check_message_valid_other_channel():
+    clear()
+    user = auth_register('pineapplepizza@gmail.com', 'Kscai<W01', 'Pineapple', 'Pizzeria')
+    channel1 = channels_create(user['token'], "Test_Channel", False)
+    channel2 = channels_create(user['token'], "Other_Channel", False)
+    message_send(user['token'], channel1['channel_id'], "FIRST!!!")
+    msg = message_send(user['token'], channel2['channel_id'], "SECOND!!")
+
+    msg_check = check_message_valid(msg['message_id'])
+    assert msg_check['ch_index'] == channel2['channel_id']
+    assert msg_check['sent_msg'].message == "SECOND!!"
+
+def test_check_message_valid_removed_and_cleared():
+    clear()
+    user = auth_register('pineapplepizza@gmail.com', 'Kscai<W01', 'Pineapple', 'Pizzeria')
+    channel = channels_create(user['token'], "Test_Channel", False)
+    msg1 = message_send(user['token'], channel['channel_id'], "FIRST!!!")
+    msg2 = message_send(user['token'], channel['channel_id'], "SECOND!!")
+    message_remove(user['token'], msg1['message_id'])
+    message_edit(user['token'], msg2['message_id'], "")
+    with pytest.raises(InputError):
+        check_message_valid(msg1['message_id'])
+    with pytest.raises(InputError):
+        check_message_valid(msg2['message_id'])
+
+    msg3 = message_send(user['token'], channel['channel_id'], "THIRD!")
+    clear()
+    assert data.find_message(msg3['message_id']) is None
+
 ####################### Tests for message_send function #####################
 
 def test_message_send_invalid_message_length():
@@ -526,6 +555,89 @@ def test_message_remove_middle():
     assert check_message['messages'][1]['message'] == "FIRST!!!"
     assert check_message['messages'][0]['message'] == "THIRD!"
 
+def test_message_remove_tombstone_whitebox():
+    '''
+    message_remove should flag the message in place until the channel is compacted
+    '''
+    clear()
+    user = auth_register('pineapplepizza@gmail.com', 'Kscai<W01', 'Pineapple', 'Pizzeria')
+    channel = channels_create(user['token'], "Test_Channel", False)
+    msg1 = message_send(user['token'], channel['channel_id'], "FIRST!!!")
+    message_send(user['token'], channel['channel_id'], "SECOND!!")
+    message_remove(user['token'], msg1['message_id'])
+
+    ch = data.channels[channel['channel_id']]
+    assert len(ch.channel_messages) == 2
+    assert ch.channel_messages[0].removed
+    assert ch.num_messages() == 1
+
+    data.compact_messages()
+    assert len(ch.channel_messages) == 1
+    assert not ch.tombstones
+
+def test_message_remove_pages_skip_tombstones_whitebox():
+    '''
+    Paging by offset skips removed messages without rewriting the history,
+    the background pass only rewrites channels with enough of them
+    '''
+    clear()
+    user = auth_register('pineapplepizza@gmail.com', 'Kscai<W01', 'Pineapple', 'Pizzeria')
+    channel = channels_create(user['token'], "Test_Channel", False)
+    msg_ids = [message_send(user['token'], channel['channel_id'], str(i))['message_id']
+               for i in range(200)]
+    ch = data.channels[channel['channel_id']]
+    # Removed out of order, and every other one of the newest
+    for msg_id in msg_ids[100::-1] + msg_ids[151::2]:
+        message_remove(user['token'], msg_id)
+    assert ch.num_messages() == 74
+
+    check_message = channel_messages(user['token'], channel['channel_id'], 0)
+    assert [msg['message'] for msg in check_message['messages']] == \
+        [str(i) for i in range(150, 100, -1)]
+    check_message = channel_messages(user['token'], channel['channel_id'], 10)
+    assert [msg['message'] for msg in check_message['messages']] == \
+        [str(i) for i in range(170, 150, -2)] + [str(i) for i in range(150, 110, -1)]
+    assert len(ch.channel_messages) == 200
+
+    assert data.compact_messages(min_tombstones=200) == 0
+    assert data.compact_messages(COMPACT_MIN_TOMBSTONES) == 1
+    assert len(ch.channel_messages) == 74
+    assert channel_messages(user['token'], channel['channel_id'], 10) == check_message
+
+def test_message_remove_compacting_survives_clear_whitebox():
+    '''
+    The background compaction keeps running after clear()
+    '''
+    clear()
+    job_id = start_compacting(0.05)
+    clear()
+    assert data.scheduler.queue_depth() == 1
+    user = auth_register('pineapplepizza@gmail.com', 'Kscai<W01', 'Pineapple', 'Pizzeria')
+    channel = channels_create(user['token'], "Test_Channel", False)
+    msg_ids = [message_send(user['token'], channel['channel_id'], str(i))['message_id']
+               for i in range(COMPACT_MIN_TOMBSTONES + 1)]
+    for msg_id in msg_ids[:COMPACT_MIN_TOMBSTONES]:
+        message_remove(user['token'], msg_id)
+    ch = data.channels[channel['channel_id']]
+    time.sleep(0.3)
+    data.scheduler.cancel(job_id)
+    assert len(ch.channel_messages) == 1
+    assert not ch.tombstones
+
+def test_message_remove_forgets_old_cursors_whitebox(monkeypatch):
+    '''
+    A channel only keeps the seqs of its latest removed messages
+    '''
+    clear()
+    monkeypatch.setattr('data.REMOVED_SEQS_MAX', 2)
+    user = auth_register('pineapplepizza@gmail.com', 'Kscai<W01', 'Pineapple', 'Pizzeria')
+    channel = channels_create(user['token'], "Test_Channel", False)
+    msg_ids = [message_send(user['token'], channel['channel_id'], str(i))['message_id']
+               for i in range(4)]
+    for msg_id in msg_ids[:3]:
+        message_remove(user['token'], msg_id)
+    assert list(data.channels[channel['channel_id']].removed_seqs) == msg_ids[1:3]
+
 ####################### Tests for message_edit function #####################
 
 def test_message_edit_invalid_message():
@@ -1011,6 +1123,53 @@ def test_message_sendlater_multiple_same_time():
     assert msg2['message_id'] == 1
     assert msg3['message_id'] == 2
 
+def test_message_sendlater_cancel():
+    '''
+    Input:
+        a message queued by message_sendlater, cancelled before it is due
+    Output:
+        the message is never sent, and cannot be cancelled twice
+    '''
+    clear()
+    user = auth_register('peanutcoal@gmail.com', 'aidKdamc0m', 'Peanut', 'Coal')
+    channel = channels_create(user['token'], "Test_Channel", False)
+
+    send_time = int(time.time()) + 1
+    msg1 = message_sendlater(user['token'], channel['channel_id'], "Cancelled", send_time)
+    message_sendlater(user['token'], channel['channel_id'], "Sent", send_time)
+    assert data.scheduler.queue_depth() == 2
+
+    assert message_sendlater_cancel(user['token'], msg1['message_id']) == {}
+    assert data.scheduler.queue_depth() == 1
+    with pytest.raises(InputError):
+        message_sendlater_cancel(user['token'], msg1['message_id'])
+
+    time.sleep(2.5)
+    check_message = channel_messages(user['token'], channel['channel_id'], 0)
+    assert [msg['message'] for msg in check_message['messages']] == ["Sent"]
+    assert data.scheduler.queue_depth() == 0
+
+def test_message_sendlater_cancel_not_sender():
+    '''
+    Input:
+        another user tries to cancel a queued message
+    Output:
+        message_sendlater_cancel should raise an AccessError
+    '''
+    clear()
+    user = auth_register('peanutcoal@gmail.com', 'aidKdamc0m', 'Peanut', 'Coal')
+    user2 = auth_register('jimmykenny@gmail.com', 'Gao02MnKlej', 'Jimmy', 'Kenny')
+    channel = channels_create(user['token'], "Test_Channel", True)
+    channel_join(user2['token'], channel['channel_id'])
+
+    msg = message_sendlater(user['token'], channel['channel_id'], "Mine", int(time.time()) + 60)
+    with pytest.raises(AccessError):
+        message_sendlater_cancel(user2['token'], msg['message_id'])
+    with pytest.raises(InputError):
+        message_sendlater_cancel(user['token'], 1234)
+    clear()
+    assert data.scheduler.queue_depth() == 0
+
 ####################### Tests for message_react function #####################
 def test_message_react_invalid_token():
     '''
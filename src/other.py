@@ -1,7 +1,7 @@
 import re
 from data import data
+from storage import store
 from error import InputError, AccessError
-import re
 import jwt
 
 def clear():
@@ -12,10 +12,11 @@ def clear():
 
     Returns: None
     """
-    data.users.clear()
-    data.channels.clear()
-    data.tokens.clear()
-    data.message_index = 0
+    store.clear()
+    data.token_cache.clear()
+    data.search_cache.clear()
+    data.scheduler.clear()
+    data.record('clear')
     return {}
 
 def users_all(token):
@@ -39,7 +40,7 @@ def users_all(token):
 
     users = []
 
-    for user in data.users:
+    for user in store.users.all():
         users.append(user.user_details())
 
     return {
@@ -83,25 +84,52 @@ def admin_userpermission_change(token, u_id, permission_id):
     # check user id is valid
     target = valid_user_id(u_id)
 
-    if (target.u_id ==  data.users[tok].u_id):
+    if (target.u_id ==  store.users.find(tok).u_id):
         raise InputError("user trying to change their own permission_id")
     
-    print(data.users[tok].permission_id)
-    if (data.users[tok].permission_id != 1):
+    if (store.users.find(tok).permission_id != 1):
         raise AccessError("user is not authorised to change permission_ids")
 
     # update permission_id
     target.permission_id = permission_id
+    store.users.save(target)
     return {}
 
-def search(token, query_str):
+def admin_scheduler_details(token):
+    """
+    Reports on the scheduler that sends messages later and ends standups
+
+    Parameters:
+    	token (str): A string that validates the users actions while
+    				 They are logged in
+
+   	Returns:
+   		{
+   			queue_depth (int): the number of jobs waiting to run
+   			failed (int): the number of jobs that raised an error
+   		}
+    """
+    tok = authenticate_token(token)
+    if store.users.find(tok).permission_id != 1:
+        raise AccessError("user is not authorised to see the scheduler")
+    return data.scheduler.scheduler_details()
+
+def search(token, query_str, limit=None, before_message_id=None, since=None, until=None):
     """
     Function that searches the messages of every channel that the user
     for messages matching a query string
 
+    If any of limit, before_message_id, since or until is given, only one
+    page of at most limit (default 50) matches is returned, newest first.
+
     Parameters:
     	token (str): for validation
         query_str (str): The string to search for
+        limit (int): the most matches to return in a page (1 to 50)
+        before_message_id (int): return the matches older than this one,
+                                 the end of the previous page
+        since (UNIX timestamp): ignore messages sent before this time
+        until (UNIX timestamp): ignore messages sent after this time
 
     Returns:
     	[
@@ -112,44 +140,104 @@ def search(token, query_str):
     			time_created (UNIX timestamp): The time at which the message was sent
     	  	}
     	]
+    	end (int): in a page, the before_message_id of the next page,
+    	           or -1 if there are no more matches
     """
     # Authenticate token and get user id
     user_id = authenticate_token(token)
 
-    # Get list of all channels the user is in
-    all_channels = []
-    query_str = re.escape(query_str) # Treats special characters as normal text
-    for channel in data.channels:
-        check_u_id = [user.u_id for user in channel.all_members]
-        if user_id in check_u_id:
-            all_channels.append(channel)
-
-    # Search each relevent channel for messages that match the query
-    return_messages = []
-    for channel in all_channels:
-        for message in channel.channel_messages:
-            if re.search(query_str, message.message):
-                return_messages.append(message.message_details())
+    if limit is not None or before_message_id is not None or since is not None or until is not None:
+        return search_page(user_id, query_str, 50 if limit is None else limit,
+                           before_message_id, since, until)
+
+    # Repeated searches are answered from the cache while nothing they
+    # depend on has changed. Only message_ids are kept, so reacts and pins
+    # are always current
+    key = (user_id, query_str)
+    versions = data.search_versions(user_id)
+    message_ids = data.search_cache.get(key, versions)
+    if message_ids is not None:
+        return {
+            'messages': [store.messages.find(message_id)[1].message_details()
+                         for message_id in message_ids]
+        }
+
+    messages = search_messages(user_id, query_str)
+    data.search_cache.add(key, versions, [msg['message_id'] for msg in messages])
+    return {
+        'messages': messages
+    }
+
+def search_messages(user_id, query_str):
+    """
+    Finds every message in the user's channels containing query_str
+
+    Parameters:
+        user_id (int): the user searching
+        query_str (str): The string to search for
+
+    Returns:
+        messages (list): message dictionaries in channel_id order, then
+                         in the order they appear in their channel
+    """
+    return store.messages.search(user_id, query_str)
+
+def search_page(user_id, query_str, limit, before_message_id, since, until):
+    """
+    Finds one page of search results, newest first
+
+    Parameters:
+        user_id (int): the user searching
+        query_str (str): The string to search for
+        limit (int): the most matches to return (1 to 50)
+        before_message_id (int): only return matches older than this one
+        since (int): ignore messages sent before this time, if given
+        until (int): ignore messages sent after this time, if given
+
+    Returns:
+        {
+            messages (list): up to limit message dictionaries
+            end (int): the message_id to pass as before_message_id for the
+                       next page, or -1 if there are no more matches
+        }
+    """
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1 or limit > 50:
+        raise InputError("invalid limit")
+    for bound in (since, until):
+        if bound is not None and (not isinstance(bound, int) or isinstance(bound, bool)):
+            raise InputError("since and until must be integers")
+
+    before = None
+    if before_message_id is not None:
+        if not isinstance(before_message_id, int) or isinstance(before_message_id, bool):
+            raise InputError("before_message_id must be integer")
+        before = store.messages.time_key(before_message_id)
+        if before is None:
+            raise InputError("invalid before_message_id")
+
+    # One more than the page is fetched to tell if there are more
+    page = store.messages.search_page(user_id, query_str, limit + 1, since, until, before)
     return {
-        'messages': return_messages
+        'messages': page[:limit],
+        'end': page[limit - 1]['message_id'] if len(page) > limit else -1
     }
 
 def valid_channel_id(channel_id):
     if not isinstance(channel_id, int) or isinstance(channel_id, bool):
         raise InputError('channel_id must be integer')
 
-    check_channel_id = [channel.channel_id for channel in data.channels]
-    if channel_id not in check_channel_id:
+    channel = store.channels.find(channel_id)
+    if channel is None:
         raise InputError("invalid channel_id")
-    return data.channels[channel_id]
+    return channel
 
 def valid_user_id(u_id):
     if not isinstance(u_id, int) or isinstance(u_id, bool):
         raise InputError('user_id must be integer')
-    check_u_id = [user.u_id for user in data.users]
-    if u_id not in check_u_id:
+    user = store.users.find(u_id)
+    if user is None:
         raise InputError("invalid user_id")
-    return data.users[u_id]
+    return user
 
 
 def valid_email(email):
@@ -166,29 +254,35 @@ def existing_email(email):
     """ Checks if the email is already being used
         Parameters: email(string)
         Return: None    """
-    check_email = [user.email for user in data.users]
-    if email in check_email:
+    if store.users.find_by_email(email) is not None:
         raise InputError("Email already exists and is being used by another user")
 
 def existing_handle(handle_str):
     """ Checks if the handle_str is already being used
         Parameters: handle_str(string)
         Return: None    """
-    check_handle = [user.handle_str for user in data.users]
-    if handle_str in check_handle:
+    if store.users.find_by_handle(handle_str) is not None:
         raise InputError("Handle already exists and is being used by another user")
 
 
 def authenticate_token(token):
 
-    if token not in data.tokens:
+    if not isinstance(token, str):
         raise AccessError("Invalid Token")
-
-    SECRET = 'aaaaaddeeeiiklmmnnnnnorrsy'
-    try:
-        payload = jwt.decode(token, SECRET, algorithms=['HS256'])
-        user_id = payload.get("u_id")
-    except:
+    session = store.sessions.find(token)
+    if session is None:
         raise AccessError("Invalid Token")
 
+    # Only verify the signature the first time a token is seen
+    user_id = data.token_cache.get(token)
+    if user_id is None:
+        SECRET = 'aaaaaddeeeiiklmmnnnnnorrsy'
+        try:
+            payload = jwt.decode(token, SECRET, algorithms=['HS256'])
+            user_id = payload.get("u_id")
+        except:
+            raise AccessError("Invalid Token")
+        data.token_cache.add(token, user_id)
+
+    session.touch()
     return user_id
@@ -112,6 +112,31 @@ def test_search_success(url):
     result = json.loads(resp.text)
     assert result['messages'][0]['message'] == "My time has come."
 
+def test_search_paged_success(url):
+    '''
+    Test that the search path passes on the paging arguments
+    '''
+    requests.delete(url + "clear")
+
+    user1 = register_user(url, "test@test.com")
+    channel = create_channel(url, user1, "channel", True)
+    for text in ["first time", "second time", "third time"]:
+        requests.post(url + "message/send", json = {"token": user1['token'],
+                                                   "channel_id": channel['channel_id'],
+                                                   "message": text})
+
+    result = json.loads(requests.get(url + "search", params = {'token': user1['token'],
+                                                               'query_str': "time",
+                                                               'limit': 2}).text)
+    assert [msg['message'] for msg in result['messages']] == ["third time", "second time"]
+
+    result = json.loads(requests.get(url + "search", params = {'token': user1['token'],
+                                                               'query_str': "time",
+                                                               'limit': 2,
+                                                               'before_message_id': result['end']}).text)
+    assert [msg['message'] for msg in result['messages']] == ["first time"]
+    assert result['end'] == -1
+
 def test_search_failure(url):
     '''
     Test that the search path raises errors correctly
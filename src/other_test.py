@@ -1,15 +1,17 @@
 """ tests for other.py file """
 import pytest
 import copy
+from data import data
 from auth import auth_login, auth_logout, auth_register
 from error import InputError, AccessError
 from expected_data import expected_data5, expected_data6
 from expected_data import expected_data7, expected_data8, expected_data9
 from other import clear, users_all, admin_userpermission_change, valid_channel_id, valid_user_id
+from other import admin_scheduler_details
 from other import valid_email, existing_email, existing_handle, authenticate_token
 from channel import channel_invite, channel_details, channel_messages, channel_leave, channel_join, channel_addowner, channel_removeowner
 from channels import channels_list, channels_listall, channels_create
-from user import user_profile
+from user import user_profile, user_profile_setemail, user_profile_sethandle
 
 ####################### Tests for users_all function #####################
 
@@ -264,6 +266,16 @@ def test_admin_userpermission_change_valid_inputs():
     assert expected_data9['users'][1]['permission_id'] == 1
     assert expected_data9['users'][2]['permission_id'] == 1
 
+####################### Tests for admin_scheduler_details function #####################
+
+def test_admin_scheduler_details():
+    clear()
+    owner = auth_register('owner@gmail.com', 'IJFB73d', 'Johnny', 'Mack')
+    member = auth_register('memeber@mails.com', 'JHFJSDJ083', 'Thomas', 'Dean')
+    assert admin_scheduler_details(owner['token']) == {'queue_depth': 0, 'failed': 0}
+    with pytest.raises(AccessError):
+        admin_scheduler_details(member['token'])
+
 ####################### Tests for helper functions #####################
 ### testing that vaild_channel_id returns channel if it exists
 def test_valid_channel_id_valid_channel():
@@ -339,6 +351,22 @@ def test_existing_email_free():
     k = 3
     assert k == 3
 
+### testing that existing_email ignores case when checking for a taken email
+def test_existing_email_different_case():
+    clear()
+    auth_register('test@test.com', 'password', 'Test', 'Test')
+    with pytest.raises(InputError):
+        existing_email("TEST@test.com")
+
+### testing that existing_email frees the old email once a user changes it
+def test_existing_email_after_setemail():
+    clear()
+    user1 = auth_register('test@test.com', 'password', 'Test', 'Test')
+    user_profile_setemail(user1['token'], 'changed@test.com')
+    existing_email('test@test.com')
+    with pytest.raises(InputError):
+        existing_email('changed@test.com')
+
 ### testing that exiting handle raises an input error if given a handle string that already exists
 def test_existing_handle_exists():
     clear()
@@ -356,6 +384,15 @@ def test_existing_handle_free():
     k = 3
     assert k == 3
 
+### testing that existing_handle frees the old handle once a user changes it
+def test_existing_handle_after_sethandle():
+    clear()
+    user1 = auth_register('test@test.com', 'password', 'Test', 'Test')
+    user_profile_sethandle(user1['token'], 'newhandle')
+    existing_handle('testtest')
+    with pytest.raises(InputError):
+        existing_handle('newhandle')
+
 ### testing that authenticate_token raises an AccessError when the token given is invalid
 def test_authenticate_token_invalid_token():
     clear()
@@ -370,3 +407,25 @@ def test_authenticate_token_valid_token():
     user1 = auth_register('test@test.com', 'password', 'Test', 'Test')
     returned_id = authenticate_token(user1['token'])
     assert returned_id == user1['u_id']
+
+### testing that authenticate_token only verifies a token once and counts cache hits
+def test_authenticate_token_cache_hits_whitebox():
+    clear()
+    user1 = auth_register('test@test.com', 'password', 'Test', 'Test')
+    authenticate_token(user1['token'])
+    authenticate_token(user1['token'])
+    authenticate_token(user1['token'])
+    assert data.token_cache.cache_details() == {'hits': 2, 'misses': 1, 'size': 1}
+
+### testing that logging out and clear remove the token from the cache
+def test_authenticate_token_cache_invalidated_whitebox():
+    clear()
+    user1 = auth_register('test@test.com', 'password', 'Test', 'Test')
+    authenticate_token(user1['token'])
+    auth_logout(user1['token'])
+    assert data.token_cache.cache_details()['size'] == 0
+
+    user2 = auth_login('test@test.com', 'password')
+    authenticate_token(user2['token'])
+    clear()
+    assert data.token_cache.cache_details() == {'hits': 0, 'misses': 0, 'size': 0}
@@ -0,0 +1,291 @@
+""" Runs timed work, such as message_sendlater, on one shared thread
+
+Jobs wait in a heap ordered by due time, so any number of them costs one
+thread plus a heap entry each. Jobs due at the same time run in the order
+they were scheduled.
+
+Recurring jobs, started with every(), are the server's own upkeep such as
+compaction and archiving. They run again each interval until cancelled,
+and clear() leaves them queued: it only drops the work users asked for.
+
+Durable jobs name a handler registered with register() and take JSON
+arguments. They are written to a schedule_log as well, so after
+open_log() on startup the jobs that had not run before the process
+stopped are scheduled again.
+"""
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+
+# Overdue durable jobs found on startup run at most CATCH_UP_BATCH at a
+# time, CATCH_UP_INTERVAL seconds apart, instead of all at once
+CATCH_UP_BATCH = 100
+CATCH_UP_INTERVAL = 1.0
+# The log is rewritten once it holds at least this many finished jobs and
+# they make up more than half of its records
+COMPACT_MIN_DONE = 1024
+
+logger = logging.getLogger(__name__)
+
+class schedule_log:
+    """ Append-only file of durable jobs added and finished, one JSON record per line """
+    def __init__(self, path):
+        self.path = path
+        # job_id -> record of every job added but not finished
+        self.pending = {}
+        self.done = 0
+        self.lock = threading.Lock()
+        self.file = None
+        if os.path.exists(path):
+            with open(path) as log_file:
+                for line in log_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Only the last line can be cut short, by a crash
+                        break
+                    if record['op'] == 'add':
+                        self.pending[record['job']] = record
+                    else:
+                        self.pending.pop(record['job'], None)
+        self.rewrite()
+
+    def add(self, job_id, due, kind, args):
+        record = {'op': 'add', 'job': job_id, 'due': due, 'kind': kind, 'args': list(args)}
+        with self.lock:
+            self.pending[job_id] = record
+            self.write(record)
+
+    def finish(self, job_id):
+        with self.lock:
+            if self.pending.pop(job_id, None) is None:
+                return
+            self.write({'op': 'done', 'job': job_id})
+            self.done += 1
+            if self.done >= COMPACT_MIN_DONE and self.done > len(self.pending):
+                self.rewrite()
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def rewrite(self):
+        """ Replaces the log with just the pending jobs """
+        if self.file is not None:
+            self.file.close()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as temp_file:
+            for record in self.pending.values():
+                temp_file.write(json.dumps(record) + '\n')
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, self.path)
+        self.file = open(self.path, 'a')
+        self.done = 0
+
+    def clear(self):
+        with self.lock:
+            self.pending.clear()
+            self.rewrite()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class scheduler:
+    def __init__(self):
+        # (due, job_id) of every job, cancelled ones are skipped when popped
+        self.heap = []
+        # job_id -> (callback, args) of the jobs still to run
+        self.jobs = {}
+        self.next_job_id = 0
+        # job_id -> interval of every recurring job, see every
+        self.recurring = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        # kind -> callback of the handlers durable jobs can name
+        self.handlers = {}
+        self.log = None
+        # Jobs that raised, each is logged with its traceback
+        self.failed = 0
+
+    def schedule(self, due, callback, args=()):
+        """
+        Runs callback(*args) on the scheduler thread once due has passed
+
+        Parameters:
+            due (float): the UNIX time to run the job at
+            callback (function): the work to do
+            args (tuple): passed on to callback
+
+        Returns:
+            job_id (int): used to cancel the job
+        """
+        with self.condition:
+            job_id = self.next_job_id
+            self.next_job_id += 1
+            self.push(job_id, due, callback, args)
+        return job_id
+
+    def every(self, interval, callback):
+        """
+        Runs callback() on the scheduler thread every interval seconds,
+        starting interval seconds from now, until the job is cancelled
+
+        Parameters:
+            interval (float): seconds between runs
+            callback (function): the work to do
+
+        Returns:
+            job_id (int): used to cancel the job
+        """
+        with self.condition:
+            job_id = self.next_job_id
+            self.next_job_id += 1
+            self.recurring[job_id] = interval
+            self.push(job_id, time.time() + interval, callback, ())
+        return job_id
+
+    def push(self, job_id, due, callback, args):
+        """ Queues a job, the caller must hold self.condition """
+        self.jobs[job_id] = (callback, tuple(args))
+        heapq.heappush(self.heap, (due, job_id))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        # Wake the thread in case this job is due before the one it waits for
+        self.condition.notify()
+
+    def register(self, kind, callback):
+        """ Names a callback so durable jobs can refer to it """
+        self.handlers[kind] = callback
+
+    def schedule_durable(self, due, kind, args=()):
+        """
+        Like schedule, but the job is also written to the schedule log,
+        if one is open, so it survives a restart
+
+        Parameters:
+            due (float): the UNIX time to run the job at
+            kind (str): the name of a handler given to register
+            args (tuple): JSON values passed on to the handler
+
+        Returns:
+            job_id (int): used to cancel the job
+        """
+        with self.condition:
+            job_id = self.next_job_id
+            self.next_job_id += 1
+        # Logged before it is queued, so it can't finish before it is added
+        if self.log is not None:
+            self.log.add(job_id, due, kind, args)
+        with self.condition:
+            self.push(job_id, due, self.run_durable, (job_id, kind, args))
+        return job_id
+
+    def run_durable(self, job_id, kind, args):
+        try:
+            self.handlers[kind](*args)
+        finally:
+            if self.log is not None:
+                self.log.finish(job_id)
+
+    def open_log(self, path):
+        """
+        Starts writing durable jobs to the log at path, and schedules again
+        the jobs in it that had not run. Overdue jobs are spread out in
+        batches of CATCH_UP_BATCH so a long outage does not flood the server
+
+        Parameters:
+            path (str): the schedule log file, created if missing
+
+        Returns:
+            replayed (int): the number of jobs scheduled again
+        """
+        log = schedule_log(path)
+        records = sorted(log.pending.values(), key=lambda record: (record['due'], record['job']))
+        now = time.time()
+        with self.condition:
+            self.log = log
+            self.next_job_id = max([self.next_job_id] + [record['job'] + 1 for record in records])
+            overdue = 0
+            for record in records:
+                due = record['due']
+                if due <= now:
+                    due = now + (overdue // CATCH_UP_BATCH) * CATCH_UP_INTERVAL
+                    overdue += 1
+                self.push(record['job'], due, self.run_durable,
+                          (record['job'], record['kind'], tuple(record['args'])))
+        return len(records)
+
+    def close_log(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def cancel(self, job_id):
+        """ Stops a job from running, returns False if it already ran or was cancelled """
+        with self.condition:
+            cancelled = self.jobs.pop(job_id, None) is not None
+            cancelled = self.recurring.pop(job_id, None) is not None or cancelled
+        if cancelled and self.log is not None:
+            self.log.finish(job_id)
+        return cancelled
+
+    def queue_depth(self):
+        """ The number of jobs waiting to run """
+        with self.condition:
+            return len(self.jobs)
+
+    def scheduler_details(self):
+        with self.condition:
+            return {
+                'queue_depth': len(self.jobs),
+                'failed': self.failed
+            }
+
+    def clear(self):
+        """ Drops every job but the recurring ones """
+        with self.condition:
+            self.jobs = {job_id: job for job_id, job in self.jobs.items()
+                         if job_id in self.recurring}
+            self.heap = [entry for entry in self.heap if entry[1] in self.recurring]
+            heapq.heapify(self.heap)
+            self.failed = 0
+        if self.log is not None:
+            self.log.clear()
+
+    def run(self):
+        while True:
+            with self.condition:
+                job = None
+                while job is None:
+                    # Drop cancelled jobs from the front of the heap
+                    while self.heap and self.heap[0][1] not in self.jobs:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    due, job_id = self.heap[0]
+                    delay = due - time.time()
+                    if delay > 0:
+                        self.condition.wait(delay)
+                        continue
+                    heapq.heappop(self.heap)
+                    job = self.jobs.pop(job_id)
+
+            callback, args = job
+            try:
+                callback(*args)
+            except Exception:
+                # One failed job must not stop the ones after it
+                with self.condition:
+                    self.failed += 1
+                logger.exception('scheduled job %d failed', job_id)
+            with self.condition:
+                if job_id in self.recurring:
+                    self.push(job_id, time.time() + self.recurring[job_id], callback, args)
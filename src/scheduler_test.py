@@ -0,0 +1,131 @@
+""" Tests for scheduler.py """
+import threading
+import time
+from scheduler import scheduler
+
+def test_jobs_run_in_due_order():
+    jobs = scheduler()
+    ran = []
+    done = threading.Event()
+    now = time.time()
+    jobs.schedule(now + 0.2, ran.append, ('third',))
+    jobs.schedule(now + 0.1, ran.append, ('first',))
+    jobs.schedule(now + 0.1, ran.append, ('second',))
+    jobs.schedule(now + 0.3, done.set)
+    assert jobs.queue_depth() == 4
+    assert done.wait(2)
+    assert ran == ['first', 'second', 'third']
+    assert jobs.queue_depth() == 0
+
+def test_cancel():
+    jobs = scheduler()
+    ran = []
+    done = threading.Event()
+    now = time.time()
+    job_id = jobs.schedule(now + 0.1, ran.append, ('cancelled',))
+    jobs.schedule(now + 0.2, done.set)
+    assert jobs.cancel(job_id)
+    assert not jobs.cancel(job_id)
+    assert jobs.queue_depth() == 1
+    assert done.wait(2)
+    assert ran == []
+
+def test_failed_job_does_not_stop_the_thread():
+    jobs = scheduler()
+    done = threading.Event()
+    now = time.time()
+    jobs.schedule(now, int, ('not a number',))
+    jobs.schedule(now, done.set)
+    assert done.wait(2)
+
+def test_many_jobs_share_one_thread():
+    jobs = scheduler()
+    threads = threading.active_count()
+    for i in range(10000):
+        jobs.schedule(time.time() + 3600 + i, print)
+    assert jobs.queue_depth() == 10000
+    assert threading.active_count() <= threads + 1
+    jobs.clear()
+    assert jobs.queue_depth() == 0
+
+def test_durable_jobs_replayed_after_restart(tmp_path):
+    path = str(tmp_path / 'schedule.log')
+    before = scheduler()
+    before.register('record', print)
+    before.open_log(path)
+    now = time.time()
+    kept = before.schedule_durable(now + 3600, 'record', ('later',))
+    cancelled = before.schedule_durable(now + 3600, 'record', ('cancelled',))
+    before.cancel(cancelled)
+    before.close_log()
+
+    after = scheduler()
+    ran = []
+    after.register('record', ran.append)
+    assert after.open_log(path) == 1
+    assert after.queue_depth() == 1
+    # New jobs do not reuse the ids of replayed ones
+    assert after.schedule_durable(now + 3600, 'record', ('new',)) > kept
+    after.clear()
+    after.close_log()
+
+def test_overdue_jobs_caught_up_in_batches(tmp_path, monkeypatch):
+    path = str(tmp_path / 'schedule.log')
+    before = scheduler()
+    before.open_log(path)
+    for i in range(5):
+        before.log.add(i, time.time() - 60, 'record', [i])
+    before.close_log()
+    # Simulate a crash part way through writing a record
+    with open(path, 'a') as log_file:
+        log_file.write('{"op": "add", "jo')
+
+    monkeypatch.setattr('scheduler.CATCH_UP_BATCH', 2)
+    monkeypatch.setattr('scheduler.CATCH_UP_INTERVAL', 0.3)
+    after = scheduler()
+    ran = []
+    after.register('record', ran.append)
+    assert after.open_log(path) == 5
+    time.sleep(0.15)
+    assert ran == [0, 1]
+    time.sleep(0.6)
+    assert ran == [0, 1, 2, 3, 4]
+    after.close_log()
+
+    # Finished jobs are not replayed again
+    again = scheduler()
+    assert again.open_log(path) == 0
+    again.close_log()
+
+def test_failed_job_is_logged_and_counted(caplog):
+    jobs = scheduler()
+    done = threading.Event()
+    now = time.time()
+    jobs.schedule(now, int, ('not a number',))
+    jobs.schedule(now, done.set)
+    assert done.wait(2)
+    assert jobs.scheduler_details() == {'queue_depth': 0, 'failed': 1}
+    assert 'scheduled job 0 failed' in caplog.text
+    assert 'ValueError' in caplog.text
+
+def test_recurring_jobs_survive_clear():
+    jobs = scheduler()
+    runs = []
+    twice = threading.Event()
+    def tick():
+        runs.append(time.time())
+        if len(runs) == 2:
+            twice.set()
+    job_id = jobs.every(0.05, tick)
+    jobs.schedule(time.time() + 60, runs.append, ('user job',))
+    assert jobs.queue_depth() == 2
+    jobs.clear()
+    assert jobs.queue_depth() == 1
+    assert twice.wait(2)
+    assert jobs.cancel(job_id)
+    # A run already under way may still finish, but none start after it
+    time.sleep(0.1)
+    ran = len(runs)
+    time.sleep(0.1)
+    assert len(runs) == ran
+    assert jobs.queue_depth() == 0
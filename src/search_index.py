@@ -0,0 +1,289 @@
+""" Incremental inverted indexes over message text, used by other.search """
+import heapq
+import re
+import threading
+from bisect import bisect_left, bisect_right, insort
+
+WORD = re.compile(r'\w+')
+EMPTY = frozenset()
+# Length of the character n-grams indexed for substring search
+GRAM = 3
+# The most removed messages kept as search cursors, across all channels.
+# The oldest are forgotten first, as data.REMOVED_SEQS_MAX does per channel
+REMOVED_TIMES_MAX = 64 * 1024
+
+def tokenise(text):
+    """
+    Splits text into lower case words
+
+    Parameters:
+        text (str): the text to split
+
+    Returns:
+        terms (set): the distinct words in text
+    """
+    return {word.lower() for word in WORD.findall(text)}
+
+def trigrams(text):
+    """
+    Splits text into every run of GRAM consecutive characters
+
+    Parameters:
+        text (str): the text to split
+
+    Returns:
+        grams (set): the distinct trigrams in text, case preserved
+    """
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+def whole_words(query_str):
+    """
+    Finds the words in a query that must appear as complete words in any message
+    containing the query. A word touching either end of the query may be part of
+    a longer word in the message, so only words with a non-word character on
+    both sides inside the query count.
+
+    Parameters:
+        query_str (str): the string being searched for
+
+    Returns:
+        terms (set): lower case words that every match must contain
+    """
+    terms = set()
+    for word in WORD.finditer(query_str):
+        if word.start() > 0 and word.end() < len(query_str):
+            terms.add(word.group().lower())
+    return terms
+
+class search_index:
+    def __init__(self, source=None):
+        # term -> channel_id -> set of message_ids in that channel whose text
+        # contains that word, so a search only reads the searcher's channels
+        self.postings = {}
+        # trigram -> channel_id -> set of message_ids in that channel whose
+        # text contains that trigram
+        self.gram_postings = {}
+        # channel_id -> (time_created, message_id) of the channel's messages
+        # sorted oldest first. Removed messages are dropped from message_times
+        # straight away and from times in batches, so entries not in
+        # message_times are stale
+        self.times = {}
+        self.message_times = {}
+        # channel_id -> the number of stale entries in its times
+        self.stale_times = {}
+        # time_created of the latest REMOVED_TIMES_MAX removed messages, so
+        # they still work as cursors, oldest removed first
+        self.removed_times = {}
+        # Channels left out of the index by defer, each is indexed from
+        # source(channel_id), which yields the tuples add_many takes, the
+        # first time a search looks at it
+        self.source = source
+        self.deferred = set()
+        # Searches run side by side, this keeps two from indexing one channel
+        self.build_lock = threading.Lock()
+
+    def defer(self, channel_id):
+        """ Leaves channel_id out of the index until a search needs it """
+        self.deferred.add(channel_id)
+
+    def build(self, channel_ids):
+        """ Indexes whichever of channel_ids were deferred """
+        if self.deferred.isdisjoint(channel_ids):
+            return
+        with self.build_lock:
+            for channel_id in [channel_id for channel_id in channel_ids
+                               if channel_id in self.deferred]:
+                self.add_many(self.source(channel_id))
+                self.deferred.discard(channel_id)
+
+    def add(self, channel_id, message_id, text, time_created):
+        # A deferred channel is read as it is once it is indexed
+        if channel_id in self.deferred:
+            return
+        add_channel_postings(self.postings, tokenise(text), channel_id, message_id)
+        add_channel_postings(self.gram_postings, trigrams(text), channel_id, message_id)
+        insort(self.times.setdefault(channel_id, []), (time_created, message_id))
+        self.message_times[message_id] = time_created
+
+    def add_many(self, messages):
+        """
+        Adds many messages at once, sorting the time index once at the end
+        rather than inserting into it message by message
+
+        Parameters:
+            messages (iterable): (channel_id, message_id, text, time_created) tuples
+        """
+        added_to = set()
+        for channel_id, message_id, text, time_created in messages:
+            add_channel_postings(self.postings, tokenise(text), channel_id, message_id)
+            add_channel_postings(self.gram_postings, trigrams(text), channel_id, message_id)
+            self.times.setdefault(channel_id, []).append((time_created, message_id))
+            self.message_times[message_id] = time_created
+            added_to.add(channel_id)
+        for channel_id in added_to:
+            self.times[channel_id].sort()
+
+    def remove(self, channel_id, message_id, text, time_created=None):
+        """
+        Drops a removed message, remembering its time so it still works as
+        a cursor. time_created is only needed for messages not in the index,
+        such as archived ones
+        """
+        indexed_time = self.discard(channel_id, message_id, text)
+        if indexed_time is not None:
+            time_created = indexed_time
+        if time_created is not None:
+            self.removed_times[message_id] = time_created
+            if len(self.removed_times) > REMOVED_TIMES_MAX:
+                del self.removed_times[next(iter(self.removed_times))]
+
+    def discard(self, channel_id, message_id, text):
+        """
+        Drops a message from the index without remembering it, for messages
+        kept out of it such as archived ones
+
+        Returns:
+            time_created (int): the message's time, or None if it was not indexed
+        """
+        if message_id not in self.message_times:
+            return None
+        remove_channel_postings(self.postings, tokenise(text), channel_id, message_id)
+        remove_channel_postings(self.gram_postings, trigrams(text), channel_id, message_id)
+        time_created = self.message_times.pop(message_id)
+        stale = self.stale_times.get(channel_id, 0) + 1
+        times = self.times[channel_id]
+        if stale >= 64 and stale * 2 > len(times):
+            self.times[channel_id] = [entry for entry in times if entry[1] in self.message_times]
+            stale = 0
+        self.stale_times[channel_id] = stale
+        return time_created
+
+    def update(self, channel_id, message_id, old_text, new_text):
+        # Deferred channels are read as they are once indexed, archived
+        # messages are searched in the archive
+        if message_id not in self.message_times:
+            return
+        remove_channel_postings(self.postings, tokenise(old_text), channel_id, message_id)
+        remove_channel_postings(self.gram_postings, trigrams(old_text), channel_id, message_id)
+        add_channel_postings(self.postings, tokenise(new_text), channel_id, message_id)
+        add_channel_postings(self.gram_postings, trigrams(new_text), channel_id, message_id)
+
+    def time_key(self, message_id):
+        """ The (time_created, message_id) sort key of a live or removed message, or None """
+        time_created = self.message_times.get(message_id, self.removed_times.get(message_id))
+        if time_created is None:
+            return None
+        return (time_created, message_id)
+
+    def newest_first(self, query_str, channel_ids, since=None, until=None, before=None,
+                     also=()):
+        """
+        Yields the ids of messages that may contain query_str, newest first,
+        so a caller wanting one page only has to look at the front
+
+        Parameters:
+            query_str (str): the string being searched for
+            channel_ids (iterable): the channels to search
+            since (int): if given, skip messages created before this time
+            until (int): if given, skip messages created after this time
+            before (tuple): if given, only yield messages whose
+                            (time_created, message_id) is below this key
+            also (iterable): (time_created, message_id) of messages kept out
+                             of the index, such as archived matches, to yield
+                             in order with the rest
+
+        Returns:
+            message_ids (generator): candidate message ids
+        """
+        upper = (float('inf'), 0) if until is None else (until, float('inf'))
+        if before is not None:
+            upper = min(upper, before)
+        lower = (float('-inf'), 0) if since is None else (since, float('-inf'))
+        also = sorted((key for key in also if lower <= key < upper), reverse=True)
+
+        self.build(channel_ids)
+        candidates = self.candidates(query_str, channel_ids)
+        if candidates is not None:
+            # Few enough to sort directly
+            keys = [(self.message_times[message_id], message_id) for message_id in candidates]
+            keys = [key for key in keys if lower <= key < upper] + also
+            keys.sort(reverse=True)
+            for _, message_id in keys:
+                yield message_id
+            return
+
+        # Otherwise walk each channel's time index back from the upper bound,
+        # merging them into one newest first order
+        walks = [self.walk_back(self.times[channel_id], lower, upper)
+                 for channel_id in channel_ids if channel_id in self.times]
+        for _, message_id in heapq.merge(also, *walks, reverse=True):
+            yield message_id
+
+    def walk_back(self, times, lower, upper):
+        """ Yields the live keys in one channel's times from upper down to lower """
+        position = bisect_left(times, upper) - 1
+        first = bisect_right(times, lower)
+        while position >= first:
+            time_created, message_id = times[position]
+            if self.message_times.get(message_id) == time_created:
+                yield times[position]
+            position -= 1
+
+    def candidates(self, query_str, channel_ids):
+        """
+        Narrows a substring search down to the messages that could match
+
+        Parameters:
+            query_str (str): the string being searched for
+            channel_ids (iterable): the channels to search
+
+        Returns:
+            message_ids (set): a superset of the ids of messages in those
+                               channels containing query_str, or None if the
+                               index cannot narrow the search and every
+                               message must be checked
+        """
+        self.build(channel_ids)
+        # Every trigram of the query must appear in a match, and so must every
+        # whole word. Queries shorter than a trigram with no whole words can't
+        # be narrowed down
+        keys = [self.gram_postings.get(gram, {}) for gram in trigrams(query_str)]
+        keys += [self.postings.get(term, {}) for term in whole_words(query_str)]
+        if not keys:
+            return None
+        matches = set()
+        for channel_id in channel_ids:
+            postings = [by_channel.get(channel_id, EMPTY) for by_channel in keys]
+            # Intersect starting from the shortest posting list
+            postings.sort(key=len)
+            matches |= postings[0].intersection(*postings[1:])
+        return matches
+
+    def clear(self):
+        self.postings.clear()
+        self.gram_postings.clear()
+        self.times.clear()
+        self.message_times.clear()
+        self.stale_times.clear()
+        self.removed_times.clear()
+        self.deferred.clear()
+
+def add_channel_postings(index, keys, channel_id, message_id):
+    for key in keys:
+        index.setdefault(key, {}).setdefault(channel_id, set()).add(message_id)
+
+def remove_channel_postings(index, keys, channel_id, message_id):
+    for key in keys:
+        by_channel = index.get(key)
+        if by_channel is not None:
+            remove_postings(by_channel, (channel_id,), message_id)
+            if not by_channel:
+                del index[key]
+
+def remove_postings(index, keys, message_id):
+    for key in keys:
+        posting = index.get(key)
+        if posting is not None:
+            posting.discard(message_id)
+            if not posting:
+                del index[key]
@@ -0,0 +1,102 @@
+""" Tests for search_index.py """
+from search_index import search_index, tokenise, trigrams, whole_words
+
+def test_tokenise():
+    assert tokenise("Hello, hello world!") == {'hello', 'world'}
+
+def test_whole_words_ignores_words_at_the_edges():
+    assert whole_words("lo wor") == set()
+    assert whole_words("lo big wor") == {'big'}
+    assert whole_words(" Big ") == {'big'}
+
+def test_candidates():
+    index = search_index()
+    index.add(0, 0, "the quick brown fox", 100)
+    index.add(0, 1, "the slow brown dog", 101)
+    index.add(0, 2, "a quick red fox", 102)
+    assert index.candidates("he quick br", [0]) == {0}
+    assert index.candidates("he quick brown f", [0]) == {0}
+    assert index.candidates("w brown d", [0]) == {1}
+    assert index.candidates("qu", [0]) is None
+
+def test_candidates_only_in_given_channels():
+    index = search_index()
+    index.add(0, 0, "the quick brown fox", 100)
+    index.add(1, 1, "the quick brown dog", 101)
+    index.add(2, 2, "the quick red fox", 102)
+    assert index.candidates(" quick ", [0, 2]) == {0, 2}
+    assert index.candidates(" quick ", [1]) == {1}
+    assert index.candidates(" quick ", [3]) == set()
+    assert index.candidates(" quick ", []) == set()
+
+def test_trigrams():
+    assert trigrams("abcd") == {'abc', 'bcd'}
+    assert trigrams("ab") == set()
+
+def test_candidates_substring_of_a_word():
+    index = search_index()
+    index.add(0, 0, "pineapple", 100)
+    index.add(0, 1, "apple pie", 101)
+    index.add(0, 2, "Apple", 102)
+    assert index.candidates("apple", [0]) == {0, 1}
+    assert index.candidates("neap", [0]) == {0}
+    assert index.candidates("xyz", [0]) == set()
+
+def test_update_and_remove():
+    index = search_index()
+    index.add(0, 0, "the quick brown fox", 100)
+    index.update(0, 0, "the quick brown fox", "the lazy dog")
+    assert index.candidates(" quick ", [0]) == set()
+    assert index.candidates(" lazy ", [0]) == {0}
+    index.remove(0, 0, "the lazy dog")
+    assert index.postings == {}
+    assert index.gram_postings == {}
+
+def test_remove_forgets_old_cursors(monkeypatch):
+    monkeypatch.setattr('search_index.REMOVED_TIMES_MAX', 2)
+    index = search_index()
+    for message_id in range(4):
+        index.add(0, message_id, "hello", 100 + message_id)
+    for message_id in range(3):
+        index.remove(0, message_id, "hello")
+    assert index.time_key(0) is None
+    assert index.time_key(1) == (101, 1)
+    assert index.time_key(2) == (102, 2)
+    assert index.time_key(3) == (103, 3)
+
+def test_newest_first_with_bounds():
+    index = search_index()
+    index.add(0, 0, "hello there", 100)
+    index.add(0, 1, "hello again", 200)
+    index.add(0, 3, "hello later", 300)
+    index.add(0, 2, "hello sooner", 250)
+    index.add(0, 4, "goodbye", 400)
+    assert list(index.newest_first("hello", [0])) == [3, 2, 1, 0]
+    assert list(index.newest_first("he", [0])) == [4, 3, 2, 1, 0]
+    assert list(index.newest_first("hello", [0], since=200, until=250)) == [2, 1]
+    assert list(index.newest_first("he", [0], before=index.time_key(2))) == [1, 0]
+
+    index.remove(0, 2, "hello sooner")
+    assert list(index.newest_first("he", [0])) == [4, 3, 1, 0]
+    assert list(index.newest_first("hello", [0], before=index.time_key(2))) == [1, 0]
+
+def test_add_many_matches_add():
+    messages = [(0, 0, "hello there", 300), (1, 1, "hello again", 100), (0, 2, "goodbye", 200)]
+    one_by_one = search_index()
+    for channel_id, message_id, text, time_created in messages:
+        one_by_one.add(channel_id, message_id, text, time_created)
+    at_once = search_index()
+    at_once.add_many(messages)
+    assert at_once.postings == one_by_one.postings
+    assert at_once.gram_postings == one_by_one.gram_postings
+    assert at_once.times == one_by_one.times
+    assert list(at_once.newest_first("he", [0, 1])) == [0, 2, 1]
+
+def test_newest_first_only_in_given_channels():
+    index = search_index()
+    for message_id in range(6):
+        index.add(message_id % 3, message_id, "hello " + str(message_id), 100 + message_id)
+    assert list(index.newest_first("he", [0, 2])) == [5, 3, 2, 0]
+    assert list(index.newest_first("hello", [0, 2])) == [5, 3, 2, 0]
+    assert list(index.newest_first("he", [1], until=103)) == [1]
+    assert list(index.newest_first("he", [3])) == []
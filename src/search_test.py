@@ -4,9 +4,12 @@ from auth import auth_register, auth_login
 from channel import channel_invite, channel_join, channel_addowner
 from channels import channels_create
 from message import message_send, message_remove, message_edit
-from error import AccessError
+from error import AccessError, InputError
 from datetime import timezone, datetime
 from other import search, clear
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import other
+import storage
 
 import pytest
 
@@ -306,3 +309,161 @@ def test_search_user_not_in_channel():
         'reacts': [],
         'is_pinned': False
         }]
+
+def test_search_multiple_words_uses_index():
+    """
+    Tests that a query spanning several words still only returns messages that
+    contain the whole query, in channel order
+    """
+    clear()
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    channel1 = channels_create(user['token'], "channel1", True)
+    channel2 = channels_create(user['token'], "channel2", True)
+
+    message_send(user['token'], channel2['channel_id'], "the quick brown fox")
+    message_send(user['token'], channel1['channel_id'], "a quick brown dog")
+    message_send(user['token'], channel1['channel_id'], "brown quick fox")
+    message_send(user['token'], channel1['channel_id'], "Quick Brown cow")
+
+    result = search(user['token'], "e quick brown ")
+    assert [msg['message'] for msg in result['messages']] == ["the quick brown fox"]
+
+    result = search(user['token'], "k brown ")
+    assert [msg['message'] for msg in result['messages']] == ["a quick brown dog", "the quick brown fox"]
+
+def test_search_multiple_words_after_edit_and_remove():
+    """
+    Tests that edited and removed messages are searched by their current text
+    """
+    clear()
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    channel = channels_create(user['token'], "channel", True)
+    msg1 = message_send(user['token'], channel['channel_id'], "see you at lunch today")
+    msg2 = message_send(user['token'], channel['channel_id'], "see you at dinner today")
+    message_edit(user['token'], msg1['message_id'], "see you at breakfast today")
+    message_remove(user['token'], msg2['message_id'])
+
+    assert search(user['token'], "you at lunch ")['messages'] == []
+    assert search(user['token'], "you at dinner ")['messages'] == []
+    result = search(user['token'], "you at breakfast ")
+    assert [msg['message_id'] for msg in result['messages']] == [msg1['message_id']]
+
+def test_search_paged_newest_first():
+    """
+    Tests that a limited search returns the newest matches first, a page at a time
+    """
+    clear()
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    channel1 = channels_create(user['token'], "channel1", True)
+    channel2 = channels_create(user['token'], "channel2", True)
+    msg_ids = []
+    for i in range(5):
+        channel = channel1 if i % 2 == 0 else channel2
+        msg_ids.append(message_send(user['token'], channel['channel_id'], "message " + str(i))['message_id'])
+    message_send(user['token'], channel1['channel_id'], "unrelated")
+
+    result = search(user['token'], "message", limit=2)
+    assert [msg['message_id'] for msg in result['messages']] == [msg_ids[4], msg_ids[3]]
+    assert result['end'] == msg_ids[3]
+
+    result = search(user['token'], "message", limit=2, before_message_id=result['end'])
+    assert [msg['message_id'] for msg in result['messages']] == [msg_ids[2], msg_ids[1]]
+
+    result = search(user['token'], "message", limit=2, before_message_id=result['end'])
+    assert [msg['message_id'] for msg in result['messages']] == [msg_ids[0]]
+    assert result['end'] == -1
+
+def test_search_time_bounds():
+    """
+    Tests that since and until only keep messages sent in that window
+    """
+    clear()
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    channel = channels_create(user['token'], "channel", True)
+    msg_ids = [message_send(user['token'], channel['channel_id'], "message " + str(i))['message_id']
+               for i in range(3)]
+    # Spread the messages out in time
+    for time_created, msg_id in zip([1000, 2000, 3000], msg_ids):
+        text = data.find_message(msg_id)[1].message
+        data.search_index.remove(channel['channel_id'], msg_id, text)
+        data.search_index.add(channel['channel_id'], msg_id, text, time_created)
+
+    result = search(user['token'], "mess", since=1500, until=3000)
+    assert [msg['message_id'] for msg in result['messages']] == [msg_ids[2], msg_ids[1]]
+    result = search(user['token'], "e", until=1999)
+    assert [msg['message_id'] for msg in result['messages']] == [msg_ids[0]]
+
+def test_search_paged_invalid_inputs():
+    clear()
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    with pytest.raises(InputError):
+        search(user['token'], "message", limit=0)
+    with pytest.raises(InputError):
+        search(user['token'], "message", before_message_id=42)
+    with pytest.raises(InputError):
+        search(user['token'], "message", since="yesterday")
+
+@pytest.mark.parametrize('make_executor', [ThreadPoolExecutor, ProcessPoolExecutor])
+def test_search_sharded_matches_sequential(monkeypatch, make_executor):
+    """
+    Tests that spreading an unindexed search over workers gives the same
+    messages in the same order as searching one channel at a time
+    """
+    clear()
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    other_user = auth_register("other@test.com", "password", "firstName", "lastName")
+    channel1 = channels_create(user['token'], "channel1", True)
+    channel2 = channels_create(user['token'], "channel2", True)
+    hidden = channels_create(other_user['token'], "hidden", True)
+    for i in range(7):
+        message_send(user['token'], channel2['channel_id'], "xy " + str(i))
+        message_send(user['token'], channel1['channel_id'], "yx " + str(i))
+        message_send(other_user['token'], hidden['channel_id'], "xy hidden")
+    removed = message_send(user['token'], channel1['channel_id'], "xy removed")
+    message_remove(user['token'], removed['message_id'])
+
+    expected = search(user['token'], "xy")
+    assert len(expected['messages']) == 7
+
+    monkeypatch.setattr(storage, 'SEARCH_SHARD_SIZE', 3)
+    with make_executor(max_workers=2) as executor:
+        monkeypatch.setattr(data, 'search_executor', executor)
+        assert other.search_messages(user['u_id'], "xy") == expected['messages']
+        assert len(other.search_messages(user['u_id'], "x")) == 14
+
+def test_search_cache_hits_and_invalidation():
+    """
+    Tests that a repeated search is answered from the cache, and that the
+    cache is skipped once a relevant channel or the user's membership changes
+    """
+    clear()
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    other_user = auth_register("other@test.com", "password", "firstName", "lastName")
+    channel = channels_create(user['token'], "channel", True)
+    elsewhere = channels_create(other_user['token'], "elsewhere", True)
+    msg = message_send(user['token'], channel['channel_id'], "hello world")
+
+    first = search(user['token'], "hello")
+    assert search(user['token'], "hello") == first
+    assert data.search_cache.cache_details() == {'hits': 1, 'misses': 1, 'size': 1}
+
+    # A channel the user is not in does not matter
+    message_send(other_user['token'], elsewhere['channel_id'], "hello there")
+    search(user['token'], "hello")
+    assert data.search_cache.cache_details()['hits'] == 2
+
+    # Sends, edits and removes in the user's channels do
+    message_send(user['token'], channel['channel_id'], "hello again")
+    assert len(search(user['token'], "hello")['messages']) == 2
+    message_edit(user['token'], msg['message_id'], "goodbye world")
+    assert len(search(user['token'], "hello")['messages']) == 1
+    message_remove(user['token'], msg['message_id'])
+    assert len(search(user['token'], "world")['messages']) == 0
+
+    # So does joining a channel
+    channel_join(user['token'], elsewhere['channel_id'])
+    assert len(search(user['token'], "hello")['messages']) == 2
+    assert data.search_cache.cache_details()['hits'] == 2
+
+    clear()
+    assert data.search_cache.cache_details() == {'hits': 0, 'misses': 0, 'size': 0}
@@ -1,4 +1,9 @@
+import logging
+import multiprocessing
+import os
+import signal
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from json import dumps
 from flask import Flask, request, send_from_directory
 from flask_cors import CORS
@@ -7,15 +12,32 @@ from error import InputError, AccessError
 # import all the functions
 from auth import auth_register, auth_logout, auth_login
 from auth import auth_passwordreset_reset,  auth_passwordreset_request
-from channel import channel_invite, channel_details, channel_messages
+from channel import channel_invite, channel_details, channel_messages, channel_messages_cursor
+from channel import channel_pins, channel_messages_between
 from channel import channel_leave, channel_join, channel_addowner, channel_removeowner
 from channels import channels_create, channels_list, channels_listall
-from message import message_send, message_remove, message_edit, message_sendlater, message_react, message_unreact, message_pin, message_unpin
+from message import message_send, message_remove, message_edit, message_sendlater, message_sendlater_cancel, message_react, message_unreact, message_pin, message_unpin
 from user import user_profile
 from user import user_profile_setname, user_profile_setemail
 from user import user_profile_sethandle, user_profile_uploadphoto
-from other import clear, users_all, admin_userpermission_change, search
+from other import clear, users_all, admin_userpermission_change, admin_scheduler_details, search
 from standup import standup_start, standup_send, standup_active
+from data import data as data_store, start_compacting
+from snapshot import load_snapshot, save_snapshot, start_snapshots
+from wal import write_ahead_log, replay
+from sqlite_store import sqlite_store, sqlite_engine
+from storage import store
+from archive import message_archive, tiered_history, start_archiving
+from message_store import message_columns
+
+# Seconds between snapshots when the server keeps its state in a directory
+SNAPSHOT_INTERVAL = 300
+# Seconds between moving older messages out to the archive file
+ARCHIVE_INTERVAL = 60
+# Seconds between dropping removed messages from channel histories
+COMPACT_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
 
 def defaultHandler(err):
     response = err.get_response()
@@ -34,6 +56,29 @@ CORS(APP)
 APP.config['TRAP_HTTP_EXCEPTIONS'] = True
 APP.register_error_handler(Exception, defaultHandler)
 
+# Requests that only read the store run side by side, any other request has
+# the store to itself, so neither readers nor snapshots see one half done.
+# Once the lock is released, each request waits for its write-ahead log
+# records to reach the disk before it is answered, and requests waiting
+# together share one fsync
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+@APP.before_request
+def lock_store():
+    if request.method in READ_METHODS:
+        data_store.lock.acquire_read()
+    else:
+        data_store.lock.acquire()
+
+@APP.teardown_request
+def unlock_store(error):
+    if request.method in READ_METHODS:
+        data_store.lock.release_read()
+    else:
+        data_store.lock.release()
+    if data_store.wal is not None:
+        data_store.wal.wait_for_thread()
+
 # Example
 @APP.route("/echo", methods=['GET'])
 def echo():
@@ -100,7 +145,38 @@ def messages_channel():
     token = request.args.get('token')
     channel_id = request.args.get('channel_id')
     start = request.args.get('start')
-    return_dict = channel_messages(token, int(channel_id), int(start))
+    before_message_id = request.args.get('before_message_id')
+    after_message_id = request.args.get('after_message_id')
+    limit = request.args.get('limit')
+    # Page by cursor if any cursor argument is given, otherwise by start
+    if before_message_id is None and after_message_id is None and limit is None:
+        return_dict = channel_messages(token, int(channel_id), int(start))
+    else:
+        return_dict = channel_messages_cursor(token, int(channel_id),
+            None if before_message_id is None else int(before_message_id),
+            None if after_message_id is None else int(after_message_id),
+            50 if limit is None else int(limit))
+    return dumps(return_dict)
+
+
+@APP.route("/channel/pins", methods=['GET'])
+def pins_channel():
+    token = request.args.get('token')
+    channel_id = request.args.get('channel_id')
+    return_dict = channel_pins(token, int(channel_id))
+    return dumps(return_dict)
+
+
+@APP.route("/channel/messages/between", methods=['GET'])
+def messages_between_channel():
+    token = request.args.get('token')
+    channel_id = request.args.get('channel_id')
+    # Optional arguments, all integers
+    bounds = {}
+    for arg in ('since', 'until', 'limit'):
+        if request.args.get(arg) is not None:
+            bounds[arg] = int(request.args.get(arg))
+    return_dict = channel_messages_between(token, int(channel_id), **bounds)
     return dumps(return_dict)
 
 
@@ -181,6 +257,12 @@ def send_later():
     return_dict = message_sendlater(data['token'], int(data['channel_id']), data['message'], int(data['time_sent']))
     return dumps(return_dict)
 
+@APP.route("/message/sendlater/cancel", methods = ['DELETE'])
+def cancel_send_later():
+    data = request.get_json()
+    return_dict = message_sendlater_cancel(data['token'], int(data['message_id']))
+    return dumps(return_dict)
+
 @APP.route("/message/react", methods = ['POST'])
 def react_to_message():
     data = request.get_json()
@@ -227,11 +309,22 @@ def change_permissions():
     return dumps(return_dict)
 
 
+@APP.route("/admin/scheduler/details", methods=['GET'])
+def scheduler_details():
+    return_dict = admin_scheduler_details(request.args.get('token'))
+    return dumps(return_dict)
+
+
 @APP.route("/search", methods=['GET'])
 def message_search():
     token = request.args.get('token')
     query_str = request.args.get('query_str')
-    return_dict = search(token, query_str)
+    # Optional paging arguments, all integers
+    paging = {}
+    for arg in ('limit', 'before_message_id', 'since', 'until'):
+        if request.args.get(arg) is not None:
+            paging[arg] = int(request.args.get(arg))
+    return_dict = search(token, query_str, **paging)
     return dumps(return_dict)
 
 
@@ -301,5 +394,118 @@ def send_standup():
     return dumps(return_dict)
 
 
+def open_state(state_dir, archive=True):
+    """
+    Keeps the server's state in state_dir so it survives a restart. The
+    store is loaded from the last snapshot, brought up to date from the
+    write-ahead log, and then snapshotted every SNAPSHOT_INTERVAL seconds
+
+    Parameters:
+        state_dir (str): directory for the snapshot, write-ahead log and
+                         schedule log, created if missing
+        archive (bool): whether to tier channel histories, see open_archive
+
+    Returns:
+        snapshot_path (str): where to save the final snapshot on shutdown
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    if archive:
+        open_archive(state_dir)
+    snapshot_path = os.path.join(state_dir, 'store.snapshot')
+    wal_lsn = replay(state_dir, load_snapshot(snapshot_path) or 0)
+    data_store.wal = write_ahead_log(state_dir, wal_lsn)
+    replayed = data_store.scheduler.open_log(os.path.join(state_dir, 'schedule.log'))
+    logger.info('replayed %d scheduled jobs', replayed)
+    start_snapshots(snapshot_path, SNAPSHOT_INTERVAL)
+    return snapshot_path
+
+def open_database(state_dir, archive=True):
+    """
+    Mirrors the server's state into a SQLite database in state_dir instead
+    of saving snapshots and a write-ahead log. The whole store is loaded
+    into memory from the database, and every change is written through to
+    it as it is made
+
+    Parameters:
+        state_dir (str): directory for the database and schedule log,
+                         created if missing
+        archive (bool): whether to tier channel histories, see open_archive
+
+    Returns:
+        None
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    if archive:
+        open_archive(state_dir)
+    database = sqlite_store(os.path.join(state_dir, 'store.sqlite'))
+    database.load()
+    store.use(sqlite_engine(database))
+    replayed = data_store.scheduler.open_log(os.path.join(state_dir, 'schedule.log'))
+    logger.info('replayed %d scheduled jobs', replayed)
+
+def open_archive(state_dir):
+    """
+    Tiers every channel's history, keeping older messages in an archive
+    file in state_dir rather than in memory. Called before the store is
+    loaded, so loaded channels are tiered too, see start_archiving for
+    moving messages out as the channels grow
+
+    Parameters:
+        state_dir (str): directory for the archive file
+
+    Returns:
+        None
+    """
+    data_store.archive = message_archive(os.path.join(state_dir, 'messages.archive'))
+    data_store.history_class = tiered_history
+
+def open_search_pool(workers):
+    """
+    Spreads searches the index can't narrow over a pool of worker
+    processes, see storage.memory_messages.search_shards
+
+    Parameters:
+        workers (int): the number of worker processes
+
+    Returns:
+        None
+    """
+    # Spawned rather than forked, as the scheduler thread may already be running
+    data_store.search_executor = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
 if __name__ == "__main__":
-    APP.run(port=64810) # Do not edit this port
+    # python3 src/server.py [state_dir [sqlite]] [--search-workers=N] [--columnar]
+    ARGS = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    for arg in sys.argv[1:]:
+        if arg.startswith('--search-workers='):
+            open_search_pool(int(arg.split('=', 1)[1]))
+    # Channels keep their whole history in memory as columns, see
+    # message_store.py, instead of archiving older messages to a file
+    COLUMNAR = '--columnar' in sys.argv[1:]
+    if COLUMNAR:
+        data_store.history_class = message_columns
+    # Only this module's logger, so werkzeug keeps printing its own lines as they were
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger.setLevel(logging.INFO)
+    SNAPSHOT_PATH = None
+    if len(ARGS) > 1 and ARGS[1] == 'sqlite':
+        open_database(ARGS[0], archive=not COLUMNAR)
+    elif ARGS:
+        SNAPSHOT_PATH = open_state(ARGS[0], archive=not COLUMNAR)
+    start_compacting(COMPACT_INTERVAL)
+    if data_store.archive is not None:
+        start_archiving(ARCHIVE_INTERVAL)
+    # Stopping with SIGTERM saves the final snapshot too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        APP.run(port=64810) # Do not edit this port
+    finally:
+        if SNAPSHOT_PATH is not None:
+            save_snapshot(SNAPSHOT_PATH)
+        if data_store.database is not None:
+            data_store.database.close()
+        if data_store.archive is not None:
+            data_store.archive.close()
+        if data_store.search_executor is not None:
+            data_store.search_executor.shutdown()
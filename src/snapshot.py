@@ -0,0 +1,263 @@
+""" Saves the whole store to one binary file and loads it back at startup
+
+A snapshot is a short header followed by a pickle of plain values: tuples,
+dicts, typed arrays and one utf-8 buffer of message text per channel. The
+classes in data.py are never pickled, so changing them does not break old
+snapshots. Indexes that can be worked out from the rest, such as
+message_id_index and user_channel_index, are rebuilt by load_snapshot
+instead of being saved. The search index is not rebuilt up front: each
+channel is indexed the first time a search looks at it.
+
+Saving holds the readers' side of data.lock while the store is copied, so
+only requests that change the store wait for it. Copying is a few arrays
+per channel, or one pass per column over a list history. Packing and
+writing the file happen after the lock is released.
+"""
+import logging
+import os
+import pickle
+import threading
+from array import array
+from itertools import accumulate
+from operator import attrgetter
+from data import data, user, channel, message, hangman, standup_buffer, NO_REACTS
+from message_store import message_columns
+from archive import tiered_history, load_history
+from other import clear
+
+MAGIC = b'FLOCKR-SNAPSHOT\n'
+VERSION = 1
+# The message columns a snapshot saves, with their array typecodes
+COLUMNS = (('message_id', 'q'), ('u_id', 'q'), ('time_created', 'q'), ('is_pinned', 'b'),
+           ('seq', 'q'))
+
+logger = logging.getLogger(__name__)
+# The snapshot thread and shutdown may both save, one at a time
+saving = threading.Lock()
+
+def save_snapshot(path):
+    """
+    Writes the store to path, replacing any older snapshot there only once
+    the new one is complete
+
+    Parameters:
+        path (str): the snapshot file
+
+    Returns:
+        size (int): the size of the snapshot in bytes
+    """
+    with saving:
+        state = capture()
+        for saved in state['channels']:
+            if 'texts' in saved:
+                saved['text'] = pack_texts(saved.pop('texts'))
+
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as snapshot_file:
+            snapshot_file.write(MAGIC)
+            snapshot_file.write(VERSION.to_bytes(4, 'little'))
+            pickle.dump(state, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, path)
+        # The write-ahead log up to here is no longer needed to recover
+        if data.wal is not None:
+            data.wal.drop_segments(state['wal_lsn'])
+        return os.path.getsize(path)
+
+def load_snapshot(path):
+    """
+    Replaces the store with the one saved at path. This clears the store
+    first, pending scheduled jobs included, so call it before
+    data.scheduler.open_log
+
+    Parameters:
+        path (str): the snapshot file
+
+    Returns:
+        wal_lsn (int): the last write-ahead log record the snapshot holds,
+                       or None if there is no snapshot at path
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as snapshot_file:
+        if snapshot_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a snapshot')
+        version = int.from_bytes(snapshot_file.read(4), 'little')
+        if version != VERSION:
+            raise ValueError('unsupported snapshot version ' + str(version))
+        state = pickle.load(snapshot_file)
+    with data.lock:
+        restore(state)
+    return state['wal_lsn']
+
+def start_snapshots(path, interval):
+    """
+    Saves a snapshot to path every interval seconds on a thread of its own,
+    so writing a large snapshot never holds up scheduled jobs
+
+    Parameters:
+        path (str): the snapshot file
+        interval (float): seconds between snapshots
+
+    Returns:
+        stop (threading.Event): set it to stop taking snapshots
+    """
+    stop = threading.Event()
+    def take_snapshots():
+        while not stop.wait(interval):
+            try:
+                save_snapshot(path)
+            except Exception:
+                logger.exception('saving a snapshot to %s failed', path)
+    threading.Thread(target=take_snapshots, daemon=True).start()
+    return stop
+
+def capture():
+    """ Copies the store into plain values, holding data.lock for reading while it does """
+    with data.lock.reading():
+        return {
+            # Starting a new log segment here marks what the snapshot holds
+            'wal_lsn': data.wal.rotate() if data.wal is not None else 0,
+            'message_index': data.message_index,
+            'session_index': data.session_index,
+            'users': [tuple(getattr(saved, field) for field in user.__slots__)
+                      for saved in data.users],
+            'sessions': [(token, saved.u_id, saved.issued_at, saved.last_seen)
+                         for token, saved in data.sessions.items()],
+            'channels': [capture_channel(saved) for saved in data.channels],
+            'scheduled_messages': dict(data.scheduled_messages)
+        }
+
+def capture_channel(saved):
+    # Removed messages are saved as they are, with the positions marking them
+    history = saved.channel_messages
+    state = {
+        'name': saved.name,
+        'is_public': saved.is_public,
+        'owners': list(saved.owners),
+        'members': list(saved.members),
+        'next_seq': saved.next_seq,
+        'removed_seqs': dict(saved.removed_seqs),
+        'tombstones': saved.tombstones[:],
+        'version': saved.version,
+        'standup_end': saved.standup_end,
+        'standup_parts': list(saved.standup_buffer.parts),
+        'hangman': (saved.hangman.mode, saved.hangman.word, list(saved.hangman.guesses))
+    }
+    if isinstance(history, message_columns):
+        # Copying the columns is a handful of memory copies
+        state['columns'] = (history.message_ids[:], history.u_ids[:], history.times[:],
+                            history.pinned[:], history.seqs[:])
+        state['text'] = (bytes(history.text), history.text_start[:], history.text_length[:])
+        state['reacts'] = {message_id: copy_reacts(reacts)
+                           for message_id, reacts in history.reacts.items()}
+    else:
+        # One map over the history per column, without a Python loop per message
+        state['columns'] = tuple(array(typecode, map(attrgetter(field), history))
+                                 for field, typecode in COLUMNS)
+        # Strings can't change, so encoding them can wait until after the lock
+        state['texts'] = list(map(attrgetter('message'), history))
+        state['reacts'] = {msg.message_id: copy_reacts(msg.reacts)
+                           for msg in history if msg.reacts}
+    return state
+
+def copy_reacts(reacts):
+    return [dict(react, u_ids=list(react['u_ids'])) for react in reacts]
+
+def pack_texts(texts):
+    """ Encodes texts into one buffer, returning (buffer, starts, lengths) """
+    encoded = [text.encode() for text in texts]
+    lengths = array('q', map(len, encoded))
+    starts = array('q', accumulate(lengths, initial=0))
+    starts.pop()
+    return (b''.join(encoded), starts, lengths)
+
+def restore(state):
+    """ Rebuilds the store and its indexes from the values made by capture """
+    clear()
+    for saved in state['users']:
+        new_user = user.__new__(user)
+        for field, value in zip(user.__slots__, saved):
+            setattr(new_user, field, value)
+        data.new_user(new_user)
+
+    for token, u_id, issued_at, last_seen in state['sessions']:
+        data.new_session(token, u_id)
+        data.sessions[token].issued_at = issued_at
+        data.sessions[token].last_seen = last_seen
+    data.session_index = state['session_index']
+
+    for channel_id, saved in enumerate(state['channels']):
+        data.new_channel(restore_channel(channel_id, saved))
+        data.search_index.defer(channel_id)
+
+    data.message_index = state['message_index']
+    data.scheduled_messages.update(state['scheduled_messages'])
+
+def restore_channel(channel_id, saved):
+    restored = channel.__new__(channel)
+    restored.name = saved['name']
+    restored.is_public = saved['is_public']
+    restored.channel_id = channel_id
+    restored.owners = {}
+    restored.members = {}
+    for u_id in saved['owners']:
+        restored.new_owner(data.find_user(u_id))
+    for u_id in saved['members']:
+        restored.new_member(data.find_user(u_id))
+    restored.next_seq = saved['next_seq']
+    restored.removed_seqs = saved['removed_seqs']
+    # Snapshots saved before tombstones were kept have none
+    restored.tombstones = saved.get('tombstones', array('q'))
+    removed = set(restored.tombstones)
+    restored.version = saved['version']
+    restored.standup_end = saved['standup_end']
+    restored.standup_buffer = standup_buffer()
+    for u_id, text in saved['standup_parts']:
+        restored.standup_buffer.add(u_id, text)
+    restored.hangman = restore_hangman(*saved['hangman'])
+
+    message_ids, u_ids, times, pinned, seqs = saved['columns']
+    text, text_start, text_length = saved['text']
+    history = data.history_class()
+    first_hot = 0
+    if isinstance(history, message_columns):
+        history.message_ids, history.u_ids, history.times = message_ids, u_ids, times
+        history.pinned, history.seqs = pinned, seqs
+        history.removed = array('b', bytes(len(message_ids)))
+        for row in removed:
+            history.removed[row] = 1
+        history.text = bytearray(text)
+        history.text_start, history.text_length = text_start, text_length
+        history.rows = {message_id: row for row, message_id in enumerate(message_ids)}
+        history.reacts = saved['reacts']
+    else:
+        if isinstance(history, tiered_history):
+            first_hot = load_history(history, channel_id, saved, removed)
+        for row in range(first_hot, len(message_ids)):
+            message_id = message_ids[row]
+            restored_message = message.__new__(message)
+            restored_message.message_id = message_id
+            restored_message.u_id = u_ids[row]
+            restored_message.message = text[text_start[row]:text_start[row] + text_length[row]].decode()
+            restored_message.time_created = times[row]
+            restored_message.is_pinned = bool(pinned[row])
+            restored_message.reacts = saved['reacts'].get(message_id, NO_REACTS)
+            restored_message.seq = seqs[row]
+            restored_message.removed = row in removed
+            history.append(restored_message)
+    restored.channel_messages = history
+
+    # Archived messages are found through data.archive instead
+    for row in range(first_hot, len(message_ids)):
+        if row not in removed:
+            data.message_id_index[message_ids[row]] = (restored, history[row])
+    return restored
+
+def restore_hangman(mode, word, guesses):
+    restored = hangman()
+    restored.mode = mode
+    restored.word = word
+    restored.guesses = guesses
+    return restored
@@ -0,0 +1,62 @@
+""" Reports how long snapshot.py takes to save and load a store, and its size
+
+Usage:
+    python3 src/snapshot_benchmark.py [num_messages] [num_channels] [columnar]
+"""
+import os
+import sys
+import tempfile
+import time
+from data import data, user, channel, message
+from message_store import message_columns
+from other import clear
+from snapshot import save_snapshot, load_snapshot
+
+def fill_store(num_messages, num_channels):
+    """
+    Fills the store with one user per channel and num_messages messages
+    spread evenly over num_channels channels
+    """
+    clear()
+    for i in range(num_channels):
+        new_user = user('user' + str(i) + '@test.com', 'password', 'First' + str(i), 'Last')
+        data.new_user(new_user)
+        new_channel = channel('channel' + str(i), True)
+        new_channel.new_owner(new_user)
+        new_channel.new_member(new_user)
+        data.new_channel(new_channel)
+    for i in range(num_messages):
+        data.new_message(data.channels[i % num_channels],
+                         message("benchmark message number " + str(i), i % num_channels, i))
+    data.message_index = num_messages
+
+def run_benchmark(num_messages, num_channels, history_class=list):
+    previous_class = data.history_class
+    data.history_class = history_class
+    try:
+        fill_store(num_messages, num_channels)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'store.snapshot')
+            start = time.perf_counter()
+            size = save_snapshot(path)
+            saved = time.perf_counter()
+            load_snapshot(path)
+            loaded = time.perf_counter()
+    finally:
+        data.history_class = previous_class
+        clear()
+    return {
+        'save_seconds': saved - start,
+        'load_seconds': loaded - saved,
+        'bytes': size,
+        'bytes_per_message': size / max(num_messages, 1)
+    }
+
+if __name__ == "__main__":
+    NUM_MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    NUM_CHANNELS = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    HISTORY_CLASS = message_columns if len(sys.argv) > 3 and sys.argv[3] == 'columnar' else list
+    results = run_benchmark(NUM_MESSAGES, NUM_CHANNELS, HISTORY_CLASS)
+    print(f"save: {results['save_seconds']:.2f}s  load: {results['load_seconds']:.2f}s")
+    print(f"size: {results['bytes'] / 1e6:.1f} MB ({results['bytes_per_message']:.1f} bytes per message, "
+          f"{NUM_MESSAGES} messages)")
@@ -0,0 +1,114 @@
+""" Tests for snapshot.py and snapshot_benchmark.py """
+import threading
+import pytest
+from data import data
+from auth import auth_register, auth_login
+from channel import channel_messages, channel_messages_cursor, channel_details, channel_invite
+from channels import channels_create, channels_list
+from message import message_send, message_remove, message_edit, message_react, message_pin
+from standup import standup_start, standup_send
+from message_store import message_columns
+from other import clear, search
+from snapshot import save_snapshot, load_snapshot
+from snapshot_benchmark import run_benchmark
+
+@pytest.fixture(params=[list, message_columns])
+def history_class(request):
+    previous = data.history_class
+    data.history_class = request.param
+    yield request.param
+    data.history_class = previous
+    clear()
+
+def test_snapshot_round_trip(tmp_path, history_class):
+    clear()
+    path = str(tmp_path / 'store.snapshot')
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    user2 = auth_register("test2@test.com", "password", "secondName", "lastName")
+    channel = channels_create(user['token'], "channel", True)
+    channel_invite(user['token'], channel['channel_id'], user2['u_id'])
+    msg_ids = [message_send(user['token'], channel['channel_id'], "message " + str(i))['message_id']
+               for i in range(5)]
+    message_remove(user['token'], msg_ids[1])
+    message_edit(user['token'], msg_ids[2], "edited ü")
+    message_react(user2['token'], msg_ids[3], 1)
+    message_pin(user['token'], msg_ids[4])
+    standup_start(user['token'], channel['channel_id'], 60)
+    standup_send(user2['token'], channel['channel_id'], "standup part")
+
+    before = {
+        'messages': channel_messages(user['token'], channel['channel_id'], 0),
+        'details': channel_details(user['token'], channel['channel_id']),
+        'channels': channels_list(user2['token']),
+        'search': search(user['token'], "edited")
+    }
+    assert save_snapshot(path) > 0
+    clear()
+    assert load_snapshot(path) == 0
+
+    # Tokens issued before the snapshot still work
+    assert channel_messages(user['token'], channel['channel_id'], 0) == before['messages']
+    assert channel_details(user['token'], channel['channel_id']) == before['details']
+    assert channels_list(user2['token']) == before['channels']
+    assert search(user['token'], "edited") == before['search']
+    assert isinstance(data.channels[0].channel_messages, history_class)
+    assert data.channels[0].standup_buffer.parts == [(user2['u_id'], "standup part")]
+    # The removed message still works as a cursor, and new ids carry on
+    page = channel_messages_cursor(user['token'], channel['channel_id'], before_message_id=msg_ids[1])
+    assert [msg['message_id'] for msg in page['messages']] == [msg_ids[0]]
+    assert message_send(user['token'], channel['channel_id'], "after")['message_id'] == 5
+    auth_login("test2@test.com", "password")
+
+def test_search_index_built_on_first_search(tmp_path):
+    clear()
+    path = str(tmp_path / 'store.snapshot')
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    channel_ids = [channels_create(user['token'], name, True)['channel_id'] for name in ("a", "b")]
+    msg_ids = [message_send(user['token'], channel_id, "message " + str(channel_id))['message_id']
+               for channel_id in channel_ids]
+    save_snapshot(path)
+    clear()
+    load_snapshot(path)
+    assert data.search_index.deferred == set(channel_ids)
+    assert data.search_index.postings == {}
+
+    # Changes made before a channel is indexed are picked up when it is
+    message_edit(user['token'], msg_ids[0], "edited")
+    assert [msg['message_id'] for msg in search(user['token'], "edit")['messages']] == [msg_ids[0]]
+    assert data.search_index.deferred == set()
+    assert search(user['token'], "message")['messages'][0]['message_id'] == msg_ids[1]
+    clear()
+
+def test_capture_shares_the_lock_with_readers(tmp_path):
+    clear()
+    auth_register("test@test.com", "password", "firstName", "lastName")
+    wrote = threading.Event()
+    def write():
+        with data.lock:
+            wrote.set()
+    with data.lock.reading():
+        # A snapshot can be saved while a request is reading
+        saver = threading.Thread(target=save_snapshot, args=(str(tmp_path / 'store.snapshot'),))
+        saver.start()
+        saver.join(5)
+        assert not saver.is_alive()
+        # but a request changing the store waits for the reader
+        writer = threading.Thread(target=write)
+        writer.start()
+        assert not wrote.wait(0.1)
+    writer.join(5)
+    assert wrote.is_set()
+    clear()
+
+def test_load_missing_or_foreign_file(tmp_path):
+    assert load_snapshot(str(tmp_path / 'missing')) is None
+    foreign = tmp_path / 'foreign'
+    foreign.write_bytes(b'not a snapshot')
+    with pytest.raises(ValueError):
+        load_snapshot(str(foreign))
+
+def test_run_benchmark():
+    results = run_benchmark(200, 10)
+    assert results['bytes'] > 0
+    assert results['save_seconds'] >= 0 and results['load_seconds'] >= 0
+    assert run_benchmark(200, 10, message_columns)['bytes'] > 0
@@ -0,0 +1,511 @@
+""" Mirrors the store into an on-disk SQLite database
+
+sqlite_store is a write-through copy of the in-memory store, not a
+replacement for it. It is handed every change record data.record makes,
+the same records the write-ahead log keeps (see wal.py), and applies each
+one to tables of users, sessions, channels, memberships, messages and
+reacts in its own transaction. sqlite_engine is a storage engine (see
+storage.py) that writes to a sqlite_store and answers channel_messages,
+channels_list and search with indexed queries on it rather than by
+walking the in-memory store; everything else still reads data.py's
+objects. Message pages are ranges of seqs, worked out from the positions
+with the in-memory channel, and counts come from memory too. server.py
+loads the whole store back into memory from the database at startup
+instead of from a snapshot, so the mirror gives crash-safe state and
+indexed reads but does not bring memory use down.
+
+The database runs in SQLite's WAL journal mode with synchronous=NORMAL, so
+a committed change survives the process crashing and the file is never
+left corrupt. The default memory_engine keeps the store purely in memory,
+which is what the tests use.
+
+    python3 src/server.py state_dir sqlite
+"""
+import json
+import sqlite3
+import threading
+import time
+from array import array
+from data import data, REMOVED_SEQS_MAX
+from snapshot import pack_texts, restore
+from storage import memory_engine, memory_channels, memory_messages
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    u_id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL,
+    password TEXT NOT NULL,
+    name_first TEXT NOT NULL,
+    name_last TEXT NOT NULL,
+    secret_key TEXT,
+    profile_img_url TEXT NOT NULL,
+    permission_id INTEGER NOT NULL,
+    handle_str TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE INDEX IF NOT EXISTS users_handle ON users (handle_str);
+CREATE TABLE IF NOT EXISTS sessions (
+    token TEXT PRIMARY KEY,
+    u_id INTEGER NOT NULL,
+    issued_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS channels (
+    channel_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    is_public INTEGER NOT NULL,
+    next_seq INTEGER NOT NULL DEFAULT 0,
+    standup_end INTEGER,
+    hangman_mode INTEGER NOT NULL DEFAULT 0,
+    hangman_word TEXT,
+    hangman_guesses TEXT NOT NULL DEFAULT '[]'
+);
+-- Rows are kept in the order users joined, which channel_details shows
+CREATE TABLE IF NOT EXISTS members (
+    channel_id INTEGER NOT NULL,
+    u_id INTEGER NOT NULL,
+    UNIQUE (channel_id, u_id)
+);
+CREATE INDEX IF NOT EXISTS members_user ON members (u_id, channel_id);
+CREATE TABLE IF NOT EXISTS owners (
+    channel_id INTEGER NOT NULL,
+    u_id INTEGER NOT NULL,
+    UNIQUE (channel_id, u_id)
+);
+-- Removed messages keep their row, flagged, so they still work as cursors
+CREATE TABLE IF NOT EXISTS messages (
+    message_id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    u_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    time_created INTEGER NOT NULL,
+    is_pinned INTEGER NOT NULL,
+    removed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel_id, seq) WHERE removed = 0;
+CREATE INDEX IF NOT EXISTS messages_time ON messages (time_created, message_id) WHERE removed = 0;
+CREATE TABLE IF NOT EXISTS reacts (
+    message_id INTEGER NOT NULL,
+    react_id INTEGER NOT NULL,
+    u_ids TEXT NOT NULL,
+    is_this_user_reacted INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reacts_message ON reacts (message_id);
+CREATE TABLE IF NOT EXISTS scheduled_messages (
+    message_id INTEGER PRIMARY KEY,
+    job_id INTEGER NOT NULL,
+    u_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS standup_parts (
+    channel_id INTEGER NOT NULL,
+    u_id INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+"""
+
+# Trigram index over the text of live messages, used to narrow substring
+# searches of at least 3 characters. Needs SQLite 3.34 or later
+TEXT_INDEX = """
+CREATE VIRTUAL TABLE IF NOT EXISTS message_text USING fts5 (
+    text, content='messages', content_rowid='message_id', tokenize='trigram case_sensitive 1'
+)
+"""
+
+MESSAGE_COLUMNS = 'm.message_id, m.u_id, m.text, m.time_created, m.is_pinned'
+# Most message_ids looked up in one query, well below SQLite's variable limit
+LOOKUP_BATCH = 500
+
+class sqlite_store:
+    def __init__(self, path):
+        # Shared between threads. Writers hold data.lock alone, but reading
+        # requests share it, so every use of the connection, and each
+        # transaction, holds connection_lock as well
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection_lock = threading.RLock()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        try:
+            self.connection.execute(TEXT_INDEX)
+            self.text_index = True
+        except sqlite3.OperationalError:
+            self.text_index = False
+        self.connection.commit()
+        self.apply_record = {
+            'clear': self.apply_clear,
+            'user': self.apply_user,
+            'session': self.apply_session,
+            'end_session': self.apply_end_session,
+            'channel': self.apply_channel,
+            'member': self.apply_member,
+            'owner': self.apply_owner,
+            'message': self.apply_message,
+            'edit': self.apply_edit,
+            'remove_message': self.apply_remove_message,
+            'message_state': self.apply_message_state,
+            'message_index': self.apply_message_index,
+            'scheduled': self.apply_scheduled,
+            'unscheduled': self.apply_unscheduled,
+            'standup_start': self.apply_standup_start,
+            'standup_part': self.apply_standup_part,
+            'standup_reset': self.apply_standup_reset,
+            'hangman': self.apply_hangman
+        }
+
+    def apply(self, entry):
+        """
+        Writes one change record to the database and commits it
+
+        Parameters:
+            entry (tuple): the kind of change followed by its values, as
+                           made by data.record
+
+        Returns:
+            None
+        """
+        with self.connection_lock, self.connection:
+            self.apply_record[entry[0]](*entry[1:])
+
+    def close(self):
+        with self.connection_lock:
+            self.connection.close()
+
+    def execute(self, sql, params=()):
+        """ Runs one statement, for the apply_ methods, which hold connection_lock """
+        return self.connection.execute(sql, params)
+
+    def fetch(self, sql, params=()):
+        """ Runs one query and returns all of its rows """
+        with self.connection_lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def fetch_one(self, sql, params=()):
+        """ Runs one query and returns its first row, or None """
+        with self.connection_lock:
+            return self.connection.execute(sql, params).fetchone()
+
+    def apply_clear(self):
+        for table in ('counters', 'users', 'sessions', 'channels', 'members', 'owners',
+                      'messages', 'reacts', 'scheduled_messages', 'standup_parts'):
+            self.execute('DELETE FROM ' + table)
+        if self.text_index:
+            self.execute("INSERT INTO message_text (message_text) VALUES ('delete-all')")
+
+    def apply_user(self, *fields):
+        self.execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', fields)
+
+    def apply_session(self, token, u_id, session_index):
+        self.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                     (token, u_id, int(time.time())))
+        self.set_counter('session_index', session_index)
+
+    def apply_end_session(self, token):
+        self.execute('DELETE FROM sessions WHERE token = ?', (token,))
+
+    def apply_channel(self, channel_id, name, is_public):
+        self.execute('INSERT INTO channels (channel_id, name, is_public) VALUES (?, ?, ?)',
+                     (channel_id, name, is_public))
+
+    def apply_member(self, channel_id, u_id, joined):
+        if joined:
+            self.execute('INSERT OR IGNORE INTO members VALUES (?, ?)', (channel_id, u_id))
+        else:
+            self.execute('DELETE FROM members WHERE channel_id = ? AND u_id = ?', (channel_id, u_id))
+
+    def apply_owner(self, channel_id, u_id, added):
+        if added:
+            self.execute('INSERT OR IGNORE INTO owners VALUES (?, ?)', (channel_id, u_id))
+        else:
+            self.execute('DELETE FROM owners WHERE channel_id = ? AND u_id = ?', (channel_id, u_id))
+
+    def apply_message(self, channel_id, message_id, u_id, text, time_created, is_pinned, reacts, seq):
+        self.execute('INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, 0)',
+                     (message_id, channel_id, seq, u_id, text, time_created, is_pinned))
+        self.execute('UPDATE channels SET next_seq = ? WHERE channel_id = ?', (seq + 1, channel_id))
+        self.write_reacts(message_id, reacts)
+        if self.text_index:
+            self.execute('INSERT INTO message_text (rowid, text) VALUES (?, ?)', (message_id, text))
+
+    def apply_edit(self, message_id, text):
+        self.unindex_text(message_id)
+        self.execute('UPDATE messages SET text = ? WHERE message_id = ?', (text, message_id))
+        if self.text_index:
+            self.execute('INSERT INTO message_text (rowid, text) VALUES (?, ?)', (message_id, text))
+
+    def apply_remove_message(self, message_id):
+        self.unindex_text(message_id)
+        self.execute('UPDATE messages SET removed = 1 WHERE message_id = ?', (message_id,))
+        self.execute('DELETE FROM reacts WHERE message_id = ?', (message_id,))
+
+    def apply_message_state(self, message_id, is_pinned, reacts):
+        self.execute('UPDATE messages SET is_pinned = ? WHERE message_id = ?', (is_pinned, message_id))
+        self.write_reacts(message_id, reacts)
+
+    def apply_message_index(self, message_index):
+        self.set_counter('message_index', message_index)
+
+    def apply_scheduled(self, message_id, job_id, u_id):
+        self.execute('INSERT OR REPLACE INTO scheduled_messages VALUES (?, ?, ?)',
+                     (message_id, job_id, u_id))
+
+    def apply_unscheduled(self, message_id):
+        self.execute('DELETE FROM scheduled_messages WHERE message_id = ?', (message_id,))
+
+    def apply_standup_start(self, channel_id, time_finish):
+        self.execute('UPDATE channels SET standup_end = ? WHERE channel_id = ?',
+                     (time_finish, channel_id))
+
+    def apply_standup_part(self, channel_id, u_id, text):
+        self.execute('INSERT INTO standup_parts VALUES (?, ?, ?)', (channel_id, u_id, text))
+
+    def apply_standup_reset(self, channel_id):
+        self.execute('UPDATE channels SET standup_end = NULL WHERE channel_id = ?', (channel_id,))
+        self.execute('DELETE FROM standup_parts WHERE channel_id = ?', (channel_id,))
+
+    def apply_hangman(self, channel_id, mode, word, guesses):
+        self.execute('UPDATE channels SET hangman_mode = ?, hangman_word = ?, hangman_guesses = ? '
+                     'WHERE channel_id = ?', (mode, word, json.dumps(guesses), channel_id))
+
+    def set_counter(self, name, value):
+        self.execute('INSERT OR REPLACE INTO counters VALUES (?, ?)', (name, value))
+
+    def write_reacts(self, message_id, reacts):
+        self.execute('DELETE FROM reacts WHERE message_id = ?', (message_id,))
+        self.connection.executemany(
+            'INSERT INTO reacts VALUES (?, ?, ?, ?)',
+            [(message_id, react['react_id'], json.dumps(react['u_ids']),
+              react['is_this_user_reacted']) for react in reacts])
+
+    def unindex_text(self, message_id):
+        """ Takes a live message out of the trigram index, before its text changes """
+        if not self.text_index:
+            return
+        row = self.execute('SELECT text FROM messages WHERE message_id = ? AND removed = 0',
+                           (message_id,)).fetchone()
+        if row is not None:
+            self.execute("INSERT INTO message_text (message_text, rowid, text) "
+                         "VALUES ('delete', ?, ?)", (message_id, row[0]))
+
+    def channel_messages(self, channel_id, first_seq, last_seq):
+        """
+        The live messages of a channel with seqs from first_seq to last_seq,
+        as message dictionaries newest first. A range of the messages_channel
+        index, so a page costs the same wherever it is in the channel
+
+        Parameters:
+            channel_id (int): the channel to read
+            first_seq (int): seq of the oldest message wanted
+            last_seq (int): seq of the newest message wanted
+
+        Returns:
+            messages (list): message dictionaries
+        """
+        rows = self.fetch('SELECT ' + MESSAGE_COLUMNS + ' FROM messages m '
+                          'WHERE m.channel_id = ? AND m.removed = 0 AND m.seq BETWEEN ? AND ? '
+                          'ORDER BY m.seq DESC', (channel_id, first_seq, last_seq))
+        return self.message_details(rows)
+
+    def channels_list(self, u_id):
+        """ The {channel_id, name} of every channel u_id is a member of, by channel_id """
+        rows = self.fetch('SELECT c.channel_id, c.name FROM members m '
+                          'JOIN channels c ON c.channel_id = m.channel_id '
+                          'WHERE m.u_id = ? ORDER BY m.channel_id', (u_id,))
+        return [{'channel_id': channel_id, 'name': name} for channel_id, name in rows]
+
+    def search(self, u_id, query_str):
+        """
+        Finds every live message in u_id's channels containing query_str
+
+        Parameters:
+            u_id (int): the user searching
+            query_str (str): the string to search for
+
+        Returns:
+            messages (list): message dictionaries in channel_id order, then
+                             in the order they appear in their channel
+        """
+        where, params = self.search_filter(u_id, query_str)
+        rows = self.fetch('SELECT ' + MESSAGE_COLUMNS + ' FROM messages m ' + where +
+                          ' ORDER BY m.channel_id, m.seq', params)
+        return self.message_details(rows)
+
+    def search_page(self, u_id, query_str, limit, since, until, before):
+        """
+        Finds up to limit live messages in u_id's channels containing
+        query_str, newest first, in the same order as search_index.newest_first
+
+        Parameters:
+            u_id (int): the user searching
+            query_str (str): the string to search for
+            limit (int): the most messages to return
+            since (int): ignore messages sent before this time, if given
+            until (int): ignore messages sent after this time, if given
+            before (tuple): only return messages whose (time_created,
+                            message_id) is below this key, if given
+
+        Returns:
+            messages (list): message dictionaries
+        """
+        where, params = self.search_filter(u_id, query_str)
+        if since is not None:
+            where += ' AND m.time_created >= ?'
+            params.append(since)
+        if until is not None:
+            where += ' AND m.time_created <= ?'
+            params.append(until)
+        if before is not None:
+            where += ' AND (m.time_created, m.message_id) < (?, ?)'
+            params += before
+        rows = self.fetch('SELECT ' + MESSAGE_COLUMNS + ' FROM messages m ' + where +
+                          ' ORDER BY m.time_created DESC, m.message_id DESC LIMIT ?',
+                          params + [limit])
+        return self.message_details(rows)
+
+    def search_filter(self, u_id, query_str):
+        """ The FROM ... WHERE tail and parameters shared by search and search_page """
+        where = ('JOIN members ON members.channel_id = m.channel_id AND members.u_id = ? '
+                 'WHERE m.removed = 0 AND instr(m.text, ?) > 0')
+        params = [u_id, query_str]
+        # The trigram index can only narrow queries of at least one trigram
+        if self.text_index and len(query_str) >= 3:
+            where += ' AND m.message_id IN (SELECT rowid FROM message_text WHERE message_text MATCH ?)'
+            params.append('"' + query_str.replace('"', '""') + '"')
+        return where, params
+
+    def time_key(self, message_id):
+        """ The (time_created, message_id) sort key of a live or removed message, or None """
+        row = self.fetch_one('SELECT time_created FROM messages WHERE message_id = ?',
+                             (message_id,))
+        return None if row is None else (row[0], message_id)
+
+    def find_reacts(self, message_ids):
+        """ message_id -> list of react dictionaries, for those of message_ids with any """
+        reacts = {}
+        for start in range(0, len(message_ids), LOOKUP_BATCH):
+            batch = message_ids[start:start + LOOKUP_BATCH]
+            rows = self.fetch('SELECT message_id, react_id, u_ids, is_this_user_reacted '
+                              'FROM reacts WHERE message_id IN (' + ', '.join('?' * len(batch)) +
+                              ') ORDER BY rowid', batch)
+            for message_id, react_id, u_ids, reacted in rows:
+                reacts.setdefault(message_id, []).append({
+                    'react_id': react_id,
+                    'u_ids': json.loads(u_ids),
+                    'is_this_user_reacted': bool(reacted)
+                })
+        return reacts
+
+    def message_details(self, rows):
+        """ Turns rows of MESSAGE_COLUMNS into message dictionaries, reacts included """
+        reacts = self.find_reacts([row[0] for row in rows])
+        return [{
+            'message_id': message_id,
+            'u_id': u_id,
+            'message': text,
+            'time_created': time_created,
+            'is_pinned': bool(is_pinned),
+            'reacts': reacts.get(message_id, [])
+        } for message_id, u_id, text, time_created, is_pinned in rows]
+
+    def load(self):
+        """
+        Replaces the in-memory store with a full copy of the one in the
+        database. Call it before setting data.database, so loading is not
+        written back
+        """
+        counters = dict(self.fetch('SELECT name, value FROM counters'))
+        state = {
+            'wal_lsn': 0,
+            'message_index': counters.get('message_index', 0),
+            'session_index': counters.get('session_index', 0),
+            'users': self.fetch('SELECT * FROM users ORDER BY u_id'),
+            'sessions': [(token, u_id, issued_at, issued_at) for token, u_id, issued_at
+                         in self.fetch('SELECT * FROM sessions ORDER BY rowid')],
+            'channels': [self.load_channel(*row) for row
+                         in self.fetch('SELECT * FROM channels ORDER BY channel_id')],
+            'scheduled_messages': {message_id: (job_id, u_id) for message_id, job_id, u_id
+                                   in self.fetch('SELECT * FROM scheduled_messages')}
+        }
+        with data.lock:
+            restore(state)
+
+    def load_channel(self, channel_id, name, is_public, next_seq, standup_end,
+                     hangman_mode, hangman_word, hangman_guesses):
+        """ A channel in the form snapshot.capture_channel makes, for snapshot.restore """
+        rows = self.fetch('SELECT message_id, u_id, time_created, is_pinned, seq, text '
+                          'FROM messages WHERE channel_id = ? AND removed = 0 ORDER BY seq',
+                          (channel_id,))
+        return {
+            'name': name,
+            'is_public': bool(is_public),
+            'owners': [u_id for u_id, in self.fetch(
+                'SELECT u_id FROM owners WHERE channel_id = ? ORDER BY rowid', (channel_id,))],
+            'members': [u_id for u_id, in self.fetch(
+                'SELECT u_id FROM members WHERE channel_id = ? ORDER BY rowid', (channel_id,))],
+            'next_seq': next_seq,
+            # Only the newest removed messages are kept as cursors, see REMOVED_SEQS_MAX
+            'removed_seqs': dict(self.fetch(
+                'SELECT message_id, seq FROM (SELECT message_id, seq FROM messages '
+                'WHERE channel_id = ? AND removed = 1 ORDER BY seq DESC LIMIT ?) ORDER BY seq',
+                (channel_id, REMOVED_SEQS_MAX))),
+            'version': 0,
+            'standup_end': standup_end,
+            'standup_parts': self.fetch('SELECT u_id, text FROM standup_parts '
+                                        'WHERE channel_id = ? ORDER BY rowid', (channel_id,)),
+            'hangman': (bool(hangman_mode), hangman_word, json.loads(hangman_guesses)),
+            'columns': (array('q', [row[0] for row in rows]), array('q', [row[1] for row in rows]),
+                        array('q', [row[2] for row in rows]), array('b', [row[3] for row in rows]),
+                        array('q', [row[4] for row in rows])),
+            'text': pack_texts([row[5] for row in rows]),
+            'reacts': self.find_reacts([row[0] for row in rows])
+        }
+
+class sqlite_channels(memory_channels):
+    def __init__(self, database):
+        self.database = database
+
+    def listing(self, u_id):
+        return self.database.channels_list(u_id)
+
+class sqlite_messages(memory_messages):
+    def __init__(self, database):
+        self.database = database
+
+    def page(self, channel, first, last):
+        # The positions are turned into seqs with the channel's tombstones,
+        # rather than skipping first rows with OFFSET
+        if last < first:
+            return []
+        history = channel.channel_messages
+        return self.database.channel_messages(channel.channel_id,
+                                              history[channel.live_position(first)].seq,
+                                              history[channel.live_position(last)].seq)
+
+    def search(self, u_id, query_str):
+        return self.database.search(u_id, query_str)
+
+    def search_page(self, u_id, query_str, limit, since, until, before):
+        return self.database.search_page(u_id, query_str, limit, since, until, before)
+
+    def time_key(self, message_id):
+        return self.database.time_key(message_id)
+
+class sqlite_engine(memory_engine):
+    """
+    memory_engine that also writes every change to a sqlite_store, and
+    reads channel listings, message pages and searches back from it
+    """
+    def __init__(self, database):
+        super().__init__()
+        self.database = database
+        self.channels = sqlite_channels(database)
+        self.messages = sqlite_messages(database)
+
+    def attach(self):
+        data.database = self.database
+
+    def detach(self):
+        data.database = None
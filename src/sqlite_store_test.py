@@ -0,0 +1,139 @@
+""" Tests for sqlite_store.py """
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from data import data
+from auth import auth_register, auth_login, auth_logout
+from channel import channel_messages, channel_details, channel_invite, channel_leave
+from channels import channels_create, channels_list
+from message import message_send, message_remove, message_edit, message_react, message_pin
+from message import message_sendlater
+from standup import standup_start, standup_send
+from user import user_profile_sethandle
+from message_store import message_columns
+from other import clear, search
+from sqlite_store import sqlite_store, sqlite_engine
+from storage import store, memory_engine
+
+@pytest.fixture(params=[list, message_columns])
+def database(request, tmp_path):
+    previous_class = data.history_class
+    data.history_class = request.param
+    clear()
+    previous = store.use(sqlite_engine(sqlite_store(str(tmp_path / 'store.sqlite'))))
+    yield data.database
+    data.database.close()
+    store.use(previous)
+    data.history_class = previous_class
+    clear()
+
+def in_memory(function, *args, **kwargs):
+    """ Calls function with the reference engine, so it reads the in-memory store """
+    engine = store.use(memory_engine())
+    try:
+        return function(*args, **kwargs)
+    finally:
+        store.use(engine)
+
+def fill_store():
+    """ Makes changes of every kind through the API, returning the first user and channel """
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    user2 = auth_register("test2@test.com", "password", "secondName", "lastName")
+    user3 = auth_register("test3@test.com", "password", "thirdName", "lastName")
+    auth_logout(user3['token'])
+    channel = channels_create(user['token'], "channel", True)
+    channels_create(user2['token'], "other", True)
+    channel_invite(user['token'], channel['channel_id'], user2['u_id'])
+    channel_invite(user['token'], channel['channel_id'], user3['u_id'])
+    channel_leave(auth_login("test3@test.com", "password")['token'], channel['channel_id'])
+    msg_ids = [message_send(user['token'], channel['channel_id'], "message " + str(i))['message_id']
+               for i in range(60)]
+    message_remove(user['token'], msg_ids[1])
+    message_edit(user['token'], msg_ids[2], 'edited "quoted" ü')
+    message_react(user2['token'], msg_ids[3], 1)
+    message_react(user['token'], msg_ids[3], 1)
+    message_pin(user['token'], msg_ids[4])
+    message_sendlater(user['token'], channel['channel_id'], "later", int(time.time()) + 60)
+    standup_start(user['token'], channel['channel_id'], 60)
+    standup_send(user2['token'], channel['channel_id'], "standup part")
+    user_profile_sethandle(user2['token'], "newhandle")
+    return user, channel['channel_id']
+
+def test_queries_match_memory(database):
+    user, channel_id = fill_store()
+    for start in (0, 5, 30, 58, 59):
+        assert channel_messages(user['token'], channel_id, start) == \
+            in_memory(channel_messages, user['token'], channel_id, start)
+    assert channels_list(user['token']) == in_memory(channels_list, user['token'])
+    for query_str in ("message", "message 5", "edited", '"quoted"', "ü", "me", "", "missing"):
+        assert search(user['token'], query_str) == in_memory(search, user['token'], query_str)
+
+def test_search_pages_match_memory(database):
+    user, _ = fill_store()
+    pages = []
+    before = None
+    while before != -1:
+        page = search(user['token'], "message", limit=7, before_message_id=before)
+        assert page == in_memory(search, user['token'], "message", limit=7, before_message_id=before)
+        pages += page['messages']
+        before = page['end']
+    assert len(pages) == 58
+    # The removed message still works as a cursor
+    assert search(user['token'], "mess", limit=50, before_message_id=1) == \
+        in_memory(search, user['token'], "mess", limit=50, before_message_id=1)
+    now = int(time.time())
+    assert search(user['token'], "e", since=now - 60, until=now + 60) == \
+        in_memory(search, user['token'], "e", since=now - 60, until=now + 60)
+
+def test_concurrent_reads(database):
+    user, channel_id = fill_store()
+
+    def read(start):
+        # As the server runs reading requests, sharing data.lock
+        with data.lock.reading():
+            return (channel_messages(user['token'], channel_id, start),
+                    search(user['token'], "message " + str(start)))
+    expected = [read(start) for start in range(40)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for _ in range(5):
+            assert list(executor.map(read, range(40))) == expected
+
+def test_load_round_trip(database, tmp_path):
+    user, channel_id = fill_store()
+    before = {
+        'messages': channel_messages(user['token'], channel_id, 0),
+        'details': channel_details(user['token'], channel_id),
+        'channels': channels_list(user['token']),
+        'search': search(user['token'], "edited")
+    }
+    scheduled = dict(data.scheduled_messages)
+    standup = (data.channels[channel_id].standup_end, list(data.channels[channel_id].standup_buffer.parts))
+    database.close()
+    store.use(memory_engine())
+
+    clear()
+    loaded = sqlite_store(str(tmp_path / 'store.sqlite'))
+    loaded.load()
+    store.use(sqlite_engine(loaded))
+    # Tokens issued before the restart still work, from memory and from the database
+    for read in (lambda function, *args: function(*args), in_memory):
+        assert read(channel_messages, user['token'], channel_id, 0) == before['messages']
+        assert read(channel_details, user['token'], channel_id) == before['details']
+        assert read(channels_list, user['token']) == before['channels']
+        assert read(search, user['token'], "edited") == before['search']
+    assert data.scheduled_messages == scheduled
+    assert (data.channels[channel_id].standup_end,
+            data.channels[channel_id].standup_buffer.parts) == standup
+    assert data.find_user_by_handle("newhandle") is not None
+    # New message ids carry on after the message sent later
+    assert message_send(user['token'], channel_id, "after")['message_id'] == 61
+
+def test_clear_empties_database(database):
+    fill_store()
+    clear()
+    for table in ('users', 'channels', 'members', 'messages', 'reacts', 'sessions'):
+        assert database.fetch_one('SELECT count(*) FROM ' + table)[0] == 0
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    channel_id = channels_create(user['token'], "channel", True)['channel_id']
+    message_send(user['token'], channel_id, "message")
+    assert search(user['token'], "message")['messages'][0]['message_id'] == 0
@@ -1,41 +1,46 @@
 from datetime import datetime, timedelta, timezone
-from data import data
+from data import data, MESSAGE_MAX_LENGTH
+from storage import store
 from other import valid_channel_id, authenticate_token, valid_user_id
-from user import user_profile
 from error import InputError, AccessError
-import threading
 import time
-from message import message_send
+from message import send_msg
 
 """ Couldn't avoid adding a new field to channels in data. Multiple standup timers have
     to be set independently for different channels """
 
-def timed_send(token, channel_id):
+def timed_send(u_id, channel_id):
     """
-    Called at the end of the timer set in the standup_start function.
-    Calls message send, after checking some conditions.
+    Run by the scheduler when the standup started by standup_start finishes.
+    Sends the collected messages as the user who started the standup, even
+    if they have logged out since.
     
     Parameters:
-        token (str): Passed on to message_send.
-        channel_id (int) Passed on to message_send. Also needed for channel data
+        u_id (int): The user who started the standup, sends the message.
+        channel_id (int): Needed for channel data
     
     Returns:
         None
     """
-    channel = valid_channel_id(channel_id)
-    
-    # Get standup details and reset
-    standup = channel.standup_details()
-    channel.standup_reset()
+    with data.lock:
+        channel = valid_channel_id(channel_id)
 
-    # Abort if no message has been queued
-    if standup['message_queue'] == "":
-        return
-    
-    # Call message send otherwise, truncating trailing newline characters
-    message_send(token, channel_id, standup['message_queue'])
+        # Get standup details and reset
+        standup = channel.standup_details()
+        buffer = channel.standup_reset()
+
+        # Abort if no message has been queued
+        if not buffer:
+            return
+
+        # Send it otherwise, joined into as few messages as fit the length limit
+        for text in buffer.render_messages(MESSAGE_MAX_LENGTH):
+            msg_id = store.messages.next_id()
+            send_msg(msg_id, u_id, text, channel, standup['time_finish'])
     return
 
+data.scheduler.register('standup', timed_send)
+
 def standup_active(token, channel_id):
     """
     Checks if a timer to timed_send is currently running.
@@ -88,12 +93,11 @@ def standup_start(token, channel_id, length):
     if length <= 0:
         raise InputError("Duration must be positive")
     
-    # Start the timer if reached here
-    timer = threading.Timer(length, timed_send, [token, channel_id])
-    timer.start()
+    # Schedule the end of the standup if reached here
+    data.scheduler.schedule_durable(time.time() + length, 'standup', (u_id, channel_id))
     current_time = int(time.time())
     added = current_time + length
-    channel.standup_end = added
+    channel.standup_start(added)
 
     return {
         'time_finish': channel.standup_end
@@ -121,16 +125,14 @@ def standup_send(token, channel_id, message):
         raise AccessError('User is not in the target channel')
 
     # Checking for invalid input
-    if len(message) > 1000:
+    if len(message) > MESSAGE_MAX_LENGTH:
         raise InputError(description = "Mesage too long")
 
     # Check that the timer is running
     if standup['time_finish'] is None:
         raise InputError(description = "Standup not active")
 
-    # Get senders handle
-    handle = user_profile(token, user_id)['user']['handle_str']
-    
-    # Add the message queue
-    channel.standup_message_add(handle, message)
+    # Add the message queue, the handle is looked up once the standup ends
+    if not channel.standup_message_add(user_id, message):
+        raise InputError(description = "Standup is full")
     return {}
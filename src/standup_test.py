@@ -1,10 +1,10 @@
 import pytest
 from auth import auth_login, auth_register, auth_logout
 from channels import channels_create
-from channel import channel_invite
+from channel import channel_invite, channel_messages
 from message import message_send, message_edit, message_remove
 from error import AccessError, InputError
-from standup import standup_start, standup_active, standup_send
+from standup import standup_start, standup_active, standup_send, timed_send
 from other import clear, search
 from data import data
 from user import user_profile
@@ -260,3 +260,118 @@ def test_standup_send_during_standup():
     name = user_profile(user['token'], user['u_id'])['user']['handle_str']
 
     assert check['messages'][0]['message'] == name + ": message1" + '\n' + name + ": message2"
+
+def test_standup_delivered_after_logout():
+    '''
+    Test that the standup is still sent when the user who started it has
+    logged out before it finishes
+    '''
+    clear()
+    user = auth_register("test@test.com", "password", "Firstname", "Lastname")
+    user2 = auth_register("test2@test.com", "password", "Secondname", "Lastname")
+    channel = channels_create(user['token'], "Channel", True)
+    channel_invite(user['token'], channel['channel_id'], user2['u_id'])
+
+    standup_start(user['token'], channel['channel_id'], 1)
+    standup_send(user['token'], channel['channel_id'], "before logout")
+    auth_logout(user['token'])
+    time.sleep(2)
+
+    check = search(user2['token'], "before logout")
+    assert len(check['messages']) == 1
+    assert check['messages'][0]['u_id'] == user['u_id']
+
+def test_standups_share_the_scheduler():
+    '''
+    Test that many standups at once are queued on the scheduler
+    rather than each starting a thread
+    '''
+    clear()
+    user = auth_register("test@test.com", "password", "Firstname", "Lastname")
+    channels = [channels_create(user['token'], "Channel" + str(i), True) for i in range(50)]
+    for channel in channels:
+        standup_start(user['token'], channel['channel_id'], 60)
+    assert data.scheduler.queue_depth() == 50
+    clear()
+
+def test_standup_buffer_parts_and_counts():
+    '''
+    Test that standup messages are kept as parts per user, and only joined
+    with the senders' handles when the standup ends
+    '''
+    clear()
+    user = auth_register("test@test.com", "password", "Firstname", "Lastname")
+    user2 = auth_register("test2@test.com", "password", "Secondname", "Lastname")
+    channel = channels_create(user['token'], "Channel", True)
+    channel_invite(user['token'], channel['channel_id'], user2['u_id'])
+
+    standup_start(user['token'], channel['channel_id'], 60)
+    standup_send(user['token'], channel['channel_id'], "one")
+    standup_send(user2['token'], channel['channel_id'], "two")
+    standup_send(user['token'], channel['channel_id'], "three")
+
+    buffer = data.channels[channel['channel_id']].standup_buffer
+    assert buffer.parts == [(user['u_id'], "one"), (user2['u_id'], "two"), (user['u_id'], "three")]
+    assert buffer.counts == {user['u_id']: 2, user2['u_id']: 1}
+    handle = data.find_user(user['u_id']).handle_str
+    handle2 = data.find_user(user2['u_id']).handle_str
+    assert buffer.render() == handle + ": one\n" + handle2 + ": two\n" + handle + ": three"
+    clear()
+
+def test_standup_buffer_full(monkeypatch):
+    '''
+    Test that standup_send raises an InputError once the standup holds
+    STANDUP_MAX_SIZE characters
+    '''
+    clear()
+    monkeypatch.setattr('data.STANDUP_MAX_SIZE', 10)
+    user = auth_register("test@test.com", "password", "Firstname", "Lastname")
+    channel = channels_create(user['token'], "Channel", True)
+
+    standup_start(user['token'], channel['channel_id'], 60)
+    standup_send(user['token'], channel['channel_id'], "12345")
+    standup_send(user['token'], channel['channel_id'], "67890")
+    with pytest.raises(InputError):
+        standup_send(user['token'], channel['channel_id'], "x")
+    clear()
+
+def test_standup_buffer_render_messages():
+    '''
+    Test that the parts are joined into messages of at most the given
+    length, breaking between lines and cutting up lines that are too long
+    '''
+    clear()
+    user = auth_register("test@test.com", "password", "Firstname", "Lastname")
+    channel = channels_create(user['token'], "Channel", True)
+    standup_start(user['token'], channel['channel_id'], 60)
+    for text in ("one", "two", "a much longer part"):
+        standup_send(user['token'], channel['channel_id'], text)
+
+    handle = data.find_user(user['u_id']).handle_str
+    buffer = data.channels[channel['channel_id']].standup_buffer
+    lines = [handle + ": one", handle + ": two", handle + ": a much longer part"]
+    assert buffer.render_messages(len(lines[0]) * 2 + 1) == [lines[0] + "\n" + lines[1], lines[2]]
+    assert "".join(buffer.render_messages(10)).replace("\n", "") == "".join(lines)
+    assert all(len(text) <= 10 for text in buffer.render_messages(10))
+    clear()
+
+def test_standup_longer_than_a_message():
+    '''
+    Test that a standup collecting more than the message length limit is
+    sent as several messages, none over the limit
+    '''
+    clear()
+    user = auth_register("test@test.com", "password", "Firstname", "Lastname")
+    channel = channels_create(user['token'], "Channel", True)
+    standup_start(user['token'], channel['channel_id'], 60)
+    for i in range(5):
+        standup_send(user['token'], channel['channel_id'], str(i) * 1000)
+    timed_send(user['u_id'], channel['channel_id'])
+
+    messages = channel_messages(user['token'], channel['channel_id'], 0)['messages']
+    assert len(messages) > 5
+    assert all(len(msg['message']) <= 1000 for msg in messages)
+    handle = data.find_user(user['u_id']).handle_str
+    sent = "".join(msg['message'] for msg in reversed(messages)).replace("\n", "")
+    assert sent == "".join(handle + ": " + str(i) * 1000 for i in range(5))
+    clear()
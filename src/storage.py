@@ -0,0 +1,402 @@
+""" Repositories the business logic reads and changes the store through
+
+Each kind of entity has a repository: store.users, store.sessions,
+store.channels and store.messages. auth.py, channel.py, channels.py,
+message.py, other.py, standup.py and user.py only read and change entities
+through them, so a storage engine is just a set of repositories, and
+swapping engines with store.use(engine) needs no change to those modules.
+
+Those modules do still use the services data.py keeps next to the store,
+which hold no entities and are the same under every engine:
+data.token_cache, data.search_cache and data.search_versions, the
+scheduler in data.scheduler, data.lock, and data.record, which other.clear
+calls to log the 'clear' record.
+
+Repositories hand out the entity classes of data.py: user, channel and
+message. After changing a user's fields, or the pin or reacts of a
+message, in place, pass it to save() so the engine keeps the change.
+
+memory_engine is the reference engine. It keeps everything in the
+data_class in data.py and records each change with data.record, which is
+how the write-ahead log and snapshots see it. storage_test.py is the
+contract every engine must pass.
+"""
+from data import data
+from message_store import message_columns
+
+# Most messages handed to one worker by memory_messages.search_shards
+SEARCH_SHARD_SIZE = 5000
+
+class memory_users:
+    def add(self, user):
+        data.new_user(user)
+
+    def find(self, u_id):
+        """ The user with u_id, or None """
+        return data.find_user(u_id)
+
+    def find_by_email(self, email):
+        """ The user with email, in any case, or None """
+        return data.find_user_by_email(email)
+
+    def find_by_handle(self, handle_str):
+        return data.find_user_by_handle(handle_str)
+
+    def count(self):
+        return data.num_users()
+
+    def all(self):
+        """ Every user, in u_id order """
+        return list(data.users)
+
+    def set_email(self, user, email):
+        data.update_email(user, email)
+
+    def set_handle(self, user, handle_str):
+        data.update_handle(user, handle_str)
+
+    def save(self, user):
+        """ Keeps the changes made to user's other fields """
+        data.record_user(user)
+
+class memory_sessions:
+    def add(self, token, u_id):
+        data.new_session(token, u_id)
+
+    def find(self, token):
+        """ The session of token, or None if it is not logged in """
+        return data.find_session(token)
+
+    def end(self, token):
+        """ Logs token out, returns False if it was not logged in """
+        return data.end_session(token)
+
+    def next_index(self):
+        """ Hands out the next unused session index, see auth.generate_token """
+        session_index = data.session_index
+        data.session_index += 1
+        return session_index
+
+class memory_channels:
+    def add(self, channel):
+        data.new_channel(channel)
+
+    def find(self, channel_id):
+        """ The channel with channel_id, or None """
+        # channel_ids are handed out in order, so they are positions too
+        if 0 <= channel_id < data.num_channels():
+            return data.channels[channel_id]
+        return None
+
+    def count(self):
+        return data.num_channels()
+
+    def all(self):
+        """ Every channel, in channel_id order """
+        return list(data.channels)
+
+    def of_user(self, u_id):
+        """ The channels u_id is a member of, in channel_id order """
+        return data.find_user_channels(u_id)
+
+    def listing(self, u_id):
+        """ The {channel_id, name} of each channel u_id is a member of, in channel_id order """
+        return [{'channel_id': channel.channel_id, 'name': channel.name}
+                for channel in self.of_user(u_id)]
+
+class memory_messages:
+    def next_id(self):
+        """ Hands out the next unused message_id """
+        return data.next_message_id()
+
+    def add(self, channel, message):
+        data.new_message(channel, message)
+
+    def find(self, message_id):
+        """ The (channel, message) pair of a live message, or None """
+        return data.find_message(message_id)
+
+    def remove(self, message_id):
+        data.remove_message(message_id)
+
+    def edit(self, message_id, text):
+        data.update_message(message_id, text)
+
+    def save(self, message):
+        """ Keeps changes made to the pin or reacts of message """
+        data.record_message_state(message)
+
+    def count(self, channel):
+        """ The number of live messages in channel """
+        return channel.num_messages()
+
+    def page(self, channel, first, last):
+        """
+        The live messages of channel from position first to last, counting
+        from the oldest, as message dictionaries newest first
+        """
+        positions = channel.live_positions(first, last)
+        positions.reverse()
+        history = channel.channel_messages
+        if isinstance(history, message_columns):
+            # Straight from the columns, without a message_row per message
+            return history.page_details(positions)
+        return [history[position].message_details() for position in positions]
+
+    def pinned(self, channel):
+        """ The live pinned messages of channel, as message dictionaries newest first """
+        history = channel.channel_messages
+        if isinstance(history, message_columns):
+            # A scan of the pinned column rather than of every message
+            return history.page_details(history.pinned_rows())
+        return [message.message_details() for message in reversed(history)
+                if message.is_pinned and not message.removed]
+
+    def between(self, channel, since, until, limit):
+        """
+        The newest live messages of channel created from since to until, as
+        message dictionaries newest first
+
+        Parameters:
+            channel (channel): the channel to read
+            since (int): the earliest time_created wanted, or None
+            until (int): the latest time_created wanted, or None
+            limit (int): the most messages to return
+
+        Returns:
+            messages (list): message dictionaries
+        """
+        history = channel.channel_messages
+        if isinstance(history, message_columns):
+            # Found by bisecting the time column
+            return history.page_details(history.rows_between(since, until, limit))
+        page = []
+        for message in reversed(history):
+            if len(page) == limit:
+                break
+            if not message.removed and (since is None or message.time_created >= since) \
+                    and (until is None or message.time_created <= until):
+                page.append(message.message_details())
+        return page
+
+    def search(self, u_id, query_str):
+        """
+        Finds every live message in u_id's channels containing query_str
+
+        Parameters:
+            u_id (int): the user searching
+            query_str (str): The string to search for
+
+        Returns:
+            messages (list): message dictionaries in channel_id order, then
+                             in the order they appear in their channel
+        """
+        # Let the word index narrow down the messages to check when it can,
+        # looking only at the user's channels
+        channel_ids = data.user_channel_index.get(u_id, ())
+        candidates = data.search_index.candidates(query_str, channel_ids)
+        if candidates is not None:
+            return self.search_candidates(u_id, query_str, candidates)
+
+        # Otherwise every message has to be checked, spread over workers if set up
+        if data.search_executor is not None:
+            return self.search_shards(u_id, query_str, data.search_executor)
+
+        # Otherwise search each channel the user is in for messages that contain the query
+        return_messages = []
+        for channel in data.find_user_channels(u_id):
+            for message in channel.channel_messages:
+                if not message.removed and query_str in message.message:
+                    return_messages.append(message.message_details())
+        return return_messages
+
+    def search_candidates(self, u_id, query_str, candidates):
+        """
+        Checks the messages picked out by the search index, keeping the ones
+        that really contain the query, and adds the archived messages that
+        contain it
+
+        Parameters:
+            u_id (int): the user searching
+            query_str (str): The string to search for
+            candidates (set): message_ids in the user's channels that may
+                              contain query_str
+
+        Returns:
+            messages (list): message dictionaries in channel_id order, then
+                             in the order they appear in their channel
+        """
+        matches = []
+        for message_id in candidates:
+            channel, message = data.find_message(message_id)
+            if query_str in message.message:
+                matches.append((channel.channel_id, message.seq, message))
+        channel_ids = data.user_channel_index.get(u_id, ())
+        for channel_id, seq, _, message_id in self.archived_matches(query_str, channel_ids):
+            matches.append((channel_id, seq, data.find_message(message_id)[1]))
+        matches.sort(key=lambda match: match[:2])
+        return [message.message_details() for _, _, message in matches]
+
+    def search_shards(self, u_id, query_str, executor):
+        """
+        Checks every message in the user's channels on a pool of workers. The
+        messages are cut into shards of at most SEARCH_SHARD_SIZE, each worker
+        is only sent the text of its shard, and the matches are put back
+        together in the same order as a search done one channel at a time.
+
+        Parameters:
+            u_id (int): the user searching
+            query_str (str): The string to search for
+            executor (Executor): a concurrent.futures thread or process pool
+
+        Returns:
+            messages (list): message dictionaries in channel order, then
+                             in the order they appear in their channel
+        """
+        shards = [[]]
+        for channel in data.find_user_channels(u_id):
+            for message in channel.channel_messages:
+                if not message.removed:
+                    if len(shards[-1]) == SEARCH_SHARD_SIZE:
+                        shards.append([])
+                    shards[-1].append(message)
+
+        futures = [executor.submit(scan_shard, query_str, [message.message for message in shard])
+                   for shard in shards if shard]
+        matches = []
+        for shard, future in zip(shards, futures):
+            matches += [shard[i].message_details() for i in future.result()]
+        return matches
+
+    def search_page(self, u_id, query_str, limit, since, until, before):
+        """
+        Finds up to limit live messages in u_id's channels containing
+        query_str, newest first. The search index hands over candidates in
+        time order, so only the messages up to the end of the page are ever
+        checked or turned into dictionaries.
+
+        Parameters:
+            u_id (int): the user searching
+            query_str (str): The string to search for
+            limit (int): the most messages to return
+            since (int): ignore messages sent before this time, if given
+            until (int): ignore messages sent after this time, if given
+            before (tuple): only return messages whose (time_created,
+                            message_id) is below this key, see time_key
+
+        Returns:
+            messages (list): message dictionaries
+        """
+        page = []
+        channel_ids = data.user_channel_index.get(u_id, ())
+        archived = [(time_created, message_id) for _, _, time_created, message_id
+                    in self.archived_matches(query_str, channel_ids)]
+        for message_id in data.search_index.newest_first(query_str, channel_ids,
+                                                         since, until, before, archived):
+            message = data.find_message(message_id)[1]
+            if query_str in message.message:
+                page.append(message)
+                if len(page) == limit:
+                    break
+        return [message.message_details() for message in page]
+
+    def time_key(self, message_id):
+        """ The (time_created, message_id) sort key of a live or removed message, or None """
+        found = data.find_message(message_id)
+        if found is not None:
+            data.search_index.build((found[0].channel_id,))
+        key = data.search_index.time_key(message_id)
+        if key is None and found is not None:
+            # Archived messages are not in the index
+            key = (found[1].time_created, message_id)
+        return key
+
+    def archived_matches(self, query_str, channel_ids):
+        """
+        The (channel_id, seq, time_created, message_id) of each archived
+        message in channel_ids containing query_str. The search index leaves
+        archived messages out, so they are looked for in the archive file
+        """
+        if data.archive is None:
+            return []
+        return data.archive.matches(query_str, channel_ids)
+
+    def schedule(self, message_id, job_id, u_id):
+        """ Notes that message_id is waiting to be sent by u_id's scheduler job job_id """
+        data.schedule_message(message_id, job_id, u_id)
+
+    def find_scheduled(self, message_id):
+        """ The (job_id, u_id) of a message waiting to be sent, or None """
+        return data.scheduled_messages.get(message_id)
+
+    def unschedule(self, message_id):
+        data.unschedule_message(message_id)
+
+def scan_shard(query_str, texts):
+    """ Returns the positions in texts of the ones containing query_str, run by a worker """
+    return [i for i, text in enumerate(texts) if query_str in text]
+
+class memory_engine:
+    """ The reference engine, keeping everything in data.py's data_class """
+    def __init__(self):
+        self.users = memory_users()
+        self.sessions = memory_sessions()
+        self.channels = memory_channels()
+        self.messages = memory_messages()
+
+    def attach(self):
+        """ Called by store.use once the engine is in use """
+
+    def detach(self):
+        """ Called by store.use once another engine is in use """
+
+    def clear(self):
+        """ Removes every entity """
+        data.users.clear()
+        data.channels.clear()
+        data.sessions.clear()
+        data.session_index = 0
+        data.user_id_index.clear()
+        data.email_index.clear()
+        data.handle_index.clear()
+        data.message_id_index.clear()
+        data.user_channel_index.clear()
+        data.search_index.clear()
+        data.membership_versions.clear()
+        data.scheduled_messages.clear()
+        data.message_index = 0
+        if data.archive is not None:
+            data.archive.clear()
+
+class storage:
+    """ The repositories of the storage engine in use """
+    def __init__(self, engine):
+        self.engine = None
+        self.use(engine)
+
+    def use(self, engine):
+        """
+        Switches the business logic over to engine
+
+        Parameters:
+            engine (object): has users, sessions, channels and messages
+                             repositories and attach, detach and clear
+
+        Returns:
+            previous (object): the engine used until now
+        """
+        previous = self.engine
+        if previous is not None:
+            previous.detach()
+        self.engine = engine
+        self.users = engine.users
+        self.sessions = engine.sessions
+        self.channels = engine.channels
+        self.messages = engine.messages
+        engine.attach()
+        return previous
+
+    def clear(self):
+        self.engine.clear()
+
+store = storage(memory_engine())
@@ -0,0 +1,182 @@
+""" Contract tests every storage engine in storage.py must pass
+
+To check a new engine, add a function making one to ENGINES.
+"""
+import pytest
+from data import data, user, channel, message
+from message_store import message_columns
+from other import clear
+from storage import store, memory_engine
+from sqlite_store import sqlite_store, sqlite_engine
+
+def columnar_engine(tmp_path):
+    data.history_class = message_columns
+    return memory_engine()
+
+def database_engine(tmp_path):
+    return sqlite_engine(sqlite_store(str(tmp_path / 'store.sqlite')))
+
+ENGINES = {
+    'memory': lambda tmp_path: memory_engine(),
+    'memory_columnar': columnar_engine,
+    'sqlite': database_engine
+}
+
+@pytest.fixture(params=sorted(ENGINES))
+def engine(request, tmp_path):
+    previous_class = data.history_class
+    clear()
+    previous = store.use(ENGINES[request.param](tmp_path))
+    yield store.engine
+    clear()
+    if data.database is not None:
+        data.database.close()
+    store.use(previous)
+    data.history_class = previous_class
+
+def add_user(email, name_first):
+    new_user = user(email, "password", name_first, "last")
+    store.users.add(new_user)
+    return new_user
+
+def add_channel(name, members):
+    new_channel = channel(name, True)
+    store.channels.add(new_channel)
+    for member in members:
+        new_channel.new_member(member)
+    return new_channel
+
+def add_message(target, sender, text, time_created):
+    new_message = message(text, sender.u_id, store.messages.next_id())
+    new_message.time_created = time_created
+    store.messages.add(target, new_message)
+    return new_message.message_id
+
+def test_users(engine):
+    first = add_user("first@test.com", "first")
+    second = add_user("second@test.com", "second")
+    assert store.users.count() == 2
+    assert store.users.all() == [first, second]
+    assert store.users.find(second.u_id) is second
+    assert store.users.find(5) is None
+    assert store.users.find_by_email("FIRST@test.com") is first
+    assert store.users.find_by_handle(second.handle_str) is second
+
+    store.users.set_email(first, "renamed@test.com")
+    store.users.set_handle(first, "newhandle")
+    assert store.users.find_by_email("first@test.com") is None
+    assert store.users.find_by_email("renamed@test.com") is first
+    assert store.users.find_by_handle("newhandle") is first
+    first.permission_id = 2
+    store.users.save(first)
+    assert store.users.find(first.u_id).permission_id == 2
+
+def test_sessions(engine):
+    owner = add_user("first@test.com", "first")
+    assert [store.sessions.next_index() for _ in range(3)] == [0, 1, 2]
+    store.sessions.add("token", owner.u_id)
+    assert store.sessions.find("token").u_id == owner.u_id
+    assert store.sessions.end("token")
+    assert not store.sessions.end("token")
+    assert store.sessions.find("token") is None
+
+def test_channels(engine):
+    first = add_user("first@test.com", "first")
+    second = add_user("second@test.com", "second")
+    shared = add_channel("shared", [first, second])
+    own = add_channel("own", [second])
+    assert store.channels.count() == 2
+    assert store.channels.all() == [shared, own]
+    assert store.channels.find(own.channel_id) is own
+    assert store.channels.find(2) is None
+    assert store.channels.find(-1) is None
+    assert store.channels.of_user(second.u_id) == [shared, own]
+    assert store.channels.listing(second.u_id) == [{'channel_id': shared.channel_id, 'name': "shared"},
+                                                   {'channel_id': own.channel_id, 'name': "own"}]
+    shared.remove_member(second)
+    assert store.channels.listing(second.u_id) == [{'channel_id': own.channel_id, 'name': "own"}]
+    assert store.channels.listing(first.u_id) == [{'channel_id': shared.channel_id, 'name': "shared"}]
+
+def test_messages(engine):
+    sender = add_user("first@test.com", "first")
+    target = add_channel("channel", [sender])
+    message_ids = [add_message(target, sender, "message " + str(i), 1000 + i) for i in range(5)]
+    assert message_ids == list(range(5))
+    assert store.messages.count(target) == 5
+    found_channel, found = store.messages.find(message_ids[2])
+    assert found_channel is target and found.message == "message 2"
+
+    store.messages.remove(message_ids[1])
+    store.messages.edit(message_ids[2], "edited")
+    found.is_pinned = True
+    found.new_react({'react_id': 1, 'u_ids': [sender.u_id], 'is_this_user_reacted': True})
+    store.messages.save(found)
+
+    assert store.messages.find(message_ids[1]) is None
+    assert store.messages.count(target) == 4
+    page = store.messages.page(target, 0, 3)
+    assert [msg['message_id'] for msg in page] == [4, 3, 2, 0]
+    assert page[2] == {
+        'message_id': 2,
+        'u_id': sender.u_id,
+        'message': "edited",
+        'time_created': 1002,
+        'is_pinned': True,
+        'reacts': [{'react_id': 1, 'u_ids': [sender.u_id], 'is_this_user_reacted': True}]
+    }
+    assert [msg['message_id'] for msg in store.messages.page(target, 1, 2)] == [3, 2]
+    assert store.messages.page(target, 0, -1) == []
+
+def test_search(engine):
+    sender = add_user("first@test.com", "first")
+    outsider = add_user("second@test.com", "second")
+    first = add_channel("first", [sender])
+    second = add_channel("second", [sender, outsider])
+    add_message(second, sender, "hello there", 1000)
+    add_message(first, sender, "Hello again", 1001)
+    add_message(first, sender, "well hello", 1002)
+    removed = add_message(second, sender, "hello removed", 1003)
+    store.messages.remove(removed)
+
+    def found(messages):
+        return [msg['message_id'] for msg in messages]
+    # Channel order first, then the order within each channel
+    assert found(store.messages.search(sender.u_id, "ello")) == [1, 2, 0]
+    assert found(store.messages.search(sender.u_id, "hello")) == [2, 0]
+    assert found(store.messages.search(outsider.u_id, "hello")) == [0]
+    assert found(store.messages.search(sender.u_id, "lo")) == [1, 2, 0]
+    assert store.messages.search(sender.u_id, "missing") == []
+
+    # Pages are newest first, bounded by time and by a cursor
+    assert found(store.messages.search_page(sender.u_id, "ello", 2, None, None, None)) == [2, 1]
+    assert found(store.messages.search_page(sender.u_id, "ello", 50, 1001, None, None)) == [2, 1]
+    assert found(store.messages.search_page(sender.u_id, "ello", 50, None, 1001, None)) == [1, 0]
+    before = store.messages.time_key(1)
+    assert before == (1001, 1)
+    assert found(store.messages.search_page(sender.u_id, "ello", 50, None, None, before)) == [0]
+    # A removed message still has a key, so it still works as a cursor
+    assert store.messages.time_key(removed) == (1003, removed)
+    assert store.messages.time_key(99) is None
+
+def test_scheduled_messages(engine):
+    assert store.messages.find_scheduled(0) is None
+    store.messages.schedule(0, 7, 1)
+    assert store.messages.find_scheduled(0) == (7, 1)
+    store.messages.unschedule(0)
+    store.messages.unschedule(0)
+    assert store.messages.find_scheduled(0) is None
+
+def test_clear(engine):
+    sender = add_user("first@test.com", "first")
+    target = add_channel("channel", [sender])
+    add_message(target, sender, "message", 1000)
+    store.sessions.add("token", sender.u_id)
+    clear()
+    assert store.users.count() == 0
+    assert store.users.find_by_email("first@test.com") is None
+    assert store.channels.count() == 0
+    assert store.channels.listing(sender.u_id) == []
+    assert store.sessions.find("token") is None
+    assert store.messages.find(0) is None
+    assert store.messages.search(sender.u_id, "message") == []
+    assert store.messages.next_id() == 0
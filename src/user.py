@@ -1,7 +1,7 @@
 from error import InputError, AccessError
 from other import clear, existing_email, valid_email, valid_user_id
 from other import existing_handle, authenticate_token
-from data import data
+from storage import store
 
 import jwt
 import urllib
@@ -30,7 +30,7 @@ def user_profile(token, u_id):
     authenticate_token(token)
 
     return {
-    	'user': data.users[u_id].user_details()
+    	'user': store.users.find(u_id).user_details()
     }
 
 def user_profile_setname(token, name_first, name_last):
@@ -70,10 +70,11 @@ def user_profile_setname(token, name_first, name_last):
     # check that token is authorised
     tok = authenticate_token(token)
 
-    user = data.users[tok]
+    user = store.users.find(tok)
 
     user.name_first = name_first
     user.name_last = name_last
+    store.users.save(user)
     return {
     }
 
@@ -106,8 +107,8 @@ def user_profile_setemail(token, email):
     # check that token is authorised
     tok = authenticate_token(token)
 
-    user = data.users[tok]
-    user.email = email
+    user = store.users.find(tok)
+    store.users.set_email(user, email)
     return {
     }
 
@@ -144,8 +145,8 @@ def user_profile_sethandle(token, handle_str):
     # check that handle_str is not being used by another user
     existing_handle(handle_str)
 
-    user = data.users[tok]
-    user.handle_str = handle_str
+    user = store.users.find(tok)
+    store.users.set_handle(user, handle_str)
     return {
     }
 
@@ -193,6 +194,8 @@ def user_profile_uploadphoto(token, img_url, x_start, y_start, x_end, y_end, hos
     img_cropped = img.crop((x_start, y_start, x_end, y_end))
     img_cropped.save(path)
 
-    data.users[user_id].update_profile_img_url(host_url + path)
+    user = store.users.find(user_id)
+    user.update_profile_img_url(host_url + path)
+    store.users.save(user)
 
     return {}
@@ -0,0 +1,277 @@
+""" Write-ahead log of every change made to the store
+
+Each change to the store is recorded by data.record as one JSON line: the
+record's log sequence number (lsn) followed by what changed, for example
+["message", channel_id, message_id, u_id, text, time_created, ...]. Records
+hold the values the change produced rather than the call that made it, so
+replaying them never depends on the clock, random numbers or the network.
+
+Records are appended to a buffer and a writer thread writes and fsyncs the
+buffer in batches, so any number of requests waiting for their records to
+be durable share one fsync (group commit). The log is split into segment
+files named after the first lsn they may hold. Each snapshot starts a new
+segment, and the segments it covers are deleted once it is saved.
+"""
+import json
+import os
+import threading
+from data import data, user, channel, message, NO_REACTS
+from other import clear
+
+SEGMENT_PREFIX = 'wal-'
+SEGMENT_SUFFIX = '.log'
+
+class write_ahead_log:
+    def __init__(self, directory, last_lsn=0):
+        self.directory = directory
+        self.last_lsn = last_lsn
+        self.flushed_lsn = last_lsn
+        self.buffer = []
+        self.condition = threading.Condition()
+        # Held while a batch is written, so segments are never switched mid-write
+        self.write_lock = threading.Lock()
+        # The last lsn appended by each thread, see wait_for_thread
+        self.appended = threading.local()
+        path = segment_path(directory, last_lsn + 1)
+        if os.path.exists(path):
+            drop_torn_record(path)
+        self.file = open(path, 'a')
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, entry):
+        """
+        Adds a record to the log, it is written by the writer thread
+
+        Parameters:
+            entry (tuple): the kind of change followed by its values
+
+        Returns:
+            lsn (int): the record's log sequence number
+        """
+        with self.condition:
+            self.last_lsn += 1
+            self.buffer.append(json.dumps([self.last_lsn] + list(entry)) + '\n')
+            self.appended.lsn = self.last_lsn
+            self.condition.notify_all()
+            return self.last_lsn
+
+    def wait(self, lsn):
+        """ Blocks until the record lsn and every one before it is on disk """
+        with self.condition:
+            while self.flushed_lsn < lsn:
+                self.condition.wait()
+
+    def wait_for_thread(self):
+        """ Waits for the records appended by the calling thread to be on disk """
+        lsn = getattr(self.appended, 'lsn', None)
+        if lsn is not None:
+            self.appended.lsn = None
+            self.wait(lsn)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.buffer and not self.closed:
+                    self.condition.wait()
+                if self.closed and not self.buffer:
+                    return
+            self.flush()
+
+    def flush(self):
+        """ Writes and fsyncs every record appended so far, as one batch """
+        with self.write_lock:
+            with self.condition:
+                batch, self.buffer = self.buffer, []
+                batch_lsn = self.last_lsn
+            if batch:
+                self.file.write(''.join(batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            with self.condition:
+                self.flushed_lsn = max(self.flushed_lsn, batch_lsn)
+                self.condition.notify_all()
+
+    def rotate(self):
+        """
+        Flushes the log and starts a new segment. The caller must stop the
+        store changing meanwhile, as snapshot.capture does by holding data.lock
+        for reading
+
+        Returns:
+            lsn (int): the last lsn in the finished segments
+        """
+        with self.write_lock:
+            with self.condition:
+                batch, self.buffer = self.buffer, []
+                lsn = self.last_lsn
+            self.file.write(''.join(batch))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = open(segment_path(self.directory, lsn + 1), 'a')
+            with self.condition:
+                self.flushed_lsn = max(self.flushed_lsn, lsn)
+                self.condition.notify_all()
+        return lsn
+
+    def drop_segments(self, lsn):
+        """ Deletes the segments holding only records up to lsn, once a snapshot covers them """
+        for start, path in segments(self.directory):
+            if start <= lsn and path != self.file.name:
+                os.remove(path)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+def drop_torn_record(path):
+    """ Cuts a segment back to its last complete line, so new records start on a line of their own """
+    with open(path, 'rb+') as segment:
+        contents = segment.read()
+        segment.truncate(contents.rfind(b'\n') + 1)
+
+def segment_path(directory, first_lsn):
+    return os.path.join(directory, SEGMENT_PREFIX + '%020d' % first_lsn + SEGMENT_SUFFIX)
+
+def segments(directory):
+    """ The (first lsn, path) of each segment in directory, oldest first """
+    found = []
+    for name in os.listdir(directory):
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+            found.append((int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]),
+                          os.path.join(directory, name)))
+    return sorted(found)
+
+def read_log(directory):
+    """
+    Yields every complete record in the log, in order. A crash can leave
+    the last record of a segment cut short, it was never acknowledged so
+    it is skipped
+
+    Parameters:
+        directory (str): the directory holding the segments
+
+    Returns:
+        records (generator): lists of [lsn, kind, values...]
+    """
+    for _, path in segments(directory):
+        with open(path) as segment:
+            for line in segment:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    break
+
+def replay(directory, after_lsn=0):
+    """
+    Applies the records in the log after after_lsn to the store, normally
+    on top of the snapshot that covers the records up to after_lsn. Call it
+    before data.wal is opened, so replaying does not log the records again
+
+    Parameters:
+        directory (str): the directory holding the segments
+        after_lsn (int): the last lsn already in the store
+
+    Returns:
+        last_lsn (int): the lsn of the last record applied
+    """
+    last_lsn = after_lsn
+    with data.lock:
+        for record in read_log(directory):
+            lsn, kind, values = record[0], record[1], record[2:]
+            if lsn <= last_lsn:
+                continue
+            APPLY[kind](*values)
+            last_lsn = lsn
+    return last_lsn
+
+def apply_user(*fields):
+    values = dict(zip(user.__slots__, fields))
+    existing = data.find_user(values['u_id'])
+    if existing is None:
+        existing = user.__new__(user)
+        for field, value in values.items():
+            setattr(existing, field, value)
+        data.new_user(existing)
+        return
+    if existing.email != values['email']:
+        data.update_email(existing, values['email'])
+    if existing.handle_str != values['handle_str']:
+        data.update_handle(existing, values['handle_str'])
+    for field, value in values.items():
+        setattr(existing, field, value)
+
+def apply_session(token, u_id, session_index):
+    data.new_session(token, u_id)
+    data.session_index = session_index
+
+def apply_channel(channel_id, name, is_public):
+    # channel_ids are handed out in order, so this gets channel_id back
+    data.new_channel(channel(name, is_public))
+
+def apply_member(channel_id, u_id, joined):
+    if joined:
+        data.channels[channel_id].new_member(data.find_user(u_id))
+    else:
+        data.channels[channel_id].remove_member(data.find_user(u_id))
+
+def apply_owner(channel_id, u_id, added):
+    if added:
+        data.channels[channel_id].new_owner(data.find_user(u_id))
+    else:
+        data.channels[channel_id].remove_owner(data.find_user(u_id))
+
+def apply_message(channel_id, message_id, u_id, text, time_created, is_pinned, reacts, seq):
+    new_message = message(text, u_id, message_id)
+    new_message.time_created = time_created
+    new_message.is_pinned = is_pinned
+    new_message.reacts = reacts or NO_REACTS
+    target = data.channels[channel_id]
+    target.next_seq = seq
+    data.new_message(target, new_message)
+
+def apply_message_state(message_id, is_pinned, reacts):
+    stored = data.find_message(message_id)[1]
+    stored.is_pinned = is_pinned
+    stored.reacts = reacts or NO_REACTS
+
+def apply_message_index(message_index):
+    data.message_index = message_index
+
+def apply_scheduled(message_id, job_id, u_id):
+    data.scheduled_messages[message_id] = (job_id, u_id)
+
+def apply_standup_part(channel_id, u_id, text):
+    data.channels[channel_id].standup_buffer.add(u_id, text)
+
+def apply_hangman(channel_id, mode, word, guesses):
+    game = data.channels[channel_id].hangman
+    game.mode, game.word, game.guesses = mode, word, guesses
+
+# kind -> function applying a record of that kind to the store
+APPLY = {
+    'clear': clear,
+    'user': apply_user,
+    'session': apply_session,
+    'end_session': data.end_session,
+    'channel': apply_channel,
+    'member': apply_member,
+    'owner': apply_owner,
+    'message': apply_message,
+    'edit': data.update_message,
+    'remove_message': data.remove_message,
+    'message_state': apply_message_state,
+    'message_index': apply_message_index,
+    'scheduled': apply_scheduled,
+    'unscheduled': data.unschedule_message,
+    'standup_start': lambda channel_id, time_finish: data.channels[channel_id].standup_start(time_finish),
+    'standup_part': apply_standup_part,
+    'standup_reset': lambda channel_id: data.channels[channel_id].standup_reset(),
+    'hangman': apply_hangman
+}
@@ -0,0 +1,173 @@
+""" Tests for wal.py """
+import threading
+import time
+import pytest
+import wal
+from data import data
+from auth import auth_register, auth_login, auth_logout
+from channel import channel_messages, channel_details, channel_invite, channel_leave
+from channels import channels_create, channels_list
+from message import message_send, message_remove, message_edit, message_react, message_pin
+from message import message_sendlater, message_sendlater_cancel
+from standup import standup_start, standup_send
+from user import user_profile_setname, user_profile_sethandle
+from message_store import message_columns
+from other import clear, search, users_all, admin_userpermission_change
+from snapshot import save_snapshot, load_snapshot
+from wal import write_ahead_log, replay, segments
+
+@pytest.fixture(params=[list, message_columns])
+def history_class(request):
+    previous = data.history_class
+    data.history_class = request.param
+    yield request.param
+    data.history_class = previous
+    close_wal()
+    clear()
+
+def open_wal(directory, last_lsn=0):
+    data.wal = write_ahead_log(str(directory), last_lsn)
+
+def close_wal():
+    if data.wal is not None:
+        data.wal.close()
+        data.wal = None
+
+def store_state(user, channel_id):
+    return {
+        'messages': channel_messages(user['token'], channel_id, 0),
+        'details': channel_details(user['token'], channel_id),
+        'channels': channels_list(user['token']),
+        'users': users_all(user['token']),
+        'search': search(user['token'], "edited")
+    }
+
+def fill_store():
+    """ Makes a change of every kind through the API, returning the first user and channel """
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    user2 = auth_register("test2@test.com", "password", "secondName", "lastName")
+    user3 = auth_register("test3@test.com", "password", "thirdName", "lastName")
+    auth_logout(user3['token'])
+    channel = channels_create(user['token'], "channel", True)
+    channel_invite(user['token'], channel['channel_id'], user2['u_id'])
+    channel_invite(user['token'], channel['channel_id'], user3['u_id'])
+    channel_leave(auth_login("test3@test.com", "password")['token'], channel['channel_id'])
+    msg_ids = [message_send(user['token'], channel['channel_id'], "message " + str(i))['message_id']
+               for i in range(5)]
+    message_remove(user['token'], msg_ids[1])
+    message_edit(user['token'], msg_ids[2], "edited ü")
+    message_react(user2['token'], msg_ids[3], 1)
+    message_pin(user['token'], msg_ids[4])
+    later = message_sendlater(user['token'], channel['channel_id'], "later", int(time.time()) + 60)
+    message_sendlater_cancel(user['token'], later['message_id'])
+    standup_start(user['token'], channel['channel_id'], 60)
+    standup_send(user2['token'], channel['channel_id'], "standup part")
+    user_profile_setname(user2['token'], "renamed", "lastName")
+    user_profile_sethandle(user2['token'], "newhandle")
+    admin_userpermission_change(user['token'], user2['u_id'], 1)
+    return user, channel['channel_id']
+
+def test_wal_round_trip(tmp_path, history_class):
+    clear()
+    open_wal(tmp_path)
+    user, channel_id = fill_store()
+    before = store_state(user, channel_id)
+    standup_parts = list(data.channels[channel_id].standup_buffer.parts)
+    close_wal()
+
+    clear()
+    last_lsn = replay(str(tmp_path))
+    assert last_lsn > 0
+    # Tokens issued before the restart still work
+    assert store_state(user, channel_id) == before
+    assert data.channels[channel_id].standup_buffer.parts == standup_parts
+    assert isinstance(data.channels[channel_id].channel_messages, history_class)
+    # New message ids carry on from the log
+    assert message_send(user['token'], channel_id, "after")['message_id'] == 6
+
+def test_wal_after_clear(tmp_path):
+    clear()
+    open_wal(tmp_path)
+    auth_register("old@test.com", "password", "firstName", "lastName")
+    clear()
+    user = auth_register("new@test.com", "password", "firstName", "lastName")
+    close_wal()
+
+    clear()
+    replay(str(tmp_path))
+    assert [profile['email'] for profile in users_all(user['token'])['users']] == ["new@test.com"]
+
+def test_wal_on_top_of_snapshot(tmp_path, history_class):
+    clear()
+    open_wal(tmp_path)
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    channel_id = channels_create(user['token'], "channel", True)['channel_id']
+    message_send(user['token'], channel_id, "before snapshot")
+    snapshot_path = str(tmp_path / 'store.snapshot')
+    save_snapshot(snapshot_path)
+    # The snapshot holds everything in the first segment, so it is gone
+    assert len(segments(str(tmp_path))) == 1
+    message_edit(user['token'], 0, "edited after snapshot")
+    message_send(user['token'], channel_id, "after snapshot")
+    before = store_state(user, channel_id)
+    close_wal()
+
+    clear()
+    snapshot_lsn = load_snapshot(snapshot_path)
+    assert snapshot_lsn > 0
+    last_lsn = replay(str(tmp_path), snapshot_lsn)
+    assert last_lsn > snapshot_lsn
+    assert store_state(user, channel_id) == before
+
+def test_wal_torn_record(tmp_path):
+    clear()
+    open_wal(tmp_path)
+    user = auth_register("test@test.com", "password", "firstName", "lastName")
+    channel_id = channels_create(user['token'], "channel", True)['channel_id']
+    close_wal()
+    # A crash part way through writing a record
+    path = segments(str(tmp_path))[-1][1]
+    with open(path, 'a') as segment:
+        segment.write('[999, "message", 0, 0')
+
+    clear()
+    last_lsn = replay(str(tmp_path))
+    assert channel_details(user['token'], channel_id)['name'] == "channel"
+    # Writing carries on after the last complete record
+    open_wal(tmp_path, last_lsn)
+    message_send(user['token'], channel_id, "after crash")
+    close_wal()
+    clear()
+    replay(str(tmp_path))
+    assert channel_messages(user['token'], channel_id, 0)['messages'][0]['message'] == "after crash"
+    clear()
+
+def test_wal_group_commit(tmp_path, monkeypatch):
+    fsyncs = []
+    real_fsync = wal.os.fsync
+    def slow_fsync(fd):
+        fsyncs.append(fd)
+        time.sleep(0.01)
+        real_fsync(fd)
+    monkeypatch.setattr(wal.os, 'fsync', slow_fsync)
+
+    log = write_ahead_log(str(tmp_path))
+    unflushed = []
+    def writer():
+        for i in range(10):
+            lsn = log.append(('message_index', i))
+            log.wait_for_thread()
+            if log.flushed_lsn < lsn:
+                unflushed.append(lsn)
+    threads = [threading.Thread(target=writer) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    log.close()
+
+    assert not unflushed
+    assert log.flushed_lsn == 200
+    # Writers waiting at the same time share an fsync
+    assert len(fsyncs) < 200
+    assert [record[0] for record in wal.read_log(str(tmp_path))] == list(range(1, 201))